@@ -1,3 +1,3 @@
 """clip video encode"""
 
-from .clip_video_encode import clip_video_encode
+from .clip_video_encode import clip_video_encode, encode_iter
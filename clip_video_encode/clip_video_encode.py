@@ -1,15 +1,18 @@
 """encode video with CLIP"""
+import json
+import signal
 import sys
+import threading
 import time
 
 import math
 import torch
 
-from video2numpy.frame_reader import FrameReader
-
-from .reader import Reader, read_shard
+from .frame_reader import TRANSIENT_ERRORS, FrameReader, SceneSampler
+from .manifest import manifest_dataset
+from .reader import Reader, StreamingReader, is_table_src, read_shard
 from .simplemapper import FrameMapper
-from .writer import FileWriter, WebDatasetWriter
+from .writer import FileWriter, MemoryWriter, WebDatasetWriter, load_partials, write_failures
 from .distributed import world_info_from_env
 from .handle_chunk import encode_chunk
 
@@ -19,6 +22,8 @@ import os
 import braceexpand
 import fsspec
 import io
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 
 CHUNK_SIZE = 100
 
@@ -27,12 +32,214 @@ def _convert_image_to_rgb(image):
     return image.convert("RGB")
 
 
+def iter_chunks(fr, captioning_strategy="none", stop=None):
+    """
+    groups videos read by a FrameReader into chunks of CHUNK_SIZE videos
+
+    Input:
+        stop: threading.Event, once it's set the videos read so far are yielded as the last chunk
+    Output:
+        iterator of (frames, frame_times, ind_dict) to pass to encode_chunk
+    """
+    frames, frame_times, ind_dict = [], [], {}
+    block_size = 0
+    for vid_frames, info in fr:
+        vid_times = info["timestamps"]
+
+        if captioning_strategy == "center":
+            vid_frames = vid_frames[len(vid_frames) // 2 : len(vid_frames) // 2 + 1]
+            vid_times = vid_times[len(vid_times) // 2 : len(vid_times) // 2 + 1]
+
+        frames.append(vid_frames)
+        frame_times.append(vid_times)
+        ind_dict[info["reference"]] = (
+            block_size,
+            block_size + vid_frames.shape[0],
+            info["dst_name"],
+        )
+        block_size += vid_frames.shape[0]
+
+        stopping = stop is not None and stop.is_set()
+        if len(ind_dict) == CHUNK_SIZE or stopping:
+            yield frames, frame_times, ind_dict
+            frames, frame_times, ind_dict, block_size = [], [], {}, 0
+        if stopping:
+            return
+
+    if len(frames) > 0:
+        yield frames, frame_times, ind_dict
+
+
+def read_chunks(vids, refs, reader_kwargs, captioning_strategy="none", retry_passes=0, failures=None, stop=None):
+    """
+    reads videos in chunks (see iter_chunks), videos that failed for transient reasons (see TRANSIENT_ERRORS)
+    are read again in up to retry_passes separate passes once all other videos were read
+
+    Input:
+        reader_kwargs: FrameReader arguments besides vids and refs
+        failures: list the failures (see FrameReader.failures) that remain after all passes are appended to
+        stop: threading.Event to stop reading early (see iter_chunks)
+    """
+    for retry in range(retry_passes + 1):
+        fr = FrameReader(vids, refs, retry=retry, stop=stop, **reader_kwargs)
+        fr.start_reading()
+        try:
+            yield from iter_chunks(fr, captioning_strategy, stop)
+        finally:
+            fr.terminate()  # in case the caller stopped iterating early
+
+        last_pass = retry == retry_passes or (stop is not None and stop.is_set())
+        retried = [] if last_pass else [f for f in fr.failures if f["kind"] in TRANSIENT_ERRORS]
+        if failures is not None:
+            failures.extend(f for f in fr.failures if f not in retried)
+        if len(retried) == 0:
+            return
+        print(f"Retrying {len(retried)} failed videos...")
+        vids, refs = [f["video"] for f in retried], [f["reference"] for f in retried]
+
+
+def get_failure_rows(failures, ids, shard=""):
+    """FrameReader failures -> write_failures rows"""
+    return [
+        {
+            "video": f["video"],
+            "videoID": ids.get(f["reference"], "") if isinstance(ids, dict) else ids[f["reference"]],
+            "reason": f["kind"],
+            "message": f["message"],
+            "shard": shard,
+        }
+        for f in failures
+    ]
+
+
+def stop_on_sigterm():
+    """
+    makes SIGTERM (f.e. preemption) set an event instead of killing the process so work in flight can be saved
+
+    Output:
+        stop: threading.Event set once SIGTERM was received
+        restore: function restoring the previous handler
+    """
+    stop = threading.Event()
+    if threading.current_thread() is not threading.main_thread():  # handlers can only be set from the main thread
+        return stop, lambda: None
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    return stop, lambda: signal.signal(signal.SIGTERM, previous)
+
+
+def output_key(vid, ref, ids, use_dst_name=False):
+    """key a video is written under (see encode_chunk)"""
+    return vid[:-4].split("/")[-1] if use_dst_name else str(ids[ref])
+
+
+def skip_done(vid_refs, ids, done_keys, use_dst_name=False, reader=None):
+    """
+    drops videos whose output key is in done_keys (f.e. keys in the manifest of an earlier run)
+
+    Input:
+        vid_refs: iterable of (video, ref)
+        reader: StreamingReader to release the ids and metadata of dropped videos from
+    """
+    for vid, ref in vid_refs:
+        if output_key(vid, ref, ids, use_dst_name) in done_keys:
+            if reader is not None:
+                reader.release([ref])
+            continue
+        yield vid, ref
+
+
+def stream_keys(reader, use_dst_name=False):
+    """output keys of the videos of a StreamingReader, releasing each one right away"""
+    for vid, ref in reader:
+        yield output_key(vid, ref, reader.ids, use_dst_name)
+        reader.release([ref])
+
+
+def find_done_keys(manifest, run_info, keys):
+    """
+    keys an earlier run encoded with the model and sampling of run_info,
+    only manifest rows with those and one of keys are read
+
+    Input:
+        manifest: manifest_dataset of the output folder
+        run_info: dict of run-level manifest columns (model, sampling) of this run
+        keys: iterable of candidate keys (f.e. the ones of this rank)
+    """
+    where = (ds.field("model") == run_info["model"]) & (ds.field("sampling") == run_info["sampling"])
+    where &= ds.field("key").isin(list(keys))
+    return set(manifest.to_table(columns=["key"], filter=where).column("key").to_pylist())
+
+
+def get_mappers(model_name, pretrained, device, get_text_tokenizer=False, frame_tokenization_strategy="none"):
+    """
+    loads one FrameMapper per model_name/pretrained pair (comma separated), see clip_video_encode
+
+    Output:
+        FrameMapper if there's one model, list of FrameMappers (heads) otherwise
+    """
+    model_names = model_name.split(",") if isinstance(model_name, str) else list(model_name)
+    pretrained = pretrained.split(",") if isinstance(pretrained, str) else list(pretrained)
+    assert len(model_names) == len(pretrained), "model_name and pretrained need the same number of entries"
+    if len(model_names) == 1:
+        return FrameMapper(
+            model_names[0],
+            pretrained[0],
+            device,
+            get_text_tokenizer=get_text_tokenizer,
+            get_frame_tokenizer=(frame_tokenization_strategy != "none"),
+        )
+
+    heads = []
+    for i, (name, weights) in enumerate(zip(model_names, pretrained)):
+        head_name = None
+        if model_names.count(name) > 1:  # same architecture with different weights
+            head_name = f"{name}_{weights}"
+        heads.append(
+            FrameMapper(
+                name,
+                weights,
+                device,
+                get_text_tokenizer=(get_text_tokenizer and i == 0),  # captions only use the first head
+                get_frame_tokenizer=name.endswith((".yaml", ".yml")),  # vqgan configs tokenize frames
+                name=head_name,
+            )
+        )
+    return heads
+
+
+def get_sampling_kwargs(
+    take_every_nth, target_fps, sampling_strategy, scene_threshold, scene_min_fps, frame_budget, decode_strategy
+):
+    """FrameReader arguments that decide which frames are decoded (see clip_video_encode)."""
+    assert sampling_strategy in ["uniform", "scene", "keyframes"]
+    assert decode_strategy in ["sequential", "seek", "auto"]
+    sampler = None
+    if sampling_strategy == "scene":
+        sampler = SceneSampler(scene_threshold, scene_min_fps, frame_budget)
+    return {
+        "take_every_nth": take_every_nth,
+        "target_fps": target_fps,
+        "sampler": sampler,
+        "keyframes": sampling_strategy == "keyframes",
+        "decode_strategy": decode_strategy,
+    }
+
+
 def clip_video_encode(
     src,
     dest="",
     output_format="files",
     take_every_nth=25,
     target_fps=-1,
+    sampling_strategy="uniform",
+    scene_threshold=0.1,
+    scene_min_fps=0.2,
+    frame_budget=-1,
+    decode_strategy="auto",
+    max_decode_time=-1,
+    max_frames=-1,
+    max_bytes=-1,
+    retry_passes=1,
     input_format="table",
     frame_workers=1,
     frame_memory_size=4,
@@ -40,18 +247,33 @@ def clip_video_encode(
     use_dst_name=False,
     distribute="none",
     oom_shard_count=5,
+    shard_maxcount=1000000,
+    shard_maxsize=-1,
+    write_index=False,
     model_name="ViT-B-32",
     pretrained="laion2b_s34b_b79k",
     captioning_strategy="none",
     frame_tokenization_strategy="none",
     generated_caption_key="generated_caption",  # this will put it in json, make this 'caption' if you want it in txt
     pass_through_keys="mp4,txt,json",
+    video_extensions="mp4",
     caption_similarity=False,
     img_size=224,
+    pooling_strategies="",
+    pooling_window=8,
 ):
     """
     Encode frames using CLIP image encoder
 
+    Every written sample is listed in {dest}/manifest/*.parquet with its location, frame count, model and sampling
+    arguments (see manifest.load_manifest). Running again with the same dest skips videos the manifest lists as
+    encoded with the same model and sampling (table input) or shards it lists (webdataset input).
+
+    On SIGTERM (f.e. preemption) no more videos are read and the videos read so far are encoded and written.
+    With webdataset input the current output shard is closed with a {shard}.partial.json marker of its keys,
+    running again with the same arguments continues marked shards in new {shard_id}_{part} shards.
+    With table input the manifest is enough to continue where the run stopped.
+
     Input:
       src:
         str: path to mp4 file
@@ -67,6 +289,34 @@ def clip_video_encode(
         int: only take every nth frame
       target_fps:
         int: target fps to downsample videos to (-1 means original fps or take_every_nth)
+      sampling_strategy:
+        str: which of the frames selected by take_every_nth/target_fps are encoded
+          - uniform: all of them
+          - scene: only frames where the picture changed (see frame_reader.SceneSampler),
+                   use a small take_every_nth so changes are found quickly
+          - keyframes: only the keyframes (I-frames) of each video, other frames aren't decoded at all
+                       (needs ffmpeg, take_every_nth and target_fps are ignored)
+      scene_threshold:
+        float: mean absolute difference (0-1) of downsampled frames that counts as a change (scene sampling)
+      scene_min_fps:
+        float: minimum rate of encoded frames in static scenes, -1 for none (scene sampling)
+      frame_budget:
+        int: max frames per video, frames with the largest changes are kept, -1 means no max (scene sampling)
+      decode_strategy:
+        str: how frames between the ones that are taken are skipped
+          - sequential: decode all of them
+          - seek: seek to the next frame that's taken (decoding restarts at the keyframe before it)
+          - auto: seek only when taken frames are further apart than the keyframe interval (probed with ffprobe)
+      max_decode_time:
+        float: seconds after which decoding a video is given up, -1 means a limit based on the video's length
+      max_frames:
+        int: videos with more frames (after sampling) are skipped, -1 means no max
+      max_bytes:
+        int: video files larger than this are skipped, -1 means no max. mp4 links stop downloading once they
+             exceed it, streamed links (f.e. youtube) are only limited if their server reports a size
+      retry_passes:
+        int: number of passes re-reading videos that failed (f.e. timed out) after all others were read
+        skipped videos are listed with the reason in {dest}/failures.csv (failures_rank{rank}.csv if distributed)
       frame_workers:
         int: number of Processes to distribute video reading to.
       frame_memory_size:
@@ -77,25 +327,52 @@ def clip_video_encode(
         bool: use the save name suggested by video2numpy
       distribute:
         str: distribution strategy, currently either slurm or none
+      oom_shard_count:
+        int: zero-padding of output shard ids
+      shard_maxcount:
+        int: maximum number of samples per output shard (webdataset output)
+      shard_maxsize:
+        int: maximum number of bytes per output shard (webdataset output), -1 means no limit
+      write_index:
+        bool: save a {shard}.index.json with member offsets next to each output shard (webdataset output)
       model_name:
         str:
           - open_clip model name, used for selecting CLIP architecture
           - vqgan config path
+          - comma separated list of the above to encode every video with several models (heads) in one pass,
+            frames are decoded once and heads with the same preprocessing share it. the first head's outputs are
+            saved as usual, the ones of other heads as {key}.{head}.npy (and {key}.{head}.{strategy}.npy when
+            pooled) where head is the model name without directories/extension (vqgan configs tokenize frames)
       pretrained:
         str:
           - open_clip pretrained weights name
           - vqgan weights checkpoint path
+          - comma separated list with one entry per model_name
       captioning_strategy:
         str: which frames of a video to generate captions for. Possible values are:
           - none: don't generate any captions
           - center: generate a caption for the middle frame
         int: (NOT IMPLEMENTED) step size for which frames to generate captions for
+      frame_tokenization_strategy:
+        str: "none" to save embeddings, anything else saves VQGAN codebook indices of each frame instead
+             (model_name/pretrained are the vqgan config/checkpoint), stored as the smallest unsigned dtype that fits
+             the codebook (uint16 for typical codebooks)
       pass_through_keys:
         str: comma separated list of extension to pass through from input dataset (if webdataset format)
+      video_extensions:
+        str: comma separated list of video extensions to look for in input shards (if webdataset format)
       caption_similarity:
         bool: whether to put the similarity between the average frame embedding and text embedding into metadata
       img_size:
         int: pixel height and width of target output shape
+      pooling_strategies:
+        str: comma separated list of pooled outputs to save alongside frame embeddings as {strategy}.npy:
+          - mean: mean frame embedding
+          - max: elementwise max over frame embeddings
+          - norm_mean: normalized mean of normalized frame embeddings
+          - window_mean: mean frame embedding over consecutive windows of pooling_window seconds
+      pooling_window:
+        float: seconds of video per window for window_mean
     """
     assert input_format in ["table", "webdataset"]
 
@@ -105,192 +382,376 @@ def clip_video_encode(
 
     if isinstance(pass_through_keys, str):
         pass_through_keys = pass_through_keys.split(",")
+    if isinstance(video_extensions, str):
+        video_extensions = video_extensions.split(",")
+    if isinstance(pooling_strategies, str):
+        pooling_strategies = [s for s in pooling_strategies.split(",") if s != ""]
+
+    if distribute == "slurm":
+        local_rank, global_rank, world_size = world_info_from_env()
+        device = f"cuda:{local_rank}" if torch.cuda.is_available() else "cpu"
+    else:
+        local_rank, global_rank, world_size = 0, 0, 1  # TODO: how do we do this?
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    model = ",".join(  # one model_name:pretrained per head
+        f"{m}:{p}"
+        for m, p in zip(
+            model_name.split(",") if isinstance(model_name, str) else model_name,
+            pretrained.split(",") if isinstance(pretrained, str) else pretrained,
+        )
+    )
+    sampling = {
+        "take_every_nth": take_every_nth,
+        "target_fps": target_fps,
+        "sampling_strategy": sampling_strategy,
+        "scene_threshold": scene_threshold,
+        "scene_min_fps": scene_min_fps,
+        "frame_budget": frame_budget,
+        "img_size": img_size,
+        "captioning_strategy": captioning_strategy,
+    }
+    run_info = {"model": model, "sampling": json.dumps(sampling)}
+    manifest = manifest_dataset(dest)  # samples of earlier runs to dest, None if there are none
 
     if input_format == "table":
-        reader = Reader(src, metadata_columns)
-        vids, ids, meta = reader.get_data()
-        meta_refs = list(range(len(vids)))
+        if is_table_src(src):  # stream only this rank's part of the table(s)
+            reader = StreamingReader(src, metadata_columns, rank=global_rank, world_size=world_size)
+            vids, meta_refs, ids, meta = reader, None, reader.ids, reader.meta
+        else:
+            reader = Reader(src, metadata_columns)
+            vids, ids, meta = reader.get_data()
+            if world_size > 1:
+                work_size = math.ceil(len(vids) / world_size)
+                print(f"Slurm worker {global_rank} processing {work_size} videos...")
+                ws, wf = global_rank * work_size, (global_rank + 1) * work_size
+                vids = vids[ws:wf]
+                ids = ids[ws:wf]
+                for mc in meta.keys():
+                    meta[mc] = meta[mc][ws:wf]
+            meta_refs = list(range(len(vids)))
+
+        # videos an earlier run already encoded with the same model and sampling are skipped
+        done = set()
+        if manifest is not None:
+            if isinstance(reader, StreamingReader):  # keys of this rank's part, without loading metadata
+                key_reader = StreamingReader(src, [], rank=global_rank, world_size=world_size)
+                keys = stream_keys(key_reader, use_dst_name)
+            else:
+                keys = (output_key(vid, ref, ids, use_dst_name) for vid, ref in zip(vids, meta_refs))
+            done = find_done_keys(manifest, run_info, keys)
+        if len(done) > 0:
+            print(f"Skipping videos of {len(done)} keys that are in the manifest already...")
+            if isinstance(reader, StreamingReader):
+                vids = skip_done(reader, ids, done, use_dst_name, reader)
+            else:
+                vid_refs = list(skip_done(zip(vids, meta_refs), ids, done, use_dst_name))
+                vids, meta_refs = [vid for vid, _ in vid_refs], [ref for _, ref in vid_refs]
 
     else:  # WebDataset, so we distribute shards
         shards = list(braceexpand.braceexpand(src))
 
-        # NOTE: this might need to be improved, some shards may not be complete
         fs, output_path = fsspec.core.url_to_fs(dest)
         if not fs.exists(output_path):
             fs.mkdir(output_path)
             done_shards = set()
-        else:
+        elif manifest is not None:  # shards are listed in the manifest once they're uploaded
+            done_shards = set()
+            for batch in manifest.to_batches(columns=["shard"]):
+                done_shards.update(pc.unique(batch.column("shard")).to_pylist())
+        else:  # output of a run without manifest
             done_shards = set(int(x.split("/")[-1].split("_")[0]) for x in fs.glob(output_path + "/*.tar"))
+        partials = load_partials(dest) if output_format == "webdataset" else {}
+        done_shards -= set(partials)  # shards of stopped runs are continued where they left off
 
         print(f"Removing {len(done_shards)} done_shards from processing queue...")
         s_ids = [s.split("/")[-1][: -len(".tar")] for s in shards]
         shards = [s for s_id, s in zip(s_ids, shards) if int(s_id) not in done_shards]
 
-    starting_shard_id = 0
-    shard_sample_count = 10000
-
-    if distribute == "slurm":
-        local_rank, global_rank, world_size = world_info_from_env()
-        if input_format == "table":
-            work_size = math.ceil(len(vids) / world_size)
-        else:
+        if world_size > 1:
             work_size = math.ceil(len(shards) / world_size)
-        print(f"Slurm worker {global_rank} processing {work_size} videos...")
-        ws, wf = global_rank * work_size, (global_rank + 1) * work_size
-        if input_format == "table":
-            vids = vids[ws:wf]
-            ids = ids[ws:wf]
-            for mc in meta.keys():
-                meta[mc] = meta[mc][ws:wf]
-
-            starting_shard_id += math.ceil(work_size / shard_sample_count) * global_rank
-        elif input_format == "webdataset":
-            shards = shards[ws:wf]
-        device = f"cuda:{local_rank}" if torch.cuda.is_available() else "cpu"
-    else:
-        local_rank, global_rank, world_size = 0, 0, 1  # TODO: how do we do this?
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+            print(f"Slurm worker {global_rank} processing {work_size} shards...")
+            shards = shards[global_rank * work_size : (global_rank + 1) * work_size]
+
+    starting_shard_id = 0
 
     assert output_format in ["files", "webdataset"]
     if output_format == "files":
-        writer = FileWriter(dest)
+        writer = FileWriter(dest, manifest=run_info)
     elif output_format == "webdataset":
-        # TODO: maybe include params for this?
-        starting_shard_id = int(shards[0].split("/")[-1].split(".tar")[0])
-        writer = WebDatasetWriter(dest, oom_shard_count, "npy", maxcount=1e6, shard_id=starting_shard_id)
+        shard_suffix = "clip_embeddings"
+        if input_format == "webdataset" and len(shards) > 0:
+            starting_shard_id = int(shards[0].split("/")[-1].split(".tar")[0])
+        elif world_size > 1:  # shard count per rank isn't known up front so tag names with rank
+            shard_suffix = f"rank{global_rank}_" + shard_suffix
+        if input_format == "table" and manifest is not None:  # continue after shards of earlier runs
+            for batch in manifest.to_batches(columns=["shard", "location"]):
+                mine = pc.ends_with(batch.column("location"), pattern=f"_{shard_suffix}.tar")
+                last = pc.max(pc.filter(batch.column("shard"), mine)).as_py()
+                starting_shard_id = max(starting_shard_id, last + 1) if last is not None else starting_shard_id
+        writer = WebDatasetWriter(
+            dest,
+            oom_shard_count,
+            "npy",
+            maxcount=shard_maxcount,
+            maxsize=shard_maxsize if shard_maxsize > 0 else None,
+            shard_id=starting_shard_id,
+            shard_suffix=shard_suffix,
+            write_index=write_index,
+            manifest=run_info,
+        )
 
-    fm = FrameMapper(
+    fm = get_mappers(
         model_name,
         pretrained,
         device,
         get_text_tokenizer=(caption_similarity or (captioning_strategy != "none")),
-        get_frame_tokenizer=(frame_tokenization_strategy != "none"),
+        frame_tokenization_strategy=frame_tokenization_strategy,
     )
 
-    if input_format == "table":
-        fr = FrameReader(
-            vids,
-            meta_refs,
-            take_every_nth=take_every_nth,
-            target_fps=target_fps,
-            resize_size=img_size,
-            workers=frame_workers,
-            memory_size=frame_memory_size,
-        )
-        fr.start_reading()
-
-        frames, ind_dict = [], {}
-        block_size = 0
-        i = 0
-        for vid_frames, info in fr:
-            i += 1
-            frames.append(vid_frames)
-            ind_dict[info["reference"]] = (
-                block_size,
-                block_size + vid_frames.shape[0],
-                info["dst_name"],
-            )
-            block_size += vid_frames.shape[0]
-
-            if i % CHUNK_SIZE == 0:
-                encode_chunk(frames, ind_dict, writer, fm, meta, ids, use_dst_name, device, input_format=input_format)
-                frames, ind_dict, block_size = [], {}, 0
-
-        if len(frames) > 0:  # TODO: make this cleaner
-            encode_chunk(frames, ind_dict, writer, fm, meta, ids, use_dst_name, device, input_format=input_format)
-    else:  # WebDataset shard logic
-        for shard in shards:
-            # try:
-            times = {}
-            t = time.time()
-            with tempfile.TemporaryDirectory(prefix=f"worker_{global_rank}_") as tempdir:
-                os.chmod(tempdir, 0o777)  # This lets subprocesses from v2np read files in the tempdir
-                folder = "/".join(shard.split("/")[0:-1])
-                fs, output_path = fsspec.core.url_to_fs(folder)
-
-                shard_id = shard.split("/")[-1]
-                tar_bytes = io.BytesIO(fs.open(f"{output_path}/{shard_id}").read())
-                with tarfile.open(fileobj=tar_bytes) as tar:
-                    tar.extractall(tempdir)
-                writer.create_shard(shard_id=int(shard_id.split(".tar")[0]))
-                times["download_and_extract"] = times.get("download_and_extract", 0) + time.time() - t
-                t = time.time()
-
-                vids, ids, meta = read_shard(tempdir, pass_through_keys=pass_through_keys)
-
-                meta_refs = list(range(len(vids)))
-                fr = FrameReader(
-                    vids,
-                    meta_refs,
-                    take_every_nth=take_every_nth,
-                    target_fps=target_fps,
-                    resize_size=img_size,
-                    workers=frame_workers,
-                    memory_size=frame_memory_size,
+    reader_kwargs = get_sampling_kwargs(
+        take_every_nth, target_fps, sampling_strategy, scene_threshold, scene_min_fps, frame_budget, decode_strategy
+    )
+    reader_kwargs.update(
+        resize_size=img_size,
+        workers=frame_workers,
+        memory_size=frame_memory_size,
+        max_decode_time=max_decode_time,
+        max_frames=max_frames,
+        max_bytes=max_bytes,
+    )
+    encode_kwargs = {
+        "input_format": input_format,
+        "captioning_strategy": captioning_strategy,
+        "frame_tokenization_strategy": frame_tokenization_strategy,
+        "generated_caption_key": generated_caption_key,
+        "pooling_strategies": pooling_strategies,
+        "pooling_window": pooling_window,
+    }
+
+    stop, restore_sigterm = stop_on_sigterm()
+    interrupted = False  # the stop cut the current shard short
+    try:
+        if input_format == "table":
+            failures = []
+            for frames, frame_times, ind_dict in read_chunks(
+                vids, meta_refs, reader_kwargs, captioning_strategy, retry_passes, failures, stop
+            ):
+                encode_chunk(
+                    frames,
+                    ind_dict,
+                    writer,
+                    fm,
+                    meta,
+                    ids,
+                    use_dst_name,
+                    device,
+                    timestamps=frame_times,
+                    **encode_kwargs,
                 )
-                fr.start_reading()
-
-                frames, ind_dict = [], {}
-                block_size = 0
-                i = 0
-                n_frames = 0
-                for vid_frames, info in fr:
-                    i += 1
-
-                    if captioning_strategy == "center":
-                        vid_frames = vid_frames[len(vid_frames) // 2 : len(vid_frames) // 2 + 1]
-
-                    n_frames += len(vid_frames)
-                    frames.append(vid_frames)
-                    ind_dict[info["reference"]] = (
-                        block_size,
-                        block_size + vid_frames.shape[0],
-                        info["dst_name"],
-                    )
-                    block_size += vid_frames.shape[0]
-                    times["read_frames"] = times.get("read_frames", 0) + time.time() - t
+                if isinstance(reader, StreamingReader):
+                    reader.release(ind_dict)
+            failure_rows = get_failure_rows(failures, ids)
+            if isinstance(reader, StreamingReader):
+                reader.release([f["reference"] for f in failures])
+        else:  # WebDataset shard logic
+            failure_rows = []
+            for shard in shards:
+                try:
+                    times = {}
                     t = time.time()
+                    with tempfile.TemporaryDirectory(prefix=f"worker_{global_rank}_") as tempdir:
+                        os.chmod(tempdir, 0o777)  # This lets subprocesses from v2np read files in the tempdir
+                        folder = "/".join(shard.split("/")[0:-1])
+                        fs, output_path = fsspec.core.url_to_fs(folder)
+
+                        shard_id = shard.split("/")[-1]
+                        tar_bytes = io.BytesIO(fs.open(f"{output_path}/{shard_id}").read())
+                        with tarfile.open(fileobj=tar_bytes) as tar:
+                            tar.extractall(tempdir)
+                        partial = partials.get(int(shard_id.split(".tar")[0]))
+                        writer.create_shard(shard_id=int(shard_id.split(".tar")[0]), partial=partial)
+                        times["download_and_extract"] = times.get("download_and_extract", 0) + time.time() - t
+                        t = time.time()
 
-                    if i % CHUNK_SIZE == 0:
-                        encode_chunk(
-                            frames,
-                            ind_dict,
-                            writer,  # TODO: turn all args below this into kwarg dict and just unpack
-                            fm,
-                            meta,
-                            ids,
-                            use_dst_name,
-                            device,
-                            input_format=input_format,
-                            captioning_strategy=captioning_strategy,
-                            frame_tokenization_strategy=frame_tokenization_strategy,
-                            generated_caption_key=generated_caption_key,
+                        vids, ids, meta = read_shard(
+                            tempdir, pass_through_keys=pass_through_keys, video_extensions=video_extensions
                         )
-                        times["encode"] = times.get("encode", 0) + time.time() - t
-                        t = time.time()
-                        frames, ind_dict, block_size = [], {}, 0
-                t = time.time()
-                if len(frames) > 0:  # TODO: make this cleaner
-                    encode_chunk(
-                        frames,
-                        ind_dict,
-                        writer,
-                        fm,
-                        meta,
-                        ids,
-                        use_dst_name,
-                        device,
-                        input_format=input_format,
-                        captioning_strategy=captioning_strategy,
-                        frame_tokenization_strategy=frame_tokenization_strategy,
-                        generated_caption_key=generated_caption_key,
-                    )
-                times["encode"] = times.get("encode", 0) + time.time() - t
-                t = time.time()
-            frame_adjusted = {k: n_frames / v for k, v in times.items()}
-            print(f"Frames/s: {frame_adjusted}")
-        # except Exception as e:  # pylint: disable=(broad-except)
-        #     print(f"Shard {shard} failed: {str(e)}")
+
+                        vid_refs = list(zip(vids, range(len(vids))))
+                        if partial is not None:  # skip videos written before the run was stopped
+                            vid_refs = list(skip_done(vid_refs, ids, set(partial["keys"]), use_dst_name))
+                            print(f"Continuing shard {shard} after {len(partial['keys'])} written videos...")
+                        failures = []
+                        n_frames = 0
+                        try:
+                            for frames, frame_times, ind_dict in read_chunks(
+                                [vid for vid, _ in vid_refs],
+                                [ref for _, ref in vid_refs],
+                                reader_kwargs,
+                                captioning_strategy,
+                                retry_passes,
+                                failures,
+                                stop,
+                            ):
+                                n_frames += sum(len(f) for f in frames)
+                                times["read_frames"] = times.get("read_frames", 0) + time.time() - t
+                                t = time.time()
+                                encode_chunk(
+                                    frames,
+                                    ind_dict,
+                                    writer,
+                                    fm,
+                                    meta,
+                                    ids,
+                                    use_dst_name,
+                                    device,
+                                    timestamps=frame_times,
+                                    **encode_kwargs,
+                                )
+                                times["encode"] = times.get("encode", 0) + time.time() - t
+                                t = time.time()
+                        finally:  # queued pass-through files are read lazily from tempdir, even if the shard failed
+                            interrupted = stop.is_set()
+                            writer.flush()
+                        times["write"] = times.get("write", 0) + time.time() - t
+                        failure_rows += get_failure_rows(failures, ids, shard)
+                    frame_adjusted = {k: n_frames / v for k, v in times.items()}
+                    print(f"Frames/s: {frame_adjusted}")
+                except Exception as e:  # pylint: disable=(broad-except)
+                    print(f"Shard {shard} failed: {str(e)}")
+                    failure_rows.append({"reason": "shard", "message": str(e), "shard": shard})
+                if stop.is_set():
+                    break
+
+        if len(failure_rows) > 0:
+            failures_name = "failures.csv" if world_size == 1 else f"failures_rank{global_rank}.csv"
+            print(f"Skipped {len(failure_rows)} videos, see {failures_name}")
+            write_failures(dest, failure_rows, failures_name)
+        if stop.is_set():
+            print("Stopped by SIGTERM, closing the current shard")
+        # a shard that finished before the stop is complete, table input resumes by manifest
+        writer.close(partial=input_format == "webdataset" and interrupted)
+    finally:
+        restore_sigterm()
+
+
+def encode_iter(
+    src,
+    take_every_nth=25,
+    target_fps=-1,
+    sampling_strategy="uniform",
+    scene_threshold=0.1,
+    scene_min_fps=0.2,
+    frame_budget=-1,
+    decode_strategy="auto",
+    max_decode_time=-1,
+    max_frames=-1,
+    max_bytes=-1,
+    retry_passes=1,
+    frame_workers=1,
+    frame_memory_size=4,
+    metadata_columns="",
+    use_dst_name=False,
+    model_name="ViT-B-32",
+    pretrained="laion2b_s34b_b79k",
+    mapper=None,
+    failures=None,
+    captioning_strategy="none",
+    frame_tokenization_strategy="none",
+    generated_caption_key="generated_caption",
+    caption_similarity=False,
+    img_size=224,
+    pooling_strategies="",
+    pooling_window=8,
+):
+    """
+    Encode frames using CLIP image encoder and yield the results instead of writing them to dest
+
+    Input:
+      src: same as clip_video_encode with input_format="table"
+      mapper:
+        FrameMapper: already loaded model to use instead of loading model_name/pretrained
+        list: already loaded heads, encoded in one pass like a comma separated model_name
+      failures:
+        list: skipped videos are appended to it as dicts with video, videoID, reason and message
+      all other arguments are the same as in clip_video_encode
+
+    Output:
+      iterator of (key, embeddings, metadata) for each video, yielded as soon as its chunk is encoded.
+      metadata holds what clip_video_encode would save next to the embeddings (f.e. "json", "timestamps.npy").
+      at most CHUNK_SIZE videos are held in memory besides the FrameReader's frame_memory_size.
+    """
+    if isinstance(metadata_columns, str):
+        metadata_columns = [metadata_columns] if metadata_columns != "" else []
+    metadata_columns = list(metadata_columns) if isinstance(metadata_columns, tuple) else metadata_columns
+    if isinstance(pooling_strategies, str):
+        pooling_strategies = [s for s in pooling_strategies.split(",") if s != ""]
+
+    if is_table_src(src):
+        reader = StreamingReader(src, metadata_columns)
+        vids, meta_refs, ids, meta = reader, None, reader.ids, reader.meta
+    else:
+        reader = Reader(src, metadata_columns)
+        vids, ids, meta = reader.get_data()
+        meta_refs = list(range(len(vids)))
+
+    if mapper is None:
+        mapper = get_mappers(
+            model_name,
+            pretrained,
+            "cuda" if torch.cuda.is_available() else "cpu",
+            get_text_tokenizer=(caption_similarity or (captioning_strategy != "none")),
+            frame_tokenization_strategy=frame_tokenization_strategy,
+        )
+
+    device = mapper[0].device if isinstance(mapper, (list, tuple)) else mapper.device
+    reader_kwargs = get_sampling_kwargs(
+        take_every_nth, target_fps, sampling_strategy, scene_threshold, scene_min_fps, frame_budget, decode_strategy
+    )
+    reader_kwargs.update(
+        resize_size=img_size,
+        workers=frame_workers,
+        memory_size=frame_memory_size,
+        max_decode_time=max_decode_time,
+        max_frames=max_frames,
+        max_bytes=max_bytes,
+    )
+    encode_kwargs = {
+        "captioning_strategy": captioning_strategy,
+        "frame_tokenization_strategy": frame_tokenization_strategy,
+        "generated_caption_key": generated_caption_key,
+        "pooling_strategies": pooling_strategies,
+        "pooling_window": pooling_window,
+    }
+
+    writer = MemoryWriter()
+    read_failures = []
+    chunks = read_chunks(vids, meta_refs, reader_kwargs, captioning_strategy, retry_passes, read_failures)
+    try:
+        for frames, frame_times, ind_dict in chunks:
+            encode_chunk(
+                frames,
+                ind_dict,
+                writer,
+                mapper,
+                meta,
+                ids,
+                use_dst_name,
+                device,
+                timestamps=frame_times,
+                **encode_kwargs,
+            )
+            if isinstance(reader, StreamingReader):
+                reader.release(ind_dict)
+            yield from writer.drain()
+    finally:
+        chunks.close()  # stops the FrameReader in case the caller stopped iterating early
+
+    if failures is not None:
+        failures.extend(get_failure_rows(read_failures, ids))
+    if isinstance(reader, StreamingReader):
+        reader.release([f["reference"] for f in read_failures])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+"""coalescer - batches many small concurrent mapper calls into large forward passes."""
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+
+class Job:
+    """frames of one call and the embeddings computed for them so far"""
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.future = Future()
+        self.offset = 0  # frames before offset have been put in a forward pass
+        self.pieces = []
+        self.t_submit = time.perf_counter()
+
+
+class BatchCoalescer:
+    """
+    Drop-in replacement for a FrameMapper that can be called from many threads at once.
+
+    Calls are queued and their frames are concatenated into forward passes of up to max_batch_size frames,
+    a forward pass that isn't full runs once max_wait seconds passed since it started collecting frames.
+    Larger max_batch_size/max_wait trade latency for throughput.
+    """
+
+    def __init__(self, mapper, max_batch_size=256, max_wait=0.005):
+        """
+        Input:
+            mapper: model used to map frames to embeddings (f.e. FrameMapper)
+            max_batch_size: max number of frames per forward pass
+            max_wait: max seconds to wait for more frames before running a forward pass that isn't full
+        """
+        self.mapper = mapper
+        self.device = mapper.device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.jobs = queue.Queue()
+        self.pending = collections.deque()
+        self.n_pending = 0
+
+        self.lock = threading.Lock()
+        self.queued_frames = 0
+        self.counts = {"requests": 0, "frames": 0, "batches": 0}
+        self.total_latency = 0.0
+
+        self.closed = False
+        self.worker = threading.Thread(target=self._loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, batch):
+        """
+        queues a batch of preprocessed frames
+
+        Input:
+            batch: (n_frames, ...) tensor like the ones passed to FrameMapper.__call__
+        Output:
+            concurrent.futures.Future resolving to the (n_frames, dim) embeddings of batch
+        """
+        if self.closed:
+            raise RuntimeError("BatchCoalescer is closed")
+        job = Job(batch)
+        with self.lock:
+            self.queued_frames += len(batch)
+        self.jobs.put(job)
+        return job.future
+
+    def __call__(self, batch):
+        return self.submit(batch).result()
+
+    def stats(self):
+        """
+        Output:
+            dict with queue_depth (frames waiting for a forward pass), totals of requests, frames and batches,
+            mean_batch_size (frames per forward pass) and mean_latency (seconds from submit to result)
+        """
+        with self.lock:
+            stats = dict(self.counts, queue_depth=self.queued_frames)
+            stats["mean_batch_size"] = stats["frames"] / max(stats["batches"], 1)
+            stats["mean_latency"] = self.total_latency / max(stats["requests"], 1)
+        return stats
+
+    def _add(self, job):
+        self.pending.append(job)
+        self.n_pending += len(job.batch)
+
+    def _fill(self):
+        """waits until max_batch_size frames are pending or max_wait passed, returns False once closed."""
+        if not self.pending:
+            job = self.jobs.get()
+            if job is None:
+                return False
+            self._add(job)
+        deadline = time.perf_counter() + self.max_wait
+        while self.n_pending < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                job = self.jobs.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job is None:
+                self.jobs.put(None)  # finish pending jobs first
+                break
+            self._add(job)
+        return True
+
+    def _step(self):
+        """runs one forward pass over pending frames and resolves futures of completed jobs."""
+        take, n = [], 0
+        while self.pending and n < self.max_batch_size:
+            job = self.pending[0]
+            k = min(self.max_batch_size - n, len(job.batch) - job.offset)
+            take.append((job, job.offset, job.offset + k))
+            job.offset += k
+            n += k
+            if job.offset == len(job.batch):
+                self.pending.popleft()
+        self.n_pending -= n
+
+        try:
+            if len(take) == 1 and take[0][1] == 0 and take[0][2] == len(take[0][0].batch):
+                batch = take[0][0].batch  # skip the copy if a single call fills the forward pass
+            else:
+                batch = torch.cat([job.batch[i0:it] for job, i0, it in take])
+            emb = self.mapper(batch) if n > 0 else None
+        except Exception as e:  # pylint: disable=broad-except
+            dropped = n
+            for job, _, _ in take:
+                if job in self.pending:  # fail the rest of the job too
+                    self.pending.remove(job)
+                    self.n_pending -= len(job.batch) - job.offset
+                    dropped += len(job.batch) - job.offset
+                job.future.set_exception(e)
+            with self.lock:
+                self.queued_frames -= dropped
+            return
+
+        t = time.perf_counter()
+        j, latency, n_done = 0, 0.0, 0
+        for job, i0, it in take:
+            if it > i0:
+                job.pieces.append(emb[j : j + it - i0])
+                j += it - i0
+            if it == len(job.batch):
+                job.future.set_result(np.concatenate(job.pieces) if job.pieces else np.zeros((0, 0), np.float32))
+                latency += t - job.t_submit
+                n_done += 1
+
+        with self.lock:
+            self.queued_frames -= n
+            self.counts["requests"] += n_done
+            self.counts["frames"] += n
+            self.counts["batches"] += int(n > 0)
+            self.total_latency += latency
+
+    def _loop(self):
+        while self._fill():
+            self._step()
+
+    def close(self):
+        """encodes all submitted frames and stops the worker thread."""
+        if not self.closed:
+            self.closed = True
+            self.jobs.put(None)
+            self.worker.join()
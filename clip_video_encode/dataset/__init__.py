@@ -1,3 +1,3 @@
 """clip-video-encode dataset."""
 
-from .dataset_reader import EmbeddingWebDatasetReader
+from .dataset_reader import EmbeddingWebDatasetReader, IndexedEmbeddingDataset, ShardList
@@ -1,101 +1,179 @@
-"""creates EmbeddingWebDataset from Processed Dataset format"""
+"""
+creates EmbeddingWebDataset shards from a directory of per-sample files (f.e. output of FileWriter)
+
+usage: python -m clip_video_encode.dataset.create_shards DATA_DIR DEST --workers=16
+"""
+import csv
+import io
 import os
-import os.path
 import random
-import argparse
-import json
-
-from csv import writer
-from pathlib import Path
-
-import numpy as np
-import webdataset as wds
-
-parser = argparse.ArgumentParser("""Generate Embedding WebDataset from Processed Dataset.""")
-parser.add_argument("--maxsize", type=float, default=1e9)
-parser.add_argument("--maxcount", type=float, default=10000)
-parser.add_argument(
-    "--compression",
-    dest="compression",
-    action="store_true",
-    help="Creates compressed .tar.gz files instead of uncompressed .tar files.",
-)
-parser.add_argument("--json", dest="json", action="store_true", help="Reads json files and add them to the .tar files.")
-parser.add_argument("--shards", default="./shards", help="directory where shards are written")
-parser.add_argument(
-    "--data",
-    default="./data",
-    help="directory path containing Processed Dataset",
-)
-args = parser.parse_args()
-
-assert args.maxsize > 10000000
-assert args.maxcount < 1000000
-
-os.makedirs(Path(args.shards), exist_ok=True)
-SPLITS = ["train", "val", "test"]
-
-tar_count = 0
-
-with open(os.path.join(args.shards, "splits.csv"), "a+", newline="", encoding="utf-8") as f:
-    csv_writer = writer(f)
-    csv_writer.writerow(["tar_file", "split"])
-
-# This is the output pattern under which we write shards.
-pattern = os.path.join(args.shards, "ds_%06d.tar" + (".gz" if args.compression else ""))
-with wds.ShardWriter(pattern, maxsize=int(args.maxsize), maxcount=int(args.maxcount)) as sink:
-    for split in SPLITS:
-        path = Path(os.path.join(args.data, split))
-        text_files_l = [*path.glob("*.txt")]
-        text_files = {text_file.stem: text_file for text_file in text_files_l}
-        text_total = len(text_files)
-
-        if args.json:
-            json_files_l = [*path.glob("*.json")]
-            json_files = {json_file.stem: json_file for json_file in json_files_l}
-            json_dicts = {}
-
-            for key in json_files:
-                try:
-                    with open(json_files[key], "r", encoding="utf-8") as f:
-                        json_dicts[key] = json.dumps(json.load(f))
-                except json.JSONDecodeError:
-                    print(f"Found {len(json_files.keys()) - len(json_dicts.keys())} corrupt json file(s).")
-            json_keys = json_files.keys()
-
-        npy_files_l = [*path.glob("*.npy")]
-        npy_files = {npy_file.stem: npy_file for npy_file in npy_files_l}
-        npy_total = len(npy_files)
-
-        print("Found {text_total} textfiles and {npy_total} numpy files.")
-        keys = list(npy_files.keys() & text_files.keys())
-
-        text_files = {k: v for k, v in text_files.items() if k in keys}
-        npy_files = {k: v for k, v in npy_files.items() if k in keys}
-
-        total_pairs = len(keys)
-        keys = list(keys)
-
-        split_tar_count = total_pairs // args.maxcount + (total_pairs % args.maxcount != 0)
-        tar_split = [("ds_{tar_count+i:06}", split) for i in range(split_tar_count)]
-        with open(os.path.join(args.shards, "splits.csv"), "a+", newline="", encoding="utf-8") as f:
-            csv_writer = writer(f)
-            for row in tar_split:
-                csv_writer.writerow(row)
-        tar_count += split_tar_count
-
-        indexes = list(range(total_pairs))
-        random.shuffle(indexes)
-
-        for i in indexes:
-            embeddings = np.load(npy_files[keys[i]])
-            with open(text_files[keys[i]], "rb", encoding="utf-8") as txtstream:
-                text = txtstream.read()
-
-            ds_key = keys[i]
-
-            sample = {"__key__": ds_key, "npy": embeddings, "txt": text}
-            if args.json and keys[i] in json_keys:
-                sample["json"] = json_dicts[keys[i]]
-            sink.write(sample)
-        sink.next_stream()
+from concurrent.futures import ProcessPoolExecutor
+
+import fire
+import fsspec
+
+from .extractors import EXTRACTORS
+from ..tar_index import split_name
+from ..writer import WebDatasetWriter
+
+
+def find_samples(fs, split_dir, extensions=None):
+    """
+    groups files of split_dir (recursively) into samples by key (file name up to the first dot)
+
+    Input:
+        fs: fsspec filesystem of split_dir
+        split_dir: directory containing {key}.npy, {key}.txt, {key}.json, ... files
+        extensions: extensions to include besides npy (None means all)
+    Output:
+        list of (key, {ext: path}) sorted by key, samples without an .npy are skipped
+    """
+    samples = {}
+    for path in fs.find(split_dir):
+        key, ext = split_name(os.path.relpath(path, split_dir))
+        if ext == "npy" or extensions is None or ext in extensions:
+            samples.setdefault(key, {})[ext] = path
+    return [(key, files) for key, files in sorted(samples.items()) if "npy" in files]
+
+
+def write_shards(dest, shards, maxsize, oom_shard_count, shard_suffix, write_index, extractor=None):
+    """
+    writes a range of shards, runs in its own process
+
+    Input:
+        shards: list of (shard_id, split, samples) where samples is a list of (key, {ext: path})
+        extractor: function mapping key to (key, metadata) or None to skip the sample (see extractors)
+    Output:
+        manifest rows (tar_file, split, n_samples) of the written shards
+    """
+    fs, _ = fsspec.core.url_to_fs(dest)
+    writer = WebDatasetWriter(
+        dest,
+        oom_shard_count,
+        "npy",
+        maxcount=max(len(samples) for _, _, samples in shards),
+        shard_id=shards[0][0],
+        maxsize=maxsize,
+        shard_suffix=shard_suffix,
+        write_index=write_index,
+    )
+    for shard_id, _, samples in shards:
+        writer.create_shard(shard_id)
+        for key, files in samples:
+            metadata = {}
+            if extractor is not None:
+                extracted = extractor(key)
+                if extracted is None:
+                    continue
+                key, metadata = extracted
+            # members are copied as stored, nothing is decoded
+            payloads = {ext: fs.cat_file(path) for ext, path in files.items()}
+            payloads.update(metadata)
+            writer.write(payloads.pop("npy"), key, payloads)
+    writer.close()
+
+    splits = {shard_id: split for shard_id, split, _ in shards}
+    rows = []
+    for shard_name, count in writer.written:  # shards that hit maxsize are continued in {shard_id}_{part} shards
+        rows.append((shard_name + ".tar", splits[int(shard_name.split("_")[0])], count))
+    return rows
+
+
+def write_manifest(dest, rows):
+    """writes splits.csv to dest atomically (to a temporary name first) so it never lists missing shards."""
+    fs, dest_path = fsspec.core.url_to_fs(dest)
+    buf = io.StringIO()
+    csv_writer = csv.writer(buf)
+    csv_writer.writerow(["tar_file", "split", "n_samples"])
+    csv_writer.writerows(rows)
+    path = os.path.join(dest_path, "splits.csv")
+    with fs.open(path + ".tmp", "w") as f:
+        f.write(buf.getvalue())
+    fs.mv(path + ".tmp", path)
+
+
+def create_shards(
+    data_dir,
+    dest,
+    splits="train,val,test",
+    maxcount=10000,
+    maxsize=1e9,
+    workers=1,
+    shuffle=True,
+    seed=0,
+    extensions="",
+    oom_shard_count=5,
+    shard_suffix="clip_embeddings",
+    write_index=False,
+    extractor=None,
+):
+    """
+    Generate Embedding WebDataset from a directory of samples.
+
+    Each worker process gets its own contiguous range of shard ids and streams its samples file by file
+    into them, so memory stays at O(shard) and building scales with the number of workers.
+    A splits.csv manifest (tar_file, split, n_samples) is written to dest once all shards are complete.
+
+    Input:
+        data_dir: fsspec path of the samples, {key}.npy plus optional {key}.txt, {key}.json, ... files
+        dest: fsspec path shards are written to
+        splits: comma separated subdirectories of data_dir holding the splits (missing ones are skipped)
+            "": data_dir itself holds the samples (f.e. clip-video-encode --output_format="files" output),
+                recorded as split "all"
+        maxcount: number of samples per shard (less if the extractor skips samples)
+        maxsize: max number of bytes per shard, larger shards are continued in {shard_id}_{part} shards
+        workers: number of processes writing shards
+        shuffle: shuffle samples within each split
+        seed: seed of the shuffle
+        extensions: comma separated extensions to include besides npy ("" means all found)
+        oom_shard_count: zero-padding of shard ids in shard names
+        shard_suffix: appended to every shard name
+        write_index: save a sidecar index next to each shard (see tar_index)
+        extractor: name of a dataset extractor (see extractors, f.e. "kinetics700") or function that derives
+            the key and metadata of samples from raw dataset layouts while they are written
+    Output:
+        manifest rows (tar_file, split, n_samples)
+    """
+    if isinstance(splits, str):
+        splits = [s for s in splits.split(",") if s]
+    if isinstance(extensions, str):
+        extensions = [e for e in extensions.split(",") if e] or None
+    if isinstance(extractor, str):
+        extractor = EXTRACTORS[extractor]
+    fs, data_path = fsspec.core.url_to_fs(data_dir)
+
+    shards = []  # (shard_id, split, samples), shard ids continue across splits
+    for split in splits or ["all"]:
+        split_dir = os.path.join(data_path, split) if splits else data_path
+        if not fs.isdir(split_dir):
+            print(f"Warning: split {split} not found in {data_dir}")
+            continue
+        samples = find_samples(fs, split_dir, extensions)
+        print(f"Found {len(samples)} samples in split {split}")
+        if shuffle:
+            random.Random(seed).shuffle(samples)
+        for i in range(0, len(samples), maxcount):
+            shards.append((len(shards), split, samples[i : i + maxcount]))
+
+    if not shards:
+        print("Warning: no samples found")
+        return []
+
+    workers = min(workers, len(shards))
+    bounds = [len(shards) * w // workers for w in range(workers + 1)]
+    ranges = [shards[i0:it] for i0, it in zip(bounds[:-1], bounds[1:])]
+    write_args = (maxsize, oom_shard_count, shard_suffix, write_index, extractor)
+    if workers == 1:
+        rows = write_shards(dest, ranges[0], *write_args)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(write_shards, dest, shard_range, *write_args) for shard_range in ranges]
+            rows = [row for future in futures for row in future.result()]
+
+    write_manifest(dest, rows)
+    print(f"Wrote {len(rows)} shards to {dest}")
+    return rows
+
+
+if __name__ == "__main__":
+    fire.Fire(create_shards)
@@ -4,15 +4,81 @@ utils for processing datasets of format described in https://github.com/iejMac/c
 used https://github.com/rom1504/laion-prepro/blob/main/laion5B/usage_guide/dataloader_pytorch.py as template
 """
 
-import io
+import ast
+import collections
+import functools
+import itertools
 import json
+import mmap
+import os
+import random
+import warnings
 
+import braceexpand
+import fsspec
 import numpy as np
 import open_clip
 import torch
 import webdataset as wds
 
-from torch.utils.data import DataLoader
+from fsspec.implementations.local import LocalFileSystem
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
+from torch.utils.data.dataloader import default_collate
+
+from ..distributed import world_info_from_env
+from ..tar_index import load_index
+
+
+MAX_READ_GAP = 4096  # bytes between members that are read at once instead of seeking (headers, padding)
+
+
+def decode_npy(data):
+    """decodes .npy bytes into an array that points into data (read-only) instead of copying it."""
+    header_size = 2 if data[6] == 1 else 4  # format version 1.0 has a 2 byte header length, 2.0+ 4 bytes
+    start = 8 + header_size
+    header_len = int.from_bytes(data[8:start], "little")
+    header = ast.literal_eval(bytes(data[start : start + header_len]).decode("latin1"))
+    dtype, shape = np.lib.format.descr_to_dtype(header["descr"]), header["shape"]
+    arr = np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=start + header_len)
+    return arr.reshape(shape, order="F" if header["fortran_order"] else "C")
+
+
+class LazyJson:
+    """
+    json metadata that is only parsed once it's accessed, behaves like the decoded dict
+
+    (not a Mapping subclass so DataLoader collation/pinning passes it through without decoding it)
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._decoded = None
+
+    @property
+    def decoded(self):
+        if self._decoded is None:
+            self._decoded = json.loads(self.data)
+        return self._decoded
+
+    def __getattr__(self, name):  # keys, items, get, ...
+        if name.startswith("_") or not hasattr(dict, name):  # f.e. pin_memory checks don't decode
+            raise AttributeError(name)
+        return getattr(self.decoded, name)
+
+    def __getitem__(self, key):
+        return self.decoded[key]
+
+    def __contains__(self, key):
+        return key in self.decoded
+
+    def __iter__(self):
+        return iter(self.decoded)
+
+    def __len__(self):
+        return len(self.decoded)
+
+    def __repr__(self):
+        return repr(self.decoded)
 
 
 def standardize_embedding_shape(emb, seq_len):
@@ -20,12 +86,193 @@ def standardize_embedding_shape(emb, seq_len):
         print(f"Warning: Raw embedding is longer than standard sequence length ({len(emb)} > {seq_len})")
         emb = emb[:seq_len]
 
-    pad = np.zeros((seq_len - len(emb), emb.shape[1]), dtype=emb.dtype)
-    zero_mask = np.concatenate([np.ones(len(emb)), np.zeros(len(pad))])
-    padded_emb = np.concatenate([emb, pad])
+    padded_emb = np.zeros((seq_len, emb.shape[1]), dtype=emb.dtype)
+    padded_emb[: len(emb)] = emb
+    zero_mask = (np.arange(seq_len) < len(emb)).astype(np.float64)
     return padded_emb, zero_mask
 
 
+def pad_batch(embs):
+    """
+    pads embedding sequences (numpy arrays or tensors) to the longest one among them
+
+    Output:
+        padded: (batch_size, max_len, embed_dim) embeddings
+        zero_mask: (batch_size, max_len) 1 for frames, 0 for padding
+    """
+    lengths = np.array([len(emb) for emb in embs])
+    mask = np.arange(lengths.max()) < lengths[:, None]
+    shape = mask.shape + tuple(embs[0].shape[1:])
+    if isinstance(embs[0], torch.Tensor):
+        padded = embs[0].new_zeros(shape)
+        padded[torch.from_numpy(mask)] = torch.cat(list(embs))
+        return padded, torch.from_numpy(mask.astype(np.float64))
+    padded = np.zeros(shape, dtype=embs[0].dtype)
+    padded[mask] = np.concatenate(embs)
+    return padded, mask.astype(np.float64)
+
+
+class Collator:
+    """
+    Collates preprocessed samples into batches.
+
+    Captions of a batch are tokenized with a single tokenizer call and tokens of recently seen captions
+    are cached. Metadata stays a list of (lazily decoded) dicts.
+    """
+
+    def __init__(self, tokenize=True, pad=False, cache_size=10000):
+        """
+        Input:
+            tokenize: add "text_tokens" for the "text" of each sample
+            pad: pad embeddings to the longest sequence in the batch (and add "zero_mask") instead of stacking
+            cache_size: number of caption tokenizations to keep
+        """
+        self.tokenize = tokenize
+        self.pad = pad
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+    def tokenize_texts(self, texts):
+        """tokenizes all captions that aren't cached in one call."""
+        missing = list(dict.fromkeys(t for t in texts if t not in self.cache))
+        if missing:
+            for text, tokens in zip(missing, open_clip.tokenize(missing)):
+                self.cache[text] = tokens
+        for text in texts:
+            self.cache.move_to_end(text)
+        tokens = torch.stack([self.cache[t] for t in texts])
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return tokens
+
+    def __call__(self, samples):
+        batch = {}
+        if self.pad:
+            batch["embeddings"], batch["zero_mask"] = pad_batch([s["embeddings"] for s in samples])
+        for k in samples[0]:
+            if k not in batch:
+                vals = [s[k] for s in samples]
+                batch[k] = vals if k == "meta" else default_collate(vals)
+        if self.tokenize and "text" in batch:
+            batch["text_tokens"] = self.tokenize_texts(batch["text"])
+        return batch
+
+
+def bucket_by_length(samples, batch_size, window=1000, collate=None):
+    """
+    batches samples of similar frame count together so batches need little padding
+
+    reads window samples at a time, sorts them by frame count and splits them into batches of batch_size
+    which are yielded in random order (collated with collate, by default Collator(pad=True)). leftover
+    samples that don't fill a batch are carried over to the next window.
+    """
+    collate = Collator(pad=True) if collate is None else collate
+    buffer = []
+    for sample in samples:
+        buffer.append(sample)
+        if len(buffer) < window:
+            continue
+        buffer.sort(key=lambda s: len(s["embeddings"]))
+        n_full = len(buffer) - len(buffer) % batch_size
+        batches = [buffer[i : i + batch_size] for i in range(0, n_full, batch_size)]
+        random.shuffle(batches)
+        for batch in batches:
+            yield collate(batch)
+        buffer = buffer[n_full:]
+
+    buffer.sort(key=lambda s: len(s["embeddings"]))
+    for i in range(0, len(buffer), batch_size):
+        yield collate(buffer[i : i + batch_size])
+
+
+class ShardList(IterableDataset, wds.Composable):  # pylint: disable=abstract-method
+    """
+    Shard source for WebDataset that gives every rank and DataLoader worker its own disjoint share of shards.
+
+    Shards are (optionally) shuffled with a seed shared by all ranks and workers before they're split,
+    so each shard is read by exactly one worker per pass and the assignment changes between epochs.
+    """
+
+    def __init__(self, urls, shuffle=False, resampled=False, seed=0, rank=None, world_size=None):
+        """
+        Input:
+            urls: shard path(s), braceexpand notation or list
+            shuffle: shuffle the order of shards (differently every epoch)
+            resampled: endlessly make new passes over the shards (reshuffled and resplit each pass)
+                instead of stopping after one pass, use with .with_epoch() to set the epoch length
+            seed: seed of the shard shuffle, has to be the same on all ranks
+            rank, world_size: position of this process among distributed ranks,
+                by default from torch.distributed (if initialized) or the environment (see world_info_from_env)
+        """
+        super().__init__()
+        self.urls = list(braceexpand.braceexpand(urls)) if isinstance(urls, str) else list(urls)
+        self.shuffle = shuffle or resampled
+        self.resampled = resampled
+        self.seed = seed
+        self.epoch = 0
+        if rank is None:  # resolved here since torch.distributed is only set up in the main process
+            if torch.distributed.is_available() and torch.distributed.is_initialized():
+                rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+            else:
+                _, rank, world_size = world_info_from_env()
+        self.rank, self.world_size = rank, world_size or 1
+
+    def set_epoch(self, epoch):
+        """sets the epoch the shard shuffle is seeded with (call before iterating the DataLoader)."""
+        self.epoch = epoch
+
+    def split(self, n_pass=0):
+        """
+        Output:
+            shards of this rank and worker for pass n_pass of the current epoch
+        """
+        urls = list(self.urls)
+        if self.shuffle:
+            random.Random(f"{self.seed}/{self.epoch}/{n_pass}").shuffle(urls)
+        worker_info = get_worker_info()
+        worker, n_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        return urls[self.rank :: self.world_size][worker::n_workers]
+
+    def __iter__(self):
+        for n_pass in itertools.count() if self.resampled else range(1):
+            urls = self.split(n_pass)
+            if not urls:
+                print(f"Warning: no shards for this worker ({len(self.urls)} shards, rank {self.rank})")
+                return
+            for url in urls:
+                yield {"url": url}
+
+
+def preprocess_sample(
+    item,
+    embedding_transform=lambda emb: emb,
+    standard_seq_len=-1,
+    to_tensor=True,
+    enable_text=True,
+    enable_meta=True,
+):
+    """decodes raw tar members of a sample (see create_embeddingwebdataset for arguments)."""
+    output = {}
+
+    emb = decode_npy(item["npy"])
+
+    if standard_seq_len != -1:
+        emb, zero_mask = standardize_embedding_shape(emb, standard_seq_len)
+        output["zero_mask"] = zero_mask
+    if to_tensor:
+        with warnings.catch_warnings():  # tensor shares the read-only tar payload, it's copied when batched
+            warnings.simplefilter("ignore", UserWarning)
+            emb = torch.from_numpy(emb)
+
+    output["embeddings"] = embedding_transform(emb)
+
+    if enable_text:
+        output["text"] = bytes(item["txt"]).decode("utf-8")
+    if enable_meta:
+        output["meta"] = LazyJson(bytes(item["json"]))
+    return output
+
+
 def create_embeddingwebdataset(
     urls,
     embedding_transform=lambda emb: emb,
@@ -33,55 +280,63 @@ def create_embeddingwebdataset(
     to_tensor=True,
     enable_text=True,
     enable_meta=True,
+    batch_size=-1,
+    bucket_window=-1,
+    shuffle_shards=False,
+    shuffle_buffer=-1,
+    resampled=False,
+    epoch_length=-1,
+    seed=0,
 ):
     """
     Create a WebDataset reader for Frame Embedding Dataset
 
+    Shards are split across distributed ranks and DataLoader workers (see ShardList) so no sample is read twice.
+
     Input:
+        urls: shard path(s), braceexpand notation, list or ShardList
         standard_seq_len: sequence length to pad all embedding sequences to (for batching)
             !(-1) : pad to standard_seq_len
-            -1: don't pad (dataset can't be used in DataLoader with batch_size > 1)
-        enable_text: include text captions
-        enable_meta: include metadata
+            -1: don't pad (dataset can't be used in DataLoader with batch_size > 1 unless bucket_window != -1)
+        enable_text: include text captions (tokenized when batched, see Collator)
+        enable_meta: include metadata (parsed on first access)
+        batch_size: number of samples per batch when bucketing
+        bucket_window: number of samples to bucket by frame count at a time
+            !(-1): dataset yields batches of batch_size samples of similar frame count,
+                   each padded to its own longest sequence (use with DataLoader(batch_size=None))
+            -1: dataset yields single samples
+        shuffle_shards: shuffle the shard order every epoch
+        shuffle_buffer: !(-1) shuffle samples within a buffer of shuffle_buffer samples (per worker)
+        resampled: endless stream of passes over the shards, each reshuffled and split between workers anew
+        epoch_length: !(-1) number of samples (or batches when bucketing) each copy of the dataset
+            (i.e. each DataLoader worker) yields per epoch, required to iterate a resampled dataset in epochs
+        seed: seed of the shard shuffle, has to be the same on all ranks
     """
+    assert bucket_window == -1 or (batch_size != -1 and standard_seq_len == -1)
 
-    dataset = wds.WebDataset(urls)
-    # TODO: different tokeinzers??
-    def tokenizer(text):
-        return open_clip.tokenize([text])[0]
-
-    def preprocess_dataset(item):
-        output = {}
-
-        npy_data = item["npy"]
-        stream = io.BytesIO(npy_data)
-        emb = np.lib.format.read_array(stream)
+    shards = urls if isinstance(urls, ShardList) else ShardList(urls, shuffle_shards, resampled, seed)
+    dataset = wds.WebDataset(shards)
+    if shuffle_buffer != -1:  # shuffle raw samples so nothing is decoded before it's needed
+        dataset = dataset.shuffle(shuffle_buffer)
 
-        if standard_seq_len != -1:
-            emb, zero_mask = standardize_embedding_shape(emb, standard_seq_len)
-            output["zero_mask"] = zero_mask
-        if to_tensor:
-            emb = torch.from_numpy(emb)
-
-        output["embeddings"] = embedding_transform(emb)
-
-        if enable_text:
-            text_data = item["txt"]
-            text = text_data.decode("utf-8")
-            output["text"] = text
-            output["text_tokens"] = tokenizer(text)
-        if enable_meta:
-            meta_data = item["json"]
-            meta = json.loads(meta_data)
-            # meta = meta_data.decode("utf-8")
-            output["meta"] = meta
-        return output
-
-    transformed_dataset = dataset.map(preprocess_dataset, handler=wds.handlers.warn_and_continue)
+    preprocess = functools.partial(
+        preprocess_sample,
+        embedding_transform=embedding_transform,
+        standard_seq_len=standard_seq_len,
+        to_tensor=to_tensor,
+        enable_text=enable_text,
+        enable_meta=enable_meta,
+    )
+    transformed_dataset = dataset.map(preprocess, handler=wds.handlers.warn_and_continue)
+    if bucket_window != -1:
+        collate = Collator(tokenize=enable_text, pad=True)
+        transformed_dataset = transformed_dataset.then(bucket_by_length, batch_size, bucket_window, collate)
+    if epoch_length != -1:
+        transformed_dataset = transformed_dataset.with_epoch(epoch_length)
     return transformed_dataset
 
 
-def dataset_to_dataloader(dataset, batch_size, num_prepro_workers):
+def dataset_to_dataloader(dataset, batch_size, num_prepro_workers, collate_fn=None):
     """converts WebDataset to PyTorch DataLoader."""
 
     dl = DataLoader(
@@ -91,6 +346,7 @@ def dataset_to_dataloader(dataset, batch_size, num_prepro_workers):
         num_workers=num_prepro_workers,
         pin_memory=True,
         prefetch_factor=2,
+        collate_fn=collate_fn,
     )
 
     return dl
@@ -109,18 +365,150 @@ class EmbeddingWebDatasetReader:
         enable_text=True,
         enable_meta=False,
         embedding_transform=lambda emb: emb,
+        bucket_window=-1,
+        shuffle_shards=False,
+        shuffle_buffer=-1,
+        resampled=False,
+        epoch_length=-1,
+        seed=0,
     ):
+        """
+        Input:
+            bucket_window: !(-1) batch samples of similar frame count from windows of bucket_window samples
+                and pad each batch only to its longest sequence (standard_seq_len has to be -1)
+            epoch_length: !(-1) number of batches per epoch (split between the DataLoader workers)
+            see create_embeddingwebdataset for the rest
+        """
         self.batch_size = batch_size
+        self.epoch = 0
+        self.shards = ShardList(urls, shuffle_shards, resampled, seed)
+        if epoch_length != -1:  # every worker yields its part of the epoch
+            n_workers = max(num_prepro_workers, 1)
+            epoch_length = -(-epoch_length // n_workers) * (batch_size if bucket_window == -1 else 1)
         dataset = create_embeddingwebdataset(
-            urls,
+            self.shards,
             embedding_transform,
             standard_seq_len,
             to_tensor,
             enable_text,
             enable_meta,
+            batch_size,
+            bucket_window,
+            shuffle_buffer=shuffle_buffer,
+            epoch_length=epoch_length,
         )
-        self.dataloader = dataset_to_dataloader(dataset, batch_size, num_prepro_workers)
+        if bucket_window == -1:
+            collate = Collator(tokenize=enable_text)
+            self.dataloader = dataset_to_dataloader(dataset, batch_size, num_prepro_workers, collate)
+        else:  # bucketed datasets yield whole batches
+            self.dataloader = dataset_to_dataloader(dataset, None, num_prepro_workers)
 
     def __iter__(self):
+        self.shards.set_epoch(self.epoch)  # workers get a copy of the shard list when iteration starts
+        self.epoch += 1
         for batch in self.dataloader:
             yield batch
+
+
+class IndexedEmbeddingDataset(Dataset):
+    """
+    Map-style dataset over Embedding WebDataset shards.
+
+    Uses the shards' sidecar tar indexes (see tar_index, built on first use if missing) so any sample
+    is served without scanning: local shards are memory mapped, remote ones are read with one seek per
+    run of adjacent requested members.
+    """
+
+    def __init__(
+        self,
+        urls,
+        embedding_transform=lambda emb: emb,
+        standard_seq_len=-1,
+        to_tensor=True,
+        enable_text=True,
+        enable_meta=True,
+    ):
+        """
+        Input:
+            urls: shard path(s), braceexpand notation or list
+            see create_embeddingwebdataset for the rest
+        """
+        self.shards = list(braceexpand.braceexpand(urls)) if isinstance(urls, str) else list(urls)
+        self.preprocess = functools.partial(
+            preprocess_sample,
+            embedding_transform=embedding_transform,
+            standard_seq_len=standard_seq_len,
+            to_tensor=to_tensor,
+            enable_text=enable_text,
+            enable_meta=enable_meta,
+        )
+        self.exts = ["npy"] + (["txt"] if enable_text else []) + (["json"] if enable_meta else [])
+
+        self.indexes = [load_index(shard) for shard in self.shards]
+        self.samples = [(i, key) for i, index in enumerate(self.indexes) for key in index]
+        self.key_to_ind = {}
+        for ind, (_, key) in enumerate(self.samples):
+            self.key_to_ind.setdefault(key, ind)
+
+        self.files = {}
+        self.pid = os.getpid()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["files"] = {}  # open shards can't be pickled, they're reopened on first read
+        return state
+
+    def _open(self, shard_ind):
+        """opens shards lazily in each process (DataLoader workers shouldn't share file handles)."""
+        if self.pid != os.getpid():
+            self.files, self.pid = {}, os.getpid()
+        if shard_ind not in self.files:
+            fs, path = fsspec.core.url_to_fs(self.shards[shard_ind])
+            if isinstance(fs, LocalFileSystem):
+                with open(path, "rb") as f:
+                    self.files[shard_ind] = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                self.files[shard_ind] = fs.open(path, "rb")
+        return self.files[shard_ind]
+
+    def read(self, ind):
+        """
+        returns the raw members of sample ind, only requested members are read
+
+        members separated by no more than a few tar headers are read together, so other members stored
+        in between (f.e. pass-through videos or pooled embeddings) are never downloaded
+        """
+        shard_ind, key = self.samples[ind]
+        members = sorted((offset, size, ext) for ext, (offset, size) in self.indexes[shard_ind][key].items())
+        members = [m for m in members if m[2] in self.exts]
+
+        f = self._open(shard_ind)
+        item = {"__key__": key}
+        if isinstance(f, memoryview):
+            for offset, size, ext in members:
+                item[ext] = f[offset : offset + size]
+            return item
+
+        ranges = []  # [start, end, members]
+        for offset, size, ext in members:
+            if ranges and offset - ranges[-1][1] <= MAX_READ_GAP:
+                ranges[-1][1] = max(ranges[-1][1], offset + size)
+                ranges[-1][2].append((offset, size, ext))
+            else:
+                ranges.append([offset, offset + size, [(offset, size, ext)]])
+        for start, end, range_members in ranges:
+            f.seek(start)
+            span = memoryview(f.read(end - start))
+            for offset, size, ext in range_members:
+                item[ext] = span[offset - start : offset - start + size]
+        return item
+
+    def __getitem__(self, ind):
+        return self.preprocess(self.read(ind))
+
+    def get(self, key):
+        """returns the sample with key (first one if multiple shards contain key)."""
+        return self[self.key_to_ind[key]]
@@ -0,0 +1,30 @@
+"""
+per-dataset extractors that turn raw dataset layouts into EmbeddingWebDataset samples (see create_shards)
+
+an extractor gets the key of a sample (path of its .npy relative to the split directory, without extensions)
+and returns (key, metadata) of the sample in the shards or None to skip it. metadata is added to the members
+found next to the .npy (f.e. {"txt": caption, "json": {...}}).
+"""
+
+
+def kinetics700(key):
+    """
+    {label}/{videoID}_{start}_{end}.npy, see https://github.com/cvdfoundation/kinetics-dataset
+
+    Output:
+        key: {videoID}_{start}_{end}
+        metadata: label as caption, videoID and clip start/end times as json
+    """
+    label, name = key.split("/")[-2:]
+    video_id, start_t, end_t = name[:11], name[12:18], name[19:]  # youtube IDs can contain "_"
+    meta = {
+        "videoID": video_id,
+        "start_time": start_t,
+        "end_time": end_t,
+    }
+    return name, {"txt": label, "json": meta}
+
+
+EXTRACTORS = {
+    "kinetics700": kinetics700,
+}
@@ -0,0 +1,619 @@
+"""frame_reader - decodes videos into frame blocks on worker processes.
+
+adapted from video2numpy.frame_reader so workers can return per-frame information (f.e. timestamps)
+"""
+import multiprocessing
+import os
+import queue
+import random
+import re
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+import requests
+
+from video2numpy.resizer import Resizer
+from video2numpy.shared_queue import SharedQueue
+from video2numpy.utils import handle_url
+
+
+DEFAULT_GOP = 250  # assumed keyframe interval if it can't be probed (x264 default)
+DOWNLOAD_CHUNK = 1024**2
+
+
+class SceneSampler:
+    """
+    Adaptive frame sampling: keeps frames where the picture changed plus a minimum rate.
+
+    Every frame that would be taken by take_every_nth/target_fps is compared to the last kept frame
+    (mean absolute difference of small grayscale thumbnails, 0-1) and only kept if the difference exceeds
+    threshold or 1/min_fps seconds passed since the last kept frame. Static scenes get few frames
+    while cuts and motion are still covered.
+    """
+
+    def __init__(self, threshold=0.1, min_fps=0.2, frame_budget=-1, thumb_size=32):
+        """
+        Input:
+            threshold: frame difference (0-1) at which a frame counts as a change
+            min_fps: minimum rate of kept frames (-1 means only keep changes)
+            frame_budget: max frames per video, the frames with the largest changes are kept (-1 means no max)
+            thumb_size: side of the thumbnails frames are compared on
+        """
+        self.threshold = threshold
+        self.max_gap = 1.0 / min_fps if min_fps > 0 else float("inf")
+        self.frame_budget = frame_budget
+        self.thumb_size = thumb_size
+        self.last = None
+        self.last_t = 0.0
+
+    def reset(self):
+        self.last = None
+
+    def score(self, frame, t):
+        """
+        Input:
+            frame: decoded BGR frame
+            t: timestamp of frame in seconds
+        Output:
+            change score of frame if it should be kept (inf for the first frame), None otherwise
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)  # pylint: disable=I1101
+        size = (self.thumb_size, self.thumb_size)
+        thumb = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)  # pylint: disable=I1101
+        thumb = thumb.astype(np.float32) / 255.0
+        if self.last is None:
+            diff = float("inf")
+        else:
+            diff = float(np.abs(thumb - self.last).mean())
+            if diff < self.threshold and t - self.last_t < self.max_gap:
+                return None
+        self.last, self.last_t = thumb, t
+        return diff
+
+    def select(self, scores):
+        """
+        Input:
+            scores: scores of the kept frames of a video in order
+        Output:
+            indices of the frames to keep within frame_budget (in order)
+        """
+        if self.frame_budget == -1 or len(scores) <= self.frame_budget:
+            return list(range(len(scores)))
+        return sorted(np.argsort(-np.array(scores), kind="stable")[: self.frame_budget].tolist())
+
+
+def decode_keyframes(path, width, height, size, timeout):
+    """
+    Decodes only the keyframes of a video with ffmpeg, the decoder skips all other frames
+
+    frames are scaled to width x height and center cropped to size x size by ffmpeg (like Resizer does)
+    and read from its pipe one at a time, so only the resized frames are ever held in memory
+
+    Output:
+        frames: list of (size, size, 3) uint8 BGR frames
+        timestamps: presentation time (seconds) of each frame
+    """
+    cmd = ["ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "info", "-skip_frame", "nokey", "-i", path]
+    cmd += ["-map", "0:v:0", "-vf", f"showinfo,scale={width}:{height}:flags=bicubic,crop={size}:{size}"]
+    cmd += ["-vsync", "0", "-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1"]
+    frames, log, expired = [], [], threading.Event()
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+
+        def kill():
+            expired.set()
+            proc.kill()
+
+        killer = threading.Timer(timeout, kill)
+        log_reader = threading.Thread(target=lambda: log.extend(proc.stderr), daemon=True)  # so ffmpeg never blocks
+        killer.start()
+        log_reader.start()
+        try:
+            frame_bytes = size * size * 3
+            while True:
+                buf = proc.stdout.read(frame_bytes)
+                if len(buf) < frame_bytes:
+                    break
+                frames.append(np.frombuffer(buf, dtype=np.uint8).reshape(size, size, 3))
+            proc.wait()
+            log_reader.join()
+        finally:
+            killer.cancel()
+    if expired.is_set():
+        raise TimeoutError
+    stderr = b"".join(log)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed - {stderr.decode(errors='replace').strip().splitlines()[-1:]}")
+
+    timestamps = [float(t) for t in re.findall(rb"pts_time:\s*(\S+)", stderr)]  # logged by showinfo
+    n = min(len(frames), len(timestamps))
+    return frames[:n], timestamps[:n]
+
+
+def probe_gop(path, n_packets=1000):
+    """
+    Output:
+        mean number of frames between keyframes among the first n_packets video packets of a local file
+        (ffprobe only demuxes, nothing is decoded), None if it can't be probed
+    """
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-read_intervals", f"%+#{n_packets}"]
+    cmd += ["-show_entries", "packet=flags", "-of", "csv=p=0", path]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, timeout=30, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    flags = proc.stdout.split()
+    n_key = sum(f.startswith(b"K") for f in flags)
+    return len(flags) / n_key if n_key > 0 else None
+
+
+class VideoError(Exception):
+    """a video that couldn't be read, kind says why (f.e. "timeout", "max_bytes")"""
+
+    def __init__(self, kind, message=""):
+        super().__init__(f"{kind} - {message}" if message else kind)
+        self.kind = kind
+
+
+TRANSIENT_ERRORS = ["timeout", "unreadable", "error"]  # kinds of failures that are retried in later passes
+
+
+def remote_size(url, timeout=None):
+    """size the server reports for url (f.e. a youtube stream), None if it doesn't"""
+    try:
+        with requests.head(url, allow_redirects=True, timeout=timeout) as resp:
+            return int(resp.headers["Content-Length"]) if resp.ok and "Content-Length" in resp.headers else None
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def download_video(url, max_bytes, timeout=None):
+    """
+    downloads a video link to a temporary file, stops as soon as it's known to be larger than max_bytes
+
+    Output:
+        tempfile.NamedTemporaryFile holding the video (deleted once it's closed)
+    """
+    with requests.get(url, stream=True, timeout=timeout) as resp:
+        resp.raise_for_status()
+        size = int(resp.headers.get("Content-Length", -1))
+        if size > max_bytes:
+            raise VideoError("max_bytes", f"{size} bytes")
+        file = tempfile.NamedTemporaryFile(suffix=os.path.splitext(url)[1])  # pylint: disable=consider-using-with
+        try:
+            n_bytes = 0
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK):
+                n_bytes += len(chunk)
+                if n_bytes > max_bytes:
+                    raise VideoError("max_bytes", f"more than {max_bytes} bytes")
+                file.write(chunk)
+            file.flush()
+        except BaseException:
+            file.close()
+            raise
+    return file
+
+
+def decode_video(
+    load_vid,
+    take_every_nth,
+    target_fps,
+    resize_size,
+    sampler=None,
+    keyframes=False,
+    decode_strategy="auto",
+    max_decode_time=-1,
+    max_frames=-1,
+):
+    """
+    Decodes frames of an opened video location (see get_frames for arguments)
+
+    Output:
+        video_frames: list of (resize_size, resize_size, 3) uint8 BGR frames
+        timestamps: seconds of each frame
+        fps: frame rate of the video
+    """
+    video_frames, timestamps = [], []
+    time_0 = time.time()
+
+    params = []
+    if max_decode_time != -1:  # so reads that block (f.e. stalled downloads) are interrupted too
+        ms = int(max_decode_time * 1000)
+        params = [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, ms, cv2.CAP_PROP_READ_TIMEOUT_MSEC, ms]  # pylint: disable=I1101
+    cap = cv2.VideoCapture(load_vid, cv2.CAP_ANY, params)  # pylint: disable=I1101
+    if not cap.isOpened():
+        raise VideoError("unreadable", "couldn't open video")
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    res = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    if max_decode_time != -1:
+        timeout = max_decode_time
+    else:
+        minutes = (frame_count / fps) / 60
+        timeout = max(minutes, 0.5)  # acceptable reading speed is 1 [min downloaded/s]
+        timeout *= res / 360.0  # give more time for longer vids
+        timeout *= 10
+
+    if target_fps != -1:
+        skip_frames = int(fps / target_fps) if fps > target_fps else 1
+    else:
+        skip_frames = take_every_nth
+    if max_frames != -1 and not keyframes and sampler is None and frame_count // skip_frames > max_frames:
+        cap.release()
+        raise VideoError("max_frames", f"~{frame_count // skip_frames} frames")
+
+    width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+    height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    resizer = Resizer([height, width, 3], resize_size)
+
+    scores = []
+    if sampler is not None:
+        sampler.reset()
+
+    # seeking decodes up to a keyframe interval of frames, only worth it if we'd otherwise decode more
+    max_gap = {"sequential": float("inf"), "seek": 0}.get(decode_strategy)
+    if max_gap is None and skip_frames > 1 and not keyframes:  # ffmpeg skips non-keyframes itself
+        max_gap = (probe_gop(load_vid) if os.path.isfile(load_vid) else None) or DEFAULT_GOP
+    can_seek = frame_count > 0 and skip_frames - 1 > (max_gap or 0)
+
+    ret = not keyframes
+    ind = 0
+    if keyframes:
+        cap.release()
+        resized_height, resized_width = resizer.resize_shape[:2]
+        video_frames, timestamps = decode_keyframes(load_vid, resized_width, resized_height, resize_size, timeout)
+    while ret:
+        if can_seek and ind % skip_frames != 0:
+            target = ind - ind % skip_frames + skip_frames
+            if target >= frame_count:
+                break
+            cap.set(cv2.CAP_PROP_POS_FRAMES, target)  # pylint: disable=I1101
+            ind = target
+        ret = cap.grab()
+        if time.time() - time_0 > timeout:  # timeout if taking too long (maybe try another format)
+            cap.release()
+            raise TimeoutError
+        if ret and (ind % skip_frames == 0):
+            # position of the frame that was just grabbed, fall back to index if container has no pts
+            pos_msec = cap.get(cv2.CAP_PROP_POS_MSEC)
+            frame_t = pos_msec / 1000.0 if (pos_msec > 0 or ind == 0) else ind / fps
+            ret, frame = cap.retrieve()
+            score = sampler.score(frame, frame_t) if (ret and sampler is not None) else None
+            if ret and (sampler is None or score is not None):
+                timestamps.append(frame_t)
+                video_frames.append(resizer(frame))
+                scores.append(score)
+        ind += 1
+    cap.release()
+
+    if sampler is not None and not keyframes:
+        keep = sampler.select(scores)
+        video_frames, timestamps = [video_frames[i] for i in keep], [timestamps[i] for i in keep]
+    if max_frames != -1 and len(video_frames) > max_frames:
+        raise VideoError("max_frames", f"{len(video_frames)} frames")
+    return video_frames, timestamps, fps
+
+
+def get_frames(
+    vid,
+    ref,
+    take_every_nth,
+    target_fps,
+    resize_size,
+    batch_size,
+    retry=0,
+    sampler=None,
+    keyframes=False,
+    decode_strategy="auto",
+    max_decode_time=-1,
+    max_frames=-1,
+    max_bytes=-1,
+):
+    """
+    Decodes a single video
+
+    Input:
+        sampler: SceneSampler to keep only frames at visual changes among the frames take_every_nth/target_fps
+            would take (None to keep all of them)
+        keyframes: only decode keyframes (I-frames) with ffmpeg, take_every_nth/target_fps/sampler are ignored
+        decode_strategy: how to get to the next frame that's taken
+            "sequential": decode every frame in between
+            "seek": seek to it (decoding starts from the keyframe before it)
+            "auto": seek when the next frame is further away than the keyframe interval of the video
+        max_decode_time: seconds after which decoding is given up (-1 means a limit based on the video length)
+        max_frames: max number of frames taken from the video (-1 means no max)
+        max_bytes: max size of the video file (-1 means no max), mp4 links are downloaded only up to it and
+            streamed urls (f.e. youtube) are checked by the size their server reports (not limited if it reports none)
+    Output:
+        np_frames: (n_frames, resize_size, resize_size, 3) uint8 RGB frames (reshaped into batches if batch_size != -1)
+        info: dict with reference, dst_name, pad_by, fps and timestamps (seconds, float32) of each returned frame
+        raises VideoError (or TimeoutError) if the video couldn't be read or exceeds a limit
+    """
+    timeout = None if max_decode_time == -1 else max_decode_time
+    # TODO: better way of testing if vid is url
+    if vid.startswith("http://") or vid.startswith("https://"):
+        if max_bytes != -1 and vid.endswith(".mp4") and "youtube" not in vid:  # mp4 link, stop large downloads
+            file = download_video(vid, max_bytes, timeout)
+            load_vid, dst_name = file.name, vid.split("/")[-1][:-4] + ".npy"
+        else:
+            load_vid, file, dst_name = handle_url(vid, retry)
+    else:
+        load_vid, file, dst_name = vid, None, vid[:-4].split("/")[-1] + ".npy"
+    if load_vid is None:
+        raise VideoError("unreadable", "unsupported url")
+
+    try:
+        if max_bytes != -1:
+            size = os.path.getsize(load_vid) if os.path.isfile(load_vid) else None
+            if load_vid.startswith(("http://", "https://")):
+                size = remote_size(load_vid, timeout)
+            if size is not None and size > max_bytes:
+                raise VideoError("max_bytes", f"{size} bytes")
+        video_frames, timestamps, fps = decode_video(
+            load_vid,
+            take_every_nth,
+            target_fps,
+            resize_size,
+            sampler,
+            keyframes,
+            decode_strategy,
+            max_decode_time,
+            max_frames,
+        )
+    finally:
+        if file is not None:  # for python files that need to be closed
+            file.close()
+
+    if len(video_frames) == 0:
+        raise VideoError("empty", "contained 0 frames")
+
+    np_frames = np.array(video_frames)[:, :, :, ::-1]  # BGR to RGB conversion
+    f_ct = np_frames.shape[0]
+    pad_by = 0
+    if batch_size != -1:
+        pad_by = (batch_size - f_ct % batch_size) % batch_size
+        np_frames = np.pad(np_frames, ((0, pad_by), (0, 0), (0, 0), (0, 0)))
+        np_frames = np_frames.reshape((-1, batch_size, resize_size, resize_size, 3))
+
+    info = {
+        "reference": ref,
+        "dst_name": dst_name,
+        "pad_by": pad_by,
+        "fps": fps,
+        "timestamps": np.array(timestamps, dtype=np.float32),
+    }
+    return np_frames, info
+
+
+def read_vids(
+    work_queue,
+    worker_id,
+    take_every_nth,
+    target_fps,
+    resize_size,
+    batch_size,
+    queue_export,
+    failure_queue=None,
+    retry=0,
+    **decode_kwargs,
+):
+    """
+    Reads videos from work queue until it gets None, saves frames to Shared Queue
+
+    Input:
+      work_queue - multiprocessing.Queue of videos (either path or youtube link) and their references
+      worker_id - unique ID of worker
+      take_every_nth - offset between frames we take
+      target_fps - what fps to decode the videos at (-1 means unaltered fps)
+      resize_size - new pixel height and width of resized frame
+      batch_size - max length of frame sequence to put on shared_queue (-1 = no max).
+      queue_export - SharedQueue export used re-create SharedQueue object in worker
+      failure_queue - multiprocessing.Queue to report videos that failed on as (video, ref, kind, message)
+      retry - how many times the videos were attempted before (picks other download formats for urls)
+      decode_kwargs - sampler, keyframes, decode_strategy and limits (see get_frames)
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # the parent's handler (see clip_video_encode) is inherited
+    shared_queue = SharedQueue.from_export(*queue_export)
+    t0 = time.perf_counter()
+    print(f"Worker #{worker_id} starting processing videos")
+
+    n_vids = 0
+    for vid, ref in iter(work_queue.get, None):
+        n_vids += 1
+        try:
+            np_frames, info = get_frames(
+                vid, ref, take_every_nth, target_fps, resize_size, batch_size, retry, **decode_kwargs
+            )
+            shared_queue.put(np_frames, info)
+        except Exception as e:  # pylint: disable=broad-except
+            kind = e.kind if isinstance(e, VideoError) else "timeout" if isinstance(e, TimeoutError) else "error"
+            message = str(e) or kind
+            print(f"Error: Video {vid} failed with message - {message}")
+            if failure_queue is not None:
+                failure_queue.put((vid, ref, kind, message))
+    tf = time.perf_counter()
+    print(f"Worker #{worker_id} done processing {n_vids} videos in {tf-t0}[s]")
+
+
+class FrameReader:
+    """
+    Iterates over frame blocks returned by read_vids function
+    """
+
+    def __init__(
+        self,
+        vids,
+        refs=None,
+        take_every_nth=1,
+        target_fps=-1,
+        resize_size=224,
+        batch_size=-1,
+        workers=1,
+        memory_size=4,
+        sampler=None,
+        keyframes=False,
+        decode_strategy="auto",
+        max_decode_time=-1,
+        max_frames=-1,
+        max_bytes=-1,
+        retry=0,
+        stop=None,
+    ):
+        """
+        Input:
+          vids - list with youtube links or paths to mp4 files.
+                 or iterator of (video, ref) pairs which is consumed as workers need more videos.
+          refs - list with refrences to other data for each video (could correspondance to metadata in other file).
+                 if None, refs = index of video
+          take_every_nth - offset between frames we take.
+          target_fps - target decoding fps (-1 if unaltered)
+          resize_size - pixel height and width of target output shape.
+          batch_size - max length of frame sequence to put on shared_queue (-1 = no max).
+          workers - number of Processes to distribute video reading to.
+          memory_size - number of GB of shared_memory
+          sampler - SceneSampler to only keep frames at visual changes (plus a minimum rate) among the frames
+                    take_every_nth/target_fps select, None keeps all of them
+          keyframes - only decode keyframes (needs ffmpeg), each frame's timestamp is in info["timestamps"]
+          decode_strategy - how to skip frames that aren't taken:
+                    "sequential" decodes all of them, "seek" seeks to the next frame that's taken,
+                    "auto" seeks only when frames are further apart than the video's keyframe interval
+          max_decode_time - seconds after which a video is given up (-1 means a limit based on its length)
+          max_frames - max number of frames taken from a video, longer videos are skipped (-1 means no max)
+          max_bytes - max file size of a video, larger videos are skipped (-1 means no max, see get_frames)
+          retry - number of earlier attempts at these videos (f.e. to read videos that failed again)
+          stop - threading.Event, once it's set iteration stops without waiting for videos still being decoded
+
+        videos that fail or exceed a limit are skipped, they're listed in self.failures once reading finished
+        """
+        self.n_workers = workers
+
+        if isinstance(vids, (list, tuple)):
+            self.n_vids = len(vids)
+            if refs is None:
+                refs = list(range(self.n_vids))
+            vid_refs = list(zip(vids, refs))
+            random.shuffle(vid_refs)  # shuffle videos so each shard has approximately equal sum of video lengths
+            self.vid_refs = iter(vid_refs)
+        else:  # streamed input
+            self.n_vids = None
+            self.vid_refs = vids
+
+        memory_size_b = int(memory_size * 1024**3)  # GB -> bytes
+        shared_blocks = memory_size_b // (resize_size**2 * 3 * (1 if batch_size == -1 else batch_size))
+        dim12 = (shared_blocks,) if batch_size == -1 else (shared_blocks, batch_size)
+        self.shared_queue = SharedQueue.from_shape(*dim12, resize_size, resize_size, 3, timeout=60.0, retry=True)
+
+        # workers pull videos from a shared bounded queue so input can be streamed and load stays balanced
+        self.work_queue = multiprocessing.Queue(maxsize=4 * workers)
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.feed_error = None
+        self.failure_queue = multiprocessing.Queue()
+        self.failures = []  # dicts with video, reference, kind (see VideoError) and message
+
+        decode_kwargs = {
+            "sampler": sampler,
+            "keyframes": keyframes,
+            "decode_strategy": decode_strategy,
+            "max_decode_time": max_decode_time,
+            "max_frames": max_frames,
+            "max_bytes": max_bytes,
+        }
+        self.procs = [
+            multiprocessing.Process(
+                args=(
+                    self.work_queue,
+                    worker_id,
+                    take_every_nth,
+                    target_fps,
+                    resize_size,
+                    batch_size,
+                    self.shared_queue.export(),
+                    self.failure_queue,
+                    retry,
+                ),
+                kwargs=decode_kwargs,
+                daemon=True,
+                target=read_vids,
+            )
+            for worker_id in range(workers)
+        ]
+        self.stop = stop
+        self.t0 = None
+        self.released = False
+
+    def __len__(self):
+        return self.n_vids
+
+    def _feed(self):
+        try:
+            for vid_ref in self.vid_refs:
+                self.work_queue.put(vid_ref)
+        except Exception as e:  # pylint: disable=(broad-except)
+            self.feed_error = e
+        finally:
+            for _ in self.procs:
+                self.work_queue.put(None)
+
+    def __iter__(self):
+        return self
+
+    def _collect_failures(self):
+        while True:
+            try:
+                vid, ref, kind, message = self.failure_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.failures.append({"video": vid, "reference": ref, "kind": kind, "message": message})
+
+    def __next__(self):
+        while not self.shared_queue and any(p.is_alive() for p in self.procs):
+            self._collect_failures()  # workers can't exit while they have unread failures
+            if self.stop is None:
+                time.sleep(1)  # SharedQueue is empty but processes are alive
+            elif self.stop.wait(1):  # don't wait for a slow decode (up to its timeout) once stopped
+                self.terminate()
+                raise StopIteration
+        if self.shared_queue:
+            frames, info = self.shared_queue.get()
+            return frames, info
+
+        self.finish_reading()
+        self.release_memory()
+        if self.feed_error is not None:
+            raise self.feed_error
+        raise StopIteration
+
+    def start_reading(self):
+        n_vids = "streamed" if self.n_vids is None else self.n_vids
+        print(f"Reading {n_vids} videos using {self.n_workers} workers...")
+        self.t0 = time.perf_counter()
+        for p in self.procs:
+            p.start()
+        self.feeder.start()
+
+    def finish_reading(self):
+        for p in self.procs:
+            while p.is_alive():
+                self._collect_failures()
+                p.join(0.1)
+        self._collect_failures()
+        print(f"All jobs completed in {time.perf_counter() - self.t0}[s].")
+
+    def release_memory(self):
+        if not self.released:
+            self.released = True
+            self.shared_queue.data_mem.unlink()
+            self.shared_queue.data_mem.close()
+
+    def terminate(self):
+        """stops workers early (f.e. when iteration was abandoned), no-op once all videos were read."""
+        for p in self.procs:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        self.release_memory()
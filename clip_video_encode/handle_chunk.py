@@ -2,6 +2,7 @@
 import numpy as np
 import torch
 
+from .pooling import pool_chunk
 from .utils import block2dl
 
 
@@ -10,6 +11,41 @@ BATCH_SIZE = 128
 N_DATASET_WORKERS = 6
 
 
+def is_tokenizer(head, frame_tokenization_strategy="none"):
+    """whether a head maps frames to tokens instead of embeddings"""
+    return getattr(head, "frame_tokenizer", frame_tokenization_strategy != "none")
+
+
+def head_name(head, i):
+    return getattr(head, "name", None) or f"head{i}"
+
+
+def map_frames(vid_block, heads, device, frame_tokenization_strategy="none"):
+    """
+    passes a block of frames through each head, heads with the same preprocessing share it
+
+    Output:
+        list with the (n_frames, ...) embeddings or tokens of each head
+    """
+    groups = {}  # transforms with equal reprs (same sizes, normalization, ...) do the same work
+    for i, head in enumerate(heads):
+        groups.setdefault(repr(head.preprocess), []).append(i)
+
+    outputs = [[] for _ in heads]
+    for inds in groups.values():
+        dl = block2dl(vid_block, heads[inds[0]].preprocess, BATCH_SIZE, N_DATASET_WORKERS)
+        for batch in dl:
+            batch = batch.to(device)
+            for i in inds:
+                if is_tokenizer(heads[i], frame_tokenization_strategy):
+                    # uint8 frames go to the device as is, they're normalized there
+                    outputs[i].append(heads[i].tokenize_frames(batch))
+                else:
+                    with torch.cuda.amp.autocast():
+                        outputs[i].append(heads[i](batch))
+    return [np.concatenate(out) for out in outputs]
+
+
 def encode_chunk(
     frames,
     ind_dict,
@@ -23,16 +59,29 @@ def encode_chunk(
     captioning_strategy="none",
     frame_tokenization_strategy="none",
     generated_caption_key="generated_caption",
+    pooling_strategies=None,
+    pooling_window=8,
+    timestamps=None,
 ):
-    """encodes a chunk of video frames and saves."""
+    """
+    encodes a chunk of video frames and saves.
+
+    mapper: FrameMapper or list of them (heads), every head gets the same decoded frames.
+    the output of the first head is saved as the sample's array, the ones of other heads as {head.name}.npy
+    (and their pooled embeddings as {head.name}.{strategy}.npy)
+    timestamps: optional list of per-video frame timestamp arrays (seconds) aligned with frames,
+    saved as {key}.timestamps.npy next to embeddings/tokens
+    """
+    heads = list(mapper) if isinstance(mapper, (list, tuple)) else [mapper]
     vid_block = np.concatenate(frames)
-    dl = block2dl(vid_block, mapper.preprocess, BATCH_SIZE, N_DATASET_WORKERS)
+    timestamps = np.concatenate(timestamps) if timestamps else None
 
     with torch.no_grad():
         if captioning_strategy != "none":
+            dl = block2dl(vid_block, heads[0].preprocess, BATCH_SIZE, N_DATASET_WORKERS)
             captions = []
             for batch in dl:
-                captions += mapper.generate_captions(batch.to(device))
+                captions += heads[0].generate_captions(batch.to(device))
 
             for ref, (i0, it, dst_name) in ind_dict.items():
                 vid_id = dst_name[:-4] if use_dst_name else ids[ref]
@@ -50,45 +99,30 @@ def encode_chunk(
 
                 # TODO: we should be able to do both at once with a CoCa model
                 writer.write(None, vid_id, vid_meta)
-        elif frame_tokenization_strategy != "none":
-            tokens = []
-            for batch in dl:
-                batch = batch.permute(0, 3, 1, 2).float() / 255.0  # make channel first and [0, 1]
-                indices = mapper.tokenize_frames(batch.to(device))
-                tokens.append(indices)
-
-            tokens = np.concatenate(tokens)
-
-            for ref, (i0, it, dst_name) in ind_dict.items():
-                vid_id = dst_name[:-4] if use_dst_name else ids[ref]
-                if input_format == "webdataset":
-                    vid_meta = meta[ref]
-                else:
-                    vid_meta = {"json": {}}
-                    for k in meta:
-                        vid_meta["json"][k] = meta[k][ref].as_py()
-                    if "caption" in vid_meta["json"]:
-                        vid_meta["txt"] = vid_meta["json"]["caption"]
-
-                video_tokens = tokens[i0:it]
-                writer.write(video_tokens, vid_id, vid_meta)
         else:
-            embeddings = []
-            for batch in dl:
-                with torch.cuda.amp.autocast():
-                    emb = mapper(batch.to(device))
-                    embeddings.append(emb)
+            outputs = map_frames(vid_block, heads, device, frame_tokenization_strategy)
+            tokenizes = [is_tokenizer(head, frame_tokenization_strategy) for head in heads]
+            bounds = [(i0, it) for i0, it, _ in ind_dict.values()]
+            pooled = [
+                pool_chunk(
+                    out,
+                    bounds,
+                    pooling_strategies if pooling_strategies is not None and not tok else [],
+                    pooling_window,
+                    timestamps,
+                )
+                for out, tok in zip(outputs, tokenizes)
+            ]
 
             caption_embs = None
-            if mapper.tokenizer is not None:
+            if not tokenizes[0] and heads[0].tokenizer is not None:
                 # TODO: is there a better way of doing this?
                 # here we will compute similarity of empty string...
                 captions = [m["caption"] if "caption" in m else "" for m in meta]
-                caption_embs = mapper.encode_captions(captions)
+                caption_embs = heads[0].encode_captions(captions)
                 caption_embs = caption_embs / np.linalg.norm(caption_embs, axis=-1)[:, None]
 
-            embeddings = np.concatenate(embeddings)
-            for ref, (i0, it, dst_name) in ind_dict.items():
+            for v, (ref, (i0, it, dst_name)) in enumerate(ind_dict.items()):
                 vid_id = dst_name[:-4] if use_dst_name else ids[ref]
                 if input_format == "webdataset":
                     vid_meta = meta[ref]
@@ -99,7 +133,7 @@ def encode_chunk(
                     if "caption" in vid_meta["json"]:
                         vid_meta["txt"] = vid_meta["json"]["caption"]
 
-                frame_embeddings = embeddings[i0:it]
+                frame_embeddings = outputs[0][i0:it]
                 if caption_embs is not None:
                     # normalize
                     fe = frame_embeddings / np.linalg.norm(frame_embeddings, axis=-1)[:, None]
@@ -110,4 +144,13 @@ def encode_chunk(
                     vid_meta["json"] = vid_meta["json"] if "json" in vid_meta else {}
                     vid_meta["json"]["clip_frame_similarity"] = sim
 
+                for h, head in enumerate(heads):
+                    prefix = f"{head_name(head, h)}." if h > 0 else ""
+                    if h > 0:
+                        vid_meta[f"{prefix}npy"] = outputs[h][i0:it]
+                    for strategy, pooled_emb in pooled[h][v].items():
+                        vid_meta[f"{prefix}{strategy}.npy"] = pooled_emb
+                if timestamps is not None:
+                    vid_meta["timestamps.npy"] = timestamps[i0:it]
+
                 writer.write(frame_embeddings, vid_id, vid_meta)
@@ -1,95 +1,240 @@
 """encode numpy video frame arrays with CLIP from directory as they come in from other processes."""
+import bisect
+import json
 import os
 import time
+from multiprocessing import resource_tracker, shared_memory  # type: ignore
 
 import numpy as np
 
 from .utils import block2dl
+from .watcher import DONE_SUFFIX, DirectoryWatcher
 from .writer import FileWriter
 
 N_DATASET_WORKERS = 6
 BATCH_SIZE = 256
+SHM_SUFFIX = ".shm"
+
+
+def share_frames(data_dir, key, frames, completion="rename"):
+    """
+    hands frames to a LiveNumpyEncoder on the same host through shared memory instead of a .npy file
+
+    the frames are copied into a new shared memory block and a small {key}.shm descriptor pointing to it
+    is placed in data_dir. the encoder unlinks the block once the frames are encoded.
+
+    Input:
+        data_dir: directory the encoder is watching
+        key: name embeddings will be saved under
+        frames: (n_frames, H, W, C) array of frames
+        completion: completion protocol the encoder was created with
+    """
+    frames = np.ascontiguousarray(frames)
+    shm = shared_memory.SharedMemory(create=True, size=max(frames.nbytes, 1))
+    np.ndarray(frames.shape, dtype=frames.dtype, buffer=shm.buf)[:] = frames
+    resource_tracker.unregister(shm._name, "shared_memory")  # pylint: disable=protected-access
+    shm.close()  # keep the block alive after this process exits, the encoder owns it now
+
+    desc_path = os.path.join(data_dir, key + SHM_SUFFIX)
+    with open(desc_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"name": shm.name, "shape": list(frames.shape), "dtype": frames.dtype.str}, f)
+    os.rename(desc_path + ".tmp", desc_path)
+    if completion == "done":
+        open(desc_path + DONE_SUFFIX, "w", encoding="utf-8").close()  # pylint: disable=consider-using-with
+
+
+class FrameBuffer:
+    """
+    bounded buffer of frames waiting to be encoded, sized from the shape of the first frames it gets.
+
+    holds views of the incoming (memory mapped or shared) arrays instead of copies,
+    frames are only read from them when they get preprocessed.
+    """
+
+    def __init__(self, mem_size_b):
+        self.mem_size_b = mem_size_b
+        self.capacity = None
+        self.frame_shape = None
+        self.cur_len = 0
+        self.blocks = []
+        self.starts = []
+        self.segments = []  # (name, i0, it, last) - videos can be split across flushes
+
+    @property
+    def free(self):
+        return self.capacity - self.cur_len if self.capacity is not None else None
+
+    def __len__(self):
+        return self.cur_len
+
+    def __getitem__(self, ind):
+        b = bisect.bisect_right(self.starts, ind) - 1
+        return self.blocks[b][ind - self.starts[b]]
+
+    def add(self, name, frames, last):
+        """
+        adds as many frames as fit into the buffer
+
+        Input:
+            name: name of the video the frames belong to
+            frames: (n_frames, H, W, C) array of frames
+            last: if these are the final frames of the video
+        Output:
+            number of frames from frames that were added
+        """
+        if self.capacity is None:
+            frame_b = int(np.prod(frames.shape[1:])) * frames.dtype.itemsize
+            self.capacity = self.mem_size_b // frame_b
+            self.frame_shape = frames.shape[1:]
+            assert self.capacity > 0, f"frame_mem too small to hold a single {frames.shape[1:]} frame"
+        assert frames.shape[1:] == self.frame_shape, f"{name} has frames of shape {frames.shape[1:]}"
+
+        n = min(len(frames), self.free)
+        self.blocks.append(frames[:n])
+        self.starts.append(self.cur_len)
+        self.segments.append((name, self.cur_len, self.cur_len + n, last and n == len(frames)))
+        self.cur_len += n
+        return n
+
+    def reset(self):
+        self.cur_len = 0
+        self.blocks, self.starts, self.segments = [], [], []
 
 
 class LiveNumpyEncoder:
     """class that watches directory for set of numpy arrays of videos to encode using CLIP."""
 
-    def __init__(self, data_dir, dest_dir, n_vids, mapper, preprocess, frame_mem=4, remove_on_read=False):
+    def __init__(
+        self,
+        data_dir,
+        dest_dir,
+        n_vids,
+        mapper,
+        preprocess,
+        frame_mem=4,
+        remove_on_read=False,
+        completion="rename",
+        use_inotify=True,
+    ):
         """
 
         Input:
-            data_dir: directory to watch for np files
+            data_dir: directory to watch for np files (or .shm descriptors written by share_frames)
             dest_dir:  where to save embeddings to
             n_vids: number of numpy array names to watch for. Completes after n_vids have been encoded
             mapper: model used to map frames to embeddings
             preprocess: function to preprocess the frames with
-            frame_mem: amount of memory in GB for shared frame array
+            frame_mem: amount of frame memory in GB encoded at once, arrays are memory mapped and
+                no more of them are read until the buffered frames are encoded
             remove_on_read: remove arrays when done reading them
+            completion: how producers mark arrays as completely written (see DirectoryWatcher)
+                "rename": write to a temporary name and rename to *.npy
+                "done": create *.npy.done marker after writing *.npy
+            use_inotify: get notified of new arrays instead of polling data_dir (Linux only)
         """
         assert data_dir != dest_dir  # input and output will have same name
         self.data_dir = data_dir
         self.writer = FileWriter(dest_dir)
         self.n_vids = n_vids
-        self.frame_mem = frame_mem
+        self.buffer = FrameBuffer(int(frame_mem * 1024**3))
+        self.embeddings = None  # allocated from the first mapper output so it has the model's dim and dtype
+        self.pieces = {}  # embeddings of videos whose frames were split across flushes
+        self.shms = {}  # shared memory blocks of videos that are being encoded
+        self.closing = []  # shared memory blocks to close once nothing references them
 
         self.fm = mapper
         self.preprocess = preprocess
 
         self.remove_on_read = remove_on_read
+        self.watcher = DirectoryWatcher(
+            data_dir, completion=completion, use_inotify=use_inotify, extensions=(".npy", SHM_SUFFIX)
+        )
+
+    def _load(self, vid):
+        """maps frames of vid without reading them."""
+        vid_path = os.path.join(self.data_dir, vid)
+        if not vid.endswith(SHM_SUFFIX):
+            return np.load(vid_path, mmap_mode="r")
+
+        with open(vid_path, "r", encoding="utf-8") as f:
+            desc = json.load(f)
+        shm = shared_memory.SharedMemory(name=desc["name"])
+        self.shms[vid] = shm
+        return np.ndarray(desc["shape"], dtype=desc["dtype"], buffer=shm.buf)
+
+    def _release(self, vid):
+        """frees shared memory of vid once its frames have been encoded."""
+        if vid in self.shms:
+            shm = self.shms.pop(vid)
+            shm.unlink()
+            self.closing.append(shm)
+        for shm in list(self.closing):
+            try:
+                shm.close()
+            except BufferError:  # frames still referenced somewhere, try again after next flush
+                continue
+            self.closing.remove(shm)
+
+    def _ingest(self, name, frames):
+        """adds frames of a video to the buffer, encoding the buffer whenever it fills up."""
+        if len(frames) == 0:
+            print(f"Warning: {name} contained 0 frames")
+            self._release(name)
+        i = 0
+        while i < len(frames):
+            if self.buffer.free == 0:
+                self._flush()
+            i += self.buffer.add(name, frames[i:], last=True)
+
+    def _flush(self):
+        """encodes buffered frames and writes out embeddings of videos that are complete."""
+        if self.buffer.cur_len == 0:
+            return
+        t0 = time.perf_counter()
+
+        dl = block2dl(self.buffer, self.preprocess, BATCH_SIZE, N_DATASET_WORKERS)
+
+        cur_len = 0
+        for batch in dl:
+            emb = self.fm(batch.to(self.fm.device))
+            if self.embeddings is None:
+                self.embeddings = np.empty((self.buffer.capacity,) + emb.shape[1:], dtype=emb.dtype)
+            self.embeddings[cur_len : cur_len + emb.shape[0]] = emb
+            cur_len += emb.shape[0]
+
+        t_enc = time.perf_counter() - t0
+        print(f"Encode time: {t_enc}")
+
+        done = []
+        for name, i0, it, last in self.buffer.segments:
+            self.pieces.setdefault(name, []).append(self.embeddings[i0:it].copy())
+            if last:
+                self.writer.write(np.concatenate(self.pieces.pop(name)), os.path.splitext(name)[0])
+                done.append(name)
+        self.buffer.reset()
+        for name in done:
+            self._release(name)
 
     def start(self):
         """starts live reading."""
 
-        mem_size_b = int(self.frame_mem * 1024**3)
-        mem_frames = mem_size_b // (224**2 * 3)
-        frame_array = np.zeros((mem_frames, 224, 224, 3), dtype=np.uint8)
-        embedding_array = np.zeros((mem_frames, 512))
-
         while self.n_vids > 0:  # haven't seen all videos.
-            # TODO: decide if we need some checks here for incorrectly placed files
-            available_vids = os.listdir(self.data_dir)  # for now assuming all vids in self.data_dir are correct
-            if len(available_vids) == 0:
-                print("Waiting for arrays...")
-                time.sleep(5)  # wait for arrays to come in
-                continue
+            available_vids = self.watcher.get()  # blocks until completed arrays land in data_dir
 
             print(f"Found {len(available_vids)} arrays.")
 
-            name_inds = []
-
             t0 = time.perf_counter()
-
-            cur_len = 0
             for vid in available_vids:
-                assert vid.endswith(".npy")
-                vid_path = os.path.join(self.data_dir, vid)
-                vid_frames = np.load(vid_path)
-                frame_array[cur_len : cur_len + vid_frames.shape[0]] = vid_frames
-                name_inds.append((vid, cur_len, cur_len + vid_frames.shape[0]))
-                cur_len += vid_frames.shape[0]
+                self._ingest(vid, self._load(vid))
 
                 self.n_vids -= 1
+                self.watcher.done(vid)
                 if self.remove_on_read:
-                    os.remove(vid_path)
+                    os.remove(os.path.join(self.data_dir, vid))
 
             t_load = time.perf_counter() - t0
             print(f"Load time: {t_load}")
 
-            t0 = time.perf_counter()
-
-            frame_chunk = frame_array[:cur_len]
-            dl = block2dl(frame_chunk, self.preprocess, BATCH_SIZE, N_DATASET_WORKERS)
-
-            cur_len = 0
-            for batch in dl:
-                emb = self.fm(batch.to(self.fm.device))
-                embedding_array[cur_len : cur_len + emb.shape[0]] = emb
-                cur_len += emb.shape[0]
-
-            t_enc = time.perf_counter() - t0
-            print(f"Encode time: {t_enc}")
-
-            all_embs = embedding_array[:cur_len]
+            self._flush()  # don't hold on to frames while waiting for more arrays
 
-            for name, i0, it in name_inds:
-                self.writer.write(all_embs[i0:it], name)
+        self.watcher.close()
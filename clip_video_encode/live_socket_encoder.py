@@ -0,0 +1,159 @@
+"""encode frames streamed over a unix domain socket, batching frames from all connected producers together."""
+import os
+import queue
+import socket
+import struct
+import threading
+
+import numpy as np
+import torch
+
+from .coalescer import BatchCoalescer
+
+
+HEADER = struct.Struct("<HBB")  # key length, dtype length, ndim
+DIM = struct.Struct("<I")
+
+
+def _recv_exact(sock, n):
+    """reads exactly n bytes, returns None if the peer closed the connection before sending anything."""
+    buf = bytearray(n)
+    view, got = memoryview(buf), 0
+    while got < n:
+        r = sock.recv_into(view[got:], n - got)
+        if r == 0:
+            if got == 0:
+                return None
+            raise ConnectionError("connection closed mid message")
+        got += r
+    return buf
+
+
+def send_array(sock, key, arr):
+    """
+    sends a keyed array as one message
+
+    message layout (little endian):
+        key length (uint16), dtype length (uint8), ndim (uint8) | key (utf-8) | dtype (numpy str, f.e. "|u1")
+        | shape (ndim x uint32) | raw array bytes (C order)
+    """
+    arr = np.ascontiguousarray(arr)
+    key_b, dtype_b = str(key).encode(), arr.dtype.str.encode()
+    header = HEADER.pack(len(key_b), len(dtype_b), arr.ndim) + key_b + dtype_b
+    header += b"".join(DIM.pack(d) for d in arr.shape)
+    sock.sendall(header)
+    if arr.nbytes > 0:
+        sock.sendall(arr.data.cast("B"))
+
+
+def recv_array(sock):
+    """receives a message sent with send_array, returns (key, arr) or (None, None) once the peer is done."""
+    header = _recv_exact(sock, HEADER.size)
+    if header is None:
+        return None, None
+    key_len, dtype_len, ndim = HEADER.unpack(header)
+    meta = _recv_exact(sock, key_len + dtype_len + ndim * DIM.size)
+    key, dtype = meta[:key_len].decode(), np.dtype(meta[key_len : key_len + dtype_len].decode())
+    shape = tuple(DIM.unpack_from(meta, key_len + dtype_len + i * DIM.size)[0] for i in range(ndim))
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    data = _recv_exact(sock, n_bytes) if n_bytes > 0 else bytearray()
+    return key, np.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+class LiveSocketClient:
+    """producer side of LiveSocketEncoder, sends (n_frames, H, W, 3) uint8 frames and gets embeddings back."""
+
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+
+    def send(self, key, frames):
+        send_array(self.sock, key, np.asarray(frames, dtype=np.uint8))
+
+    def recv(self):
+        """returns (key, embeddings) of the oldest request that hasn't been received yet."""
+        return recv_array(self.sock)
+
+    def encode(self, key, frames):
+        self.send(key, frames)
+        return self.recv()[1]
+
+    def close(self):
+        self.sock.close()
+
+
+class LiveSocketEncoder:
+    """serves frame -> embedding requests over a unix domain socket."""
+
+    def __init__(self, socket_path, mapper, preprocess, batch_size=256, max_wait=0.005):
+        """
+        Input:
+            socket_path: path of the unix domain socket to listen on
+            mapper: model used to map frames to embeddings
+            preprocess: function to preprocess the frames with
+            batch_size: max number of frames per forward pass, frames of all connections are batched together
+            max_wait: seconds to wait for more frames before running a batch that isn't full
+        """
+        self.socket_path = socket_path
+        self.preprocess = preprocess
+        self.coalescer = BatchCoalescer(mapper, batch_size, max_wait)
+        self.running = False
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen()
+        self.server.settimeout(0.1)
+
+    def _read(self, conn):
+        """preprocesses and queues requests of one connection until it closes."""
+        responses = queue.Queue()
+        sender = threading.Thread(target=self._send, args=(conn, responses), daemon=True)
+        sender.start()
+        try:
+            while self.running:
+                key, frames = recv_array(conn)
+                if key is None:
+                    break
+                if frames.dtype != np.uint8 or frames.ndim != 4:
+                    print(
+                        f"Error: {key} frames need to be (n_frames, H, W, C) uint8, got {frames.dtype} {frames.shape}"
+                    )
+                    break
+                batch = torch.stack([self.preprocess(f) for f in frames]) if len(frames) > 0 else torch.zeros(0)
+                responses.put((key, self.coalescer.submit(batch.to(self.coalescer.device))))
+        except (ConnectionError, OSError, RuntimeError) as e:
+            print(f"Error: connection failed with message - {e}")
+        finally:
+            responses.put(None)
+
+    def _send(self, conn, responses):
+        """sends embeddings back in request order."""
+        try:
+            for key, future in iter(responses.get, None):
+                send_array(conn, key, future.result())
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Error: couldn't send embeddings - {e}")
+        finally:
+            conn.close()
+
+    def start(self):
+        """serves requests until close() is called (from another thread)."""
+        self.running = True
+        while self.running:
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            conn.settimeout(None)
+            threading.Thread(target=self._read, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self.running = False
+        self.server.close()
+        self.coalescer.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
@@ -0,0 +1,86 @@
+"""manifest - parquet index of every sample written to an output folder, one file per shard (or batch of files)."""
+import os
+import time
+
+import fsspec
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+MANIFEST_DIR = "manifest"
+MANIFEST_SCHEMA = pa.schema(
+    [
+        ("key", pa.string()),
+        ("location", pa.string()),  # shard or file holding the embeddings, relative to the output folder
+        ("shard", pa.int64()),  # shard id, -1 for files
+        ("offset", pa.int64()),  # data offset of the embeddings member in the shard, -1 for files
+        ("size", pa.int64()),  # bytes of the embeddings member
+        ("n_frames", pa.int64()),
+        ("model", pa.string()),
+        ("sampling", pa.string()),  # json of the frame sampling arguments
+        ("encode_time", pa.float64()),  # unix time the sample was handed to the writer
+    ]
+)
+
+
+def manifest_row(key, location, arr, run_info, shard=-1, offset=-1, size=-1):
+    """
+    Input:
+        arr: embeddings of the sample (None if there are none)
+        run_info: dict with values of the run-level columns (model, sampling)
+    """
+    return {
+        "key": key,
+        "location": location,
+        "shard": shard,
+        "offset": offset,
+        "size": size,
+        "n_frames": 0 if arr is None or arr.ndim == 0 else arr.shape[0],
+        "model": run_info.get("model", ""),
+        "sampling": run_info.get("sampling", ""),
+        "encode_time": time.time(),
+    }
+
+
+def save_manifest(rows, path, fs=None):
+    """saves manifest rows as a parquet file."""
+    fs = fsspec.filesystem("file") if fs is None else fs
+    table = pa.Table.from_pydict({name: [row[name] for row in rows] for name in MANIFEST_SCHEMA.names}, MANIFEST_SCHEMA)
+    with fs.open(path, "wb") as f:
+        pq.write_table(table, f)
+
+
+def manifest_path(output_path, name):
+    return os.path.join(output_path, MANIFEST_DIR, name + ".parquet")
+
+
+def manifest_dataset(output_folder):
+    """
+    Output:
+        pyarrow.dataset.Dataset over the manifest files of output_folder (read lazily, with filters and column
+        selection pushed into the parquet reads), None if there's no manifest
+    """
+    fs, output_path = fsspec.core.url_to_fs(output_folder)
+    paths = sorted(fs.glob(manifest_path(output_path, "*")))
+    if len(paths) == 0:
+        return None
+    return ds.dataset(paths, schema=MANIFEST_SCHEMA, format="parquet", filesystem=fs)
+
+
+def load_manifest(output_folder, columns=None, where=None):
+    """
+    reads the manifest of an output folder (f.e. to check which keys are done or where they're stored)
+
+    Input:
+        output_folder: fsspec path clip_video_encode wrote to
+        columns: columns to read (None means all)
+        where: pyarrow.dataset expression rows have to match (f.e. ds.field("model") == "ViT-B-32:openai")
+    Output:
+        pyarrow.Table with MANIFEST_SCHEMA columns, empty if there's no manifest
+    """
+    dataset = manifest_dataset(output_folder)
+    if dataset is None:
+        schema = MANIFEST_SCHEMA if columns is None else pa.schema([MANIFEST_SCHEMA.field(c) for c in columns])
+        return schema.empty_table()
+    return dataset.to_table(columns=columns, filter=where)
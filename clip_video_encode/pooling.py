@@ -0,0 +1,66 @@
+"""pool frame embeddings into per-video and per-window vectors."""
+import numpy as np
+
+
+POOLING_STRATEGIES = ["mean", "max", "norm_mean", "window_mean"]
+
+
+def normalize(emb):
+    return emb / np.maximum(np.linalg.norm(emb, axis=-1, keepdims=True), 1e-8)
+
+
+def window_mean(emb, window, timestamps=None):
+    """
+    mean over fixed-duration windows
+
+    windows span window seconds of video time when timestamps are given, otherwise window sampled frames.
+    only windows that contain at least one frame are returned.
+    """
+    if timestamps is not None:
+        buckets = np.floor(timestamps / window).astype(np.int64)
+    else:
+        buckets = np.arange(len(emb)) // window
+    starts = np.flatnonzero(np.diff(buckets, prepend=-1))
+    counts = np.diff(np.append(starts, len(emb)))
+    return np.add.reduceat(emb, starts) / counts[:, None]
+
+
+def pool_chunk(embeddings, bounds, strategies, window=8, timestamps=None):
+    """
+    Pools a chunk of frame embeddings for each video in one pass
+
+    Input:
+        embeddings: (n_frames, dim) array of frame embeddings for the whole chunk
+        bounds: list of (i0, it) frame ranges, one per video, contiguous and in order
+        strategies: list of POOLING_STRATEGIES to compute
+        window: seconds (or sampled frames if timestamps is None) per window for "window_mean"
+        timestamps: (n_frames,) array of frame timestamps in seconds aligned with embeddings
+
+    Output:
+        list with {strategy: pooled array} for each entry in bounds
+    """
+    assert all(s in POOLING_STRATEGIES for s in strategies)
+    pooled = [{} for _ in bounds]
+    if len(bounds) == 0 or len(strategies) == 0:
+        return pooled
+
+    starts = np.array([i0 for i0, _ in bounds])
+    counts = np.array([it - i0 for i0, it in bounds])
+    assert np.all(counts > 0) and np.all(starts[1:] == starts[:-1] + counts[:-1])
+
+    emb = embeddings.astype(np.float32)  # autocast outputs are half precision, accumulate in float32
+    chunk_pools = {}
+    if "mean" in strategies:
+        chunk_pools["mean"] = np.add.reduceat(emb, starts) / counts[:, None]
+    if "max" in strategies:
+        chunk_pools["max"] = np.maximum.reduceat(emb, starts)
+    if "norm_mean" in strategies:
+        chunk_pools["norm_mean"] = normalize(np.add.reduceat(normalize(emb), starts) / counts[:, None])
+
+    for i, (i0, it) in enumerate(bounds):
+        for strategy, pools in chunk_pools.items():
+            pooled[i][strategy] = pools[i].astype(embeddings.dtype)
+        if "window_mean" in strategies:
+            vid_timestamps = timestamps[i0:it] if timestamps is not None else None
+            pooled[i]["window_mean"] = window_mean(emb[i0:it], window, vid_timestamps).astype(embeddings.dtype)
+    return pooled
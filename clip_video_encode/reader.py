@@ -1,8 +1,10 @@
 """handles input parsing."""
+import io
 import os
 import json
 import glob
 
+import fsspec
 import pyarrow.parquet as pq
 import pyarrow.csv as csv_pq
 import pyarrow as pa
@@ -72,7 +74,201 @@ class Reader:
         return vids, ids, meta
 
 
-def read_shard(tempdir, pass_through_keys=None):
+TABLE_EXTENSIONS = (".parquet", ".csv", ".txt")
+LINE_BLOCK_BYTES = 16 * 1024**2
+
+
+def is_table_src(src):
+    """
+    checks if src is a path (or glob) to tables the StreamingReader can read.
+
+    http(s) urls are never globs ("?" starts their query, f.e. youtube links), other paths are globs if they
+    contain "*" or "[".
+    """
+    if not isinstance(src, str):
+        return False
+    if src.endswith(TABLE_EXTENSIONS):
+        return True
+    return not src.startswith(("http://", "https://")) and any(c in src for c in "*[")
+
+
+def count_lines(f, start, end):
+    """counts newlines in byte range [start, end) without holding it in memory."""
+    f.seek(start)
+    n_lines, remaining = 0, end - start
+    while remaining > 0:
+        block = f.read(min(LINE_BLOCK_BYTES, remaining))
+        if not block:
+            break
+        n_lines += block.count(b"\n")
+        remaining -= len(block)
+    return n_lines
+
+
+def iter_line_blocks(f, start, end, block_lines):
+    """
+    yields blocks of raw lines which start inside byte range [start, end)
+
+    Output:
+        iterator of (offsets, lines), offsets are the byte offsets of the lines in f
+    """
+    f.seek(start - 1 if start > 0 else 0)
+    if start > 0 and f.read(1) != b"\n":
+        f.readline()  # line started in previous range
+    offsets, lines = [], []
+    pos = f.tell()
+    while pos < end:
+        line = f.readline()
+        if not line:
+            break
+        offsets.append(pos)
+        lines.append(line)
+        pos += len(line)
+        if len(lines) == block_lines:
+            yield offsets, lines
+            offsets, lines = [], []
+    if len(lines) > 0:
+        yield offsets, lines
+
+
+class StreamingReader:
+    """Streams input tables in batches, reading only this rank's part of the input.
+
+    Same columns as Reader. Accepts globs of many parquet/csv/txt files (any fsspec path).
+    The input is partitioned across ranks by row ranges of parquet files (from their metadata) and by byte ranges
+    of csv/txt files, so memory and startup time don't depend on the size of the table. Videos of txt files get
+    their line number as videoID (like Reader), to number them ranks count the lines before their byte range
+    unless line_ids=False.
+
+    Iterating yields (videoLoc, ref) pairs for FrameReader. The videoID and metadata of each yielded ref
+    are available in self.ids and self.meta (same layout as Reader.get_data) until release(refs) is called.
+    """
+
+    def __init__(self, src, meta_columns=None, rank=0, world_size=1, batch_size=10000, line_ids=True):
+        """
+        Input:
+
+        src:
+            str: path or glob to parquet, csv or txt files
+        meta_columns:
+            list[str]: columns of useful metadata to save with videos
+        rank, world_size:
+            int: which part of the input to read
+        batch_size:
+            int: number of rows to read at once
+        line_ids:
+            bool: videoID of txt lines is their line number, False uses their byte offset instead
+                  (later ranks don't count the lines before them, but IDs differ from Reader's)
+        """
+        meta_columns = list(meta_columns) if meta_columns is not None else []
+        self.columns = ["videoID", "videoLoc"]
+        self.meta_columns = [c for c in meta_columns if c not in self.columns] + [
+            c for c in meta_columns if c in self.columns
+        ]
+        self.rank, self.world_size = rank, world_size
+        self.batch_size = batch_size
+        self.line_ids = line_ids
+
+        self.fs, path = fsspec.core.url_to_fs(src)
+        self.files = sorted(self.fs.glob(path)) if glob.has_magic(path) else [path]
+        assert len(self.files) > 0, f"No input files found for {src}"
+
+        self.ids = {}
+        self.meta = {c: {} for c in self.meta_columns}
+
+    def __iter__(self):
+        ref = 0
+        for batch in self._iter_batches():
+            vid_col, id_col = batch.column("videoLoc"), batch.column("videoID")
+            meta_cols = {c: batch.column(c) for c in self.meta_columns}
+            for i in range(batch.num_rows):
+                self.ids[ref] = id_col[i]
+                for c, col in meta_cols.items():
+                    self.meta[c][ref] = col[i]
+                yield vid_col[i].as_py(), ref
+                ref += 1
+
+    def release(self, refs):
+        """drop ids and metadata of refs that have been written."""
+        for ref in refs:
+            self.ids.pop(ref, None)
+            for c in self.meta:
+                self.meta[c].pop(ref, None)
+
+    def _iter_batches(self):
+        parquets = [f for f in self.files if f.endswith(".parquet")]
+        if len(parquets) > 0:
+            yield from self._iter_parquet_batches(parquets)
+        for file_idx, f in enumerate(self.files):
+            if not f.endswith(".parquet"):
+                yield from self._iter_text_batches(f, file_idx)
+
+    def _iter_parquet_batches(self, files):
+        """each rank reads an equal range of rows, found from the row counts in the files' metadata."""
+        row_groups = []  # (file, row group, first row, number of rows)
+        n_rows = 0
+        for f in files:
+            with self.fs.open(f, "rb") as fd:
+                metadata = pq.ParquetFile(fd).metadata
+            for rg in range(metadata.num_row_groups):
+                row_groups.append((f, rg, n_rows, metadata.row_group(rg).num_rows))
+                n_rows += metadata.row_group(rg).num_rows
+        start = n_rows * self.rank // self.world_size
+        end = n_rows * (self.rank + 1) // self.world_size
+
+        for f, rg, rg_start, rg_rows in row_groups:
+            if rg_start + rg_rows <= start or rg_start >= end:
+                continue
+            row = rg_start
+            with self.fs.open(f, "rb") as fd:
+                pf = pq.ParquetFile(fd)
+                for batch in pf.iter_batches(
+                    batch_size=self.batch_size, row_groups=[rg], columns=self.columns + self.meta_columns
+                ):
+                    i0, it = max(start - row, 0), min(end - row, batch.num_rows)
+                    row += batch.num_rows
+                    if it > i0:  # row groups at the ends of the range are shared with the neighbouring ranks
+                        yield batch.slice(i0, it - i0)
+
+    def _iter_text_batches(self, f, file_idx):
+        """each rank reads lines starting in its byte range of the file."""
+        is_txt = f.endswith(".txt")
+        with self.fs.open(f, "rb") as fd:
+            header = b"" if is_txt else fd.readline()
+            data_start, size = len(header), self.fs.size(f)
+            start = data_start + (size - data_start) * self.rank // self.world_size
+            end = data_start + (size - data_start) * (self.rank + 1) // self.world_size
+
+            line_id = 0
+            if is_txt and self.line_ids and start > 0:  # count lines started before this range
+                line_id = 1 + count_lines(fd, 0, start - 1)
+
+            read_options = csv_pq.ReadOptions(column_names=["videoLoc"]) if is_txt else None
+            for offsets, lines in iter_line_blocks(fd, start, end, self.batch_size):
+                ids = list(range(line_id, line_id + len(lines))) if self.line_ids else offsets
+                line_id += len(lines)
+                ids, lines = [i for i, l in zip(ids, lines) if l.strip()], [l for l in lines if l.strip()]
+                if len(lines) == 0:
+                    continue
+                df = csv_pq.read_csv(io.BytesIO(header + b"".join(lines)), read_options=read_options)
+                if is_txt:
+                    ids = ids if len(self.files) == 1 else [f"{file_idx}_{i}" for i in ids]
+                    df = df.add_column(0, "videoID", [ids])
+                yield from df.select(self.columns + self.meta_columns).to_batches()
+
+
+class LazyFile:
+    """Reference to a file whose contents are only read when needed (f.e. by the writer)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def read_shard(tempdir, pass_through_keys=None, video_extensions=("mp4",)):
     """
     Extracts shard a tempdir and returns references to files inside
 
@@ -81,36 +277,41 @@ def read_shard(tempdir, pass_through_keys=None):
             path to directory containing contents of an opened WebDataset shard with input data
         pass_through_keys:
             extensions we would like to keep from the source shard in the output shard
+            json and txt are loaded, everything else is passed as a LazyFile so large payloads
+            aren't held in memory for the whole shard
+        video_extensions:
+            extensions of video files, in order of preference if a sample has more than one
     """
     if pass_through_keys is None:
         pass_through_keys = []
 
-    vids = sorted(
-        [f.split("/")[-1] for f in glob.glob(os.path.join(tempdir, "*.mp4"))]
-    )  # TODO: parameterize the video extension
-
     read_funcs = {
         "json": lambda path: json.load(open(path, "rb")),  # pylint: disable=consider-using-with
         "txt": lambda path: open(path, "r", encoding="UTF-8").read(),  # pylint: disable=consider-using-with
     }
 
-    keys, meta = [x.split(".mp4")[0] for x in vids], []
-    for key in keys:
-        metadata = {}
+    # one listing of the whole shard grouped by key
+    # handles double extensions for weird metadata types f.e. ".optical-flow.npy" vs. ".clip_b.npy"
+    samples = {}
+    for root, _, files in os.walk(tempdir):
+        for fname in files:
+            key, _, ext = os.path.relpath(os.path.join(root, fname), tempdir).partition(".")
+            samples.setdefault(key, {})[ext] = os.path.join(root, fname)
 
-        # handles double extensions for weird metadata types f.e. ".optical-flow.npy" vs. ".clip_b.npy"
-        exts = [".".join(f.split(".")[1:]) for f in glob.glob(os.path.join(tempdir, f"{key}.*"))]
-        desired_exts = list(set(pass_through_keys).intersection(set(exts)))
+    vids, keys, meta = [], [], []
+    for key in sorted(samples):
+        exts = samples[key]
+        vid_ext = next((ext for ext in video_extensions if ext in exts), None)
+        if vid_ext is None:
+            continue
 
-        for ext in desired_exts:
-            file_path = os.path.join(tempdir, f"{key}.{ext}")
-            if ext in read_funcs:
-                read_data = read_funcs[ext](file_path)
-            else:
-                read_data = open(path, "rb").read()  # pylint: disable=consider-using-with
-            metadata[ext] = read_data
+        metadata = {}
+        for ext in pass_through_keys:
+            if ext in exts:
+                metadata[ext] = read_funcs[ext](exts[ext]) if ext in read_funcs else LazyFile(exts[ext])
 
+        vids.append(exts[vid_ext])
+        keys.append(key)
         meta.append(metadata)
 
-    vids = [os.path.join(tempdir, v) for v in vids]
     return vids, keys, meta
@@ -1,4 +1,7 @@
 """simplemapper - simple frame -> embedding mapper."""
+import os
+import re
+
 import torch
 import numpy as np
 import open_clip
@@ -36,10 +39,22 @@ def preprocess_vqgan(x):
     return x
 
 
+def token_dtype(n_codes):
+    """smallest unsigned dtype that can hold indices of a codebook with n_codes entries"""
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if n_codes - 1 <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
 class FrameMapper:
     """maps frames -> embeddings (or captions"""
 
-    def __init__(self, model_name, pretrained, device, get_text_tokenizer=False, get_frame_tokenizer=False):
+    def __init__(self, model_name, pretrained, device, get_text_tokenizer=False, get_frame_tokenizer=False, name=None):
+        """
+        name: what outputs of this model are saved as when it's one of several heads (see encode_chunk),
+            defaults to model_name without directories and extension (f.e. "ViT-L-14", "vqgan_imagenet_f16_16384")
+        """
         # Initialize model:
         if not get_frame_tokenizer:
             model, _, preprocess = open_clip.create_model_and_transforms(
@@ -53,13 +68,18 @@ class FrameMapper:
             config = load_config(config_path, display=False)
             model = load_vqgan(config, ckpt_path=ckpt_path, is_gumbel=("gumbel" in config_path)).to(device)
             # preprocess = preprocess_vqgan
-            preprocess = lambda x: x  # dataloader preprocess
+            preprocess = lambda x: x  # dataloader preprocess, frames are normalized on device in tokenize_frames
             tokenizer = lambda x: x
 
         self.model = model
         self.preprocess = preprocess
         self.tokenizer = tokenizer
         self.device = device
+        self.frame_tokenizer = get_frame_tokenizer
+        name = os.path.splitext(os.path.basename(model_name))[0] if name is None else name
+        self.name = re.sub(r"[^\w-]", "-", name)  # used in member names, so no dots or slashes
+        if get_frame_tokenizer:  # VectorQuantizer calls the codebook size n_e, GumbelQuantize n_embed
+            self.token_dtype = token_dtype(getattr(model.quantize, "n_e", None) or model.quantize.n_embed)
 
     def __call__(self, batch, captions=None):
         with torch.no_grad(), torch.cuda.amp.autocast():
@@ -73,10 +93,18 @@ class FrameMapper:
         return caption_embeddings
 
     def tokenize_frames(self, batch):
+        """
+        Input:
+            batch: (n_frames, H, W, 3) uint8 RGB frames, on self.device so they're converted to float there
+        Output:
+            (n_frames, n_tokens) codebook indices as self.token_dtype (f.e. uint16 for a 16384 entry codebook)
+        """
         with torch.no_grad():
+            batch = batch.permute(0, 3, 1, 2).float() / 255.0  # make channel first and [0, 1]
             batch = preprocess_vqgan(batch)
             z, _, [_, _, indices] = self.model.encode(batch)
-        return indices.reshape(-1, np.prod(z.shape[-2:])).cpu().detach().numpy()
+        indices = indices.reshape(-1, np.prod(z.shape[-2:])).to(torch.int32)  # torch has no uint16
+        return indices.cpu().numpy().astype(self.token_dtype)
 
     def generate_captions(self, batch):
         """generate caption for batch of imgs"""
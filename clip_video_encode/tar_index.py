@@ -0,0 +1,87 @@
+"""tar_index - sidecar index of tar member offsets so single samples can be read with one seek."""
+import json
+import tarfile
+
+import fsspec
+
+
+INDEX_SUFFIX = ".index.json"
+
+
+def index_path(tar_path):
+    """{name}.tar -> {name}.index.json"""
+    return (tar_path[: -len(".tar")] if tar_path.endswith(".tar") else tar_path) + INDEX_SUFFIX
+
+
+def split_name(name):
+    """splits a tar member name into webdataset key and extension (f.e. dir/vid.timestamps.npy -> dir/vid, ...)"""
+    prefix, _, base = name.rpartition("/")
+    key, _, ext = base.partition(".")
+    return (prefix + "/" + key if prefix else key), ext
+
+
+def index_tar(fileobj):
+    """
+    reads the member headers of a tar once (skipping over the data)
+
+    Output:
+        index: {key: {ext: [data offset, size]}}
+    """
+    index = {}
+    with tarfile.open(fileobj=fileobj, mode="r:") as tar:
+        for member in tar:
+            if member.isfile():
+                key, ext = split_name(member.name)
+                index.setdefault(key, {})[ext] = [member.offset_data, member.size]
+    return index
+
+
+def save_index(index, path, fs=None):
+    fs = fsspec.filesystem("file") if fs is None else fs
+    with fs.open(path, "w") as f:
+        json.dump(index, f)
+
+
+def load_index(tar_url, build=True):
+    """
+    loads the sidecar index of a tar, building (and saving) it if it doesn't exist yet
+
+    Input:
+        tar_url: fsspec path of the tar
+        build: scan the tar if there's no sidecar index, otherwise raise FileNotFoundError
+    """
+    fs, tar_path = fsspec.core.url_to_fs(tar_url)
+    path = index_path(tar_path)
+    if fs.exists(path):
+        with fs.open(path, "r") as f:
+            return json.load(f)
+    if not build:
+        raise FileNotFoundError(f"no index for {tar_url}")
+    with fs.open(tar_path, "rb") as f:
+        index = index_tar(f)
+    save_index(index, path, fs)
+    return index
+
+
+class TarIndexer:
+    """tracks member offsets of a tar while a webdataset.TarWriter writes it"""
+
+    def __init__(self, tarstream):
+        self.tarstream = tarstream
+        self.n_members = 0
+        self.index = {}
+
+    def update(self, start):
+        """
+        indexes members added since the last update
+
+        Input:
+            start: tarstream.offset before the members were added
+        """
+        ts, pos = self.tarstream, start
+        for member in ts.members[self.n_members :]:
+            pos += len(member.tobuf(ts.format, ts.encoding, ts.errors))  # header(s) precede the data
+            key, ext = split_name(member.name)
+            self.index.setdefault(key, {})[ext] = [pos, member.size]
+            pos += -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.n_members = len(ts.members)
@@ -0,0 +1,138 @@
+"""watch a directory for completed numpy arrays written by other processes."""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+
+# linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+DONE_SUFFIX = ".done"
+
+
+class Inotify:
+    """Minimal ctypes inotify binding, returns names of files written or moved into a directory."""
+
+    def __init__(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        self.path = path
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+
+    def read(self, timeout):
+        """waits up to timeout seconds for events, returns list of file names."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names, i = [], 0
+        while i + EVENT_HEADER.size <= len(buf):
+            _, mask, _, name_len = EVENT_HEADER.unpack_from(buf, i)
+            i += EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:  # events were dropped, rescan
+                names += os.listdir(self.path)
+            names.append(os.fsdecode(buf[i : i + name_len].rstrip(b"\0")))
+            i += name_len
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """Returns .npy files from a directory once producers have finished writing them.
+
+    Completion protocols:
+    * "rename" - producers write to a temporary name that doesn't end with .npy (f.e. vid.npy.tmp)
+                 and os.rename it to vid.npy when done, files appearing as *.npy are complete.
+    * "done"   - producers create an empty vid.npy.done marker after vid.npy is fully written.
+
+    Other file types can be watched for by passing their extensions (f.e. [".npy", ".shm"]).
+
+    Uses inotify on Linux so new files are seen immediately, otherwise polls the directory.
+    """
+
+    def __init__(self, data_dir, completion="rename", poll_interval=0.05, use_inotify=True, extensions=(".npy",)):
+        assert completion in ["rename", "done"]
+        self.data_dir = data_dir
+        self.extensions = tuple(extensions)
+        self.completion = completion
+        self.poll_interval = poll_interval
+        self.seen = set()
+
+        self.inotify = None
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify(data_dir)
+            except OSError as e:
+                print(f"Warning: inotify unavailable ({e}), falling back to polling")
+
+        self.candidates = set(os.listdir(data_dir))  # files that landed before we started watching
+
+    def _ready(self, names):
+        """filters names to completed arrays we haven't returned yet."""
+        ready = []
+        for name in names:
+            if self.completion == "done":
+                if not name.endswith(DONE_SUFFIX):
+                    continue
+                name = name[: -len(DONE_SUFFIX)]
+            if not name.endswith(self.extensions):
+                continue
+            if name not in self.seen:
+                self.seen.add(name)
+                ready.append(name)
+        return sorted(ready)
+
+    def get(self, timeout=None):
+        """
+        blocks until at least one completed array is available (or timeout seconds pass)
+
+        Output:
+            list of file names (relative to data_dir) of completed files
+        """
+        t0 = time.perf_counter()
+        while True:
+            ready = self._ready(self.candidates)
+            self.candidates = set()
+            if len(ready) > 0:
+                return ready
+
+            wait = self.poll_interval if self.inotify is None else 1.0  # inotify wakes up on events
+            if timeout is not None:
+                wait = min(wait, timeout - (time.perf_counter() - t0))
+                if wait <= 0:
+                    return []
+
+            if self.inotify is not None:
+                self.candidates = set(self.inotify.read(wait))
+            else:
+                time.sleep(wait)
+                self.candidates = set(os.listdir(self.data_dir))
+
+    def done(self, name):
+        """cleans up protocol files of a processed array."""
+        if self.completion == "done":
+            marker = os.path.join(self.data_dir, name + DONE_SUFFIX)
+            if os.path.exists(marker):
+                os.remove(marker)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
@@ -1,12 +1,24 @@
 """save embeddings."""
+import csv
 import os
 import json
+import queue
+import shutil
+import tempfile
+import threading
+import uuid
 
 import fsspec
 import numpy as np
 import webdataset as wds
 
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from fsspec.implementations.local import LocalFileSystem
+
+from .manifest import manifest_path, manifest_row, save_manifest
+from .reader import LazyFile
+from .tar_index import INDEX_SUFFIX, TarIndexer, index_path, save_index
 
 
 write_fmt = {
@@ -16,11 +28,64 @@ write_fmt = {
 }
 
 
+def format_metadata(ext, data):
+    if isinstance(data, LazyFile):  # pass-through payloads are only read when written
+        data = data.read()
+    if isinstance(data, bytes):  # already serialized (f.e. members copied from existing files)
+        return data
+    return write_fmt[ext](data) if ext in write_fmt else data
+
+
+FAILURE_COLUMNS = ["video", "videoID", "reason", "message", "shard"]
+PARTIAL_SUFFIX = ".partial.json"
+MANIFEST_ROWS = 10000  # rows per manifest file of FileWriter
+
+
+def write_failures(dest, failures, file_name="failures.csv"):
+    """
+    writes videos that were skipped to a csv next to the output
+
+    Input:
+        dest: fsspec path of the output directory
+        failures: list of dicts with FAILURE_COLUMNS keys (missing ones are left empty)
+    """
+    fs, dest_path = fsspec.core.url_to_fs(dest)
+    with fs.open(os.path.join(dest_path, file_name), "w", newline="") as f:
+        csv_writer = csv.DictWriter(f, FAILURE_COLUMNS, extrasaction="ignore")
+        csv_writer.writeheader()
+        csv_writer.writerows(failures)
+
+
+def load_partials(output_folder):
+    """
+    finds shards that were closed early (see WebDatasetWriter.close)
+
+    Output:
+        {shard_id: {"keys": keys written so far, "parts": number of parts written}}
+    """
+    fs, output_path = fsspec.core.url_to_fs(output_folder)
+    partials = {}
+    for path in fs.glob(f"{output_path}/*{PARTIAL_SUFFIX}"):
+        with fs.open(path, "r") as f:
+            partials[int(path.split("/")[-1].split("_")[0])] = json.load(f)
+    return partials
+
+
 class FileWriter:
     """Writes output as files."""
 
-    def __init__(self, output_folder):
+    def __init__(self, output_folder, manifest=None):
+        """
+        Input:
+            output_folder: fsspec path where files are saved
+            manifest: dict of run-level manifest columns (model, sampling) to write a manifest of the samples
+                to {output_folder}/manifest/ (see manifest), None for no manifest
+        """
         self.output_folder = output_folder
+        self.manifest = manifest
+        self.manifest_rows = []
+        self.manifest_name = f"files_{uuid.uuid4().hex[:8]}"  # unique per writer so runs don't overwrite each other
+        self.n_manifests = 0
 
         self.fs, self.output_folder = fsspec.core.url_to_fs(output_folder)
 
@@ -28,73 +93,321 @@ class FileWriter:
         """write sample to file."""
         key, metadata = str(key), {} if metadata is None else metadata
 
-        save_pth = os.path.join(self.output_folder, key + ".npy")
-        with self.fs.open(save_pth, "wb") as f:
-            nbp = BytesIO()
-            np.save(nbp, arr)
-            f.write(nbp.getbuffer())
+        if arr is not None:
+            self._save_npy(os.path.join(self.output_folder, key + ".npy"), arr)
+        if self.manifest is not None:
+            self.manifest_rows.append(manifest_row(key, key + ".npy", arr, self.manifest))
+            if len(self.manifest_rows) >= MANIFEST_ROWS:
+                self._save_manifest()
 
         for ext in metadata:
             md_filename = os.path.join(self.output_folder, f"{key}.{ext}")
-            write_data = write_fmt[ext](metadata[ext]) if ext in write_fmt else metadata[ext]
-            with self.fs.open(md_filename, "w") as f:
+            write_data = format_metadata(ext, metadata[ext])
+            if isinstance(write_data, np.ndarray):  # f.e. pooled embeddings
+                self._save_npy(md_filename, write_data)
+                continue
+            with self.fs.open(md_filename, "wb" if isinstance(write_data, bytes) else "w") as f:
                 f.write(write_data)
 
-    def close(self):
+    def _save_npy(self, path, arr):
+        with self.fs.open(path, "wb") as f:
+            nbp = BytesIO()
+            np.save(nbp, arr)
+            f.write(nbp.getbuffer())
+
+    def _save_manifest(self):
+        if len(self.manifest_rows) > 0:
+            name = f"{self.manifest_name}_{self.n_manifests:05d}"
+            self.fs.makedirs(os.path.dirname(manifest_path(self.output_folder, name)), exist_ok=True)
+            save_manifest(self.manifest_rows, manifest_path(self.output_folder, name), self.fs)
+            self.manifest_rows = []
+            self.n_manifests += 1
+
+    def flush(self):
+        self._save_manifest()
+
+    def close(self, partial=False):  # pylint: disable=unused-argument
+        self._save_manifest()  # every sample is complete on its own
+
+
+class MemoryWriter:
+    """Keeps samples in memory until they're drained (f.e. to yield them instead of saving)."""
+
+    def __init__(self):
+        self.samples = []
+
+    def write(self, arr, key, metadata=None):
+        self.samples.append((str(key), arr, {} if metadata is None else metadata))
+
+    def drain(self):
+        """returns and forgets all samples written since the last drain."""
+        samples, self.samples = self.samples, []
+        return samples
+
+    def flush(self):
         pass
 
+    def close(self, partial=False):  # pylint: disable=unused-argument
+        pass  # every sample is complete on its own
+
 
 class WebDatasetWriter:
-    """Writes output in WebDataset format."""
+    """Writes output in WebDataset format.
+
+    Samples are handed to a background thread which serializes them into a local staging tar.
+    Shards roll over once they reach maxcount samples or maxsize bytes, and completed shards are
+    moved to output_folder by a pool of upload threads so the encode loop never waits on I/O.
 
-    def __init__(self, output_folder, oom_shard_count, encode_format, maxcount=10000, shard_id=0):
+    A shard closed with close(partial=True) gets a {shard}.partial.json marker listing the keys written to it,
+    passing the marker to create_shard continues the shard in a new part and removes the marker once it's done.
+    With a manifest each shard gets a manifest/{shard}.parquet listing its samples (see manifest).
+    """
+
+    def __init__(
+        self,
+        output_folder,
+        oom_shard_count,
+        encode_format,
+        maxcount=10000,
+        shard_id=0,
+        maxsize=None,
+        shard_suffix="clip_embeddings",
+        queue_size=256,
+        upload_workers=2,
+        write_index=False,
+        manifest=None,
+    ):
+        """
+        Input:
+            output_folder: fsspec path where shards are saved
+            oom_shard_count: zero-padding of shard ids in shard names
+            encode_format: extension the embedding array is saved under
+            maxcount: maximum number of samples per shard
+            shard_id: id of the first shard
+            maxsize: maximum number of payload bytes per shard (None means no limit)
+            shard_suffix: appended to every shard name, make this unique per rank if ranks share output_folder
+            queue_size: maximum number of samples waiting to be serialized before write() blocks
+            upload_workers: number of threads moving completed shards to output_folder
+            write_index: save a {shard}.index.json with the offset of every member next to each shard
+            manifest: dict of run-level manifest columns (model, sampling), None for no manifest
+        """
         self.output_folder = output_folder
         self.oom_shard_count = oom_shard_count
         self.encode_format = encode_format
         self.maxcount = maxcount
+        self.maxsize = maxsize
         self.shard_id = shard_id
-        self.shard_suffix = "clip_embeddings"  # TODO: maybe there should be param for this?
+        self.shard_suffix = shard_suffix
+        self.write_index = write_index
+        self.manifest = manifest
+
+        self.fs, self.output_path = fsspec.core.url_to_fs(output_folder)
+        self.fs.makedirs(self.output_path, exist_ok=True)
+        if manifest is not None:
+            self.fs.makedirs(os.path.dirname(manifest_path(self.output_path, "")), exist_ok=True)
+        self.local_output = isinstance(self.fs, LocalFileSystem)
+        self.staging_dir = self.output_path if self.local_output else tempfile.mkdtemp(prefix="wds_writer_")
 
         self.count = 0
+        self.size = 0
+        self.part = 0
+        self.aligned = False  # shard ids follow input shards so rollover creates parts instead of new ids
 
         self.tarwriter = None
         self.tar_fd = None
+        self.indexer = None
+        self.shard_name = None
+        self.written = []  # (name, sample count) of completed shards
+        self.keys = []  # keys written to all parts of the current shard
+        self.manifest_rows = []  # of the current part
+        self.resumed = False  # current shard continues a partial one
 
-        self.create_shard()
+        self.error = None
+        self.closed = False
+        self.uploads = []
+        self.upload_pool = ThreadPoolExecutor(max_workers=upload_workers)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()  # the first shard is opened by create_shard or the first write
 
-    def create_shard(self, shard_id=None):
-        """create new shard in sequential order."""
-        self.close()
-        if shard_id is not None:
-            self.shard_id = shard_id
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError("WebDatasetWriter background thread failed") from self.error
+
+    def _write_loop(self):
+        """serializes queued samples and shard commands in order."""
+        while True:
+            cmd, payload = self.queue.get()
+            try:
+                if self.error is not None:  # only drain the queue so producers don't block
+                    if cmd == "close" and self.tarwriter is not None:
+                        self._discard_shard()
+                elif cmd == "shard":
+                    self._open_shard(*payload)
+                elif cmd == "sample":
+                    self._write_sample(*payload)
+                elif cmd == "close":
+                    self._finish_shard("partial" if payload else "complete")
+            except Exception as e:  # pylint: disable=(broad-except)
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if cmd == "close":
+                return
+
+    def _get_shard_name(self, part=None):
         shard_name = "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
             shard_id=self.shard_id, oom_shard_count=self.oom_shard_count
         )
-        shard_name += "_" + self.shard_suffix
+        part = self.part if part is None else part
+        if part > 0:
+            shard_name += f"_{part}"
+        return shard_name + "_" + self.shard_suffix
+
+    def _open_shard(self, shard_id, aligned, part=0, keys=None):
+        """finishes current shard and starts staging shard_id (None keeps the current id) at part."""
+        shard_id = self.shard_id if shard_id is None else shard_id
+        if self.tarwriter is not None and self.count == 0 and shard_id == self.shard_id:
+            self._discard_shard()  # nothing written yet (f.e. reopening the same shard)
+        else:
+            self._finish_shard("complete" if shard_id != self.shard_id else None)
+        if shard_id != self.shard_id or keys is not None:
+            self.keys, self.resumed = list(keys or []), keys is not None
+        self.shard_id, self.part, self.aligned = shard_id, part, aligned
 
-        fs, output_path = fsspec.core.url_to_fs(self.output_folder)
-        self.tar_fd = fs.open(f"{output_path}/{shard_name}.tar", "wb")
+        self.shard_name = self._get_shard_name()
+        staged = os.path.join(self.staging_dir, f"{self.shard_name}.tar.tmp")
+        self.tar_fd = open(staged, "wb")  # pylint: disable=consider-using-with
         self.tarwriter = wds.TarWriter(self.tar_fd)
+        self.indexer = TarIndexer(self.tarwriter.tarstream) if self.write_index or self.manifest else None
+        self.manifest_rows = []
+        self.count = 0
+        self.size = 0
 
-    def write(self, arr, key, metadata=None):
-        """write sample to current shard."""
-        key, metadata = str(key), {} if metadata is None else metadata
-        if self.count >= self.maxcount:
-            self.shard_id += 1
-            self.count = 0
-            self.create_shard()
+    def _discard_shard(self):
+        self.tarwriter.close()
+        self.tar_fd.close()
+        os.remove(os.path.join(self.staging_dir, f"{self.shard_name}.tar.tmp"))
+        self.tarwriter, self.tar_fd, self.indexer = None, None, None
+
+    def _finish_shard(self, end=None):
+        """
+        closes current staging tar and hands it off to the upload pool.
+
+        end: "complete" or "partial" if no more parts of the shard follow (None if they do),
+            partial shards get a marker listing their keys, the marker of a resumed shard is removed once complete
+        """
+        if self.tarwriter is None:
+            return
+        files, n_parts = [], self.part + 1
+        if self.count == 0:  # empty shards (or parts) are never uploaded, they'd replace finished ones
+            self._discard_shard()
+            n_parts -= 1
+        else:
+            self.tarwriter.close()
+            self.tar_fd.close()
+            staged = os.path.join(self.staging_dir, f"{self.shard_name}.tar.tmp")
+            files.append((staged, f"{self.output_path}/{self.shard_name}.tar"))
+            if self.write_index:  # index goes up after the tar so it never points at a missing shard
+                staged_index = os.path.join(self.staging_dir, f"{self.shard_name}{INDEX_SUFFIX}.tmp")
+                save_index(self.indexer.index, staged_index)
+                files.append((staged_index, index_path(files[0][1])))
+            if self.manifest is not None:
+                staged_manifest = os.path.join(self.staging_dir, f"{self.shard_name}.parquet.tmp")
+                save_manifest(self.manifest_rows, staged_manifest)
+                files.append((staged_manifest, manifest_path(self.output_path, self.shard_name)))
+            self.written.append((self.shard_name, self.count))
+        marker = f"{self.output_path}/{self._get_shard_name(part=0)}{PARTIAL_SUFFIX}"
+        if end == "partial":  # marker goes up last so it only lists keys of uploaded parts
+            staged_marker = os.path.join(self.staging_dir, f"{self._get_shard_name(part=0)}{PARTIAL_SUFFIX}.tmp")
+            with open(staged_marker, "w", encoding="utf-8") as f:
+                json.dump({"keys": self.keys, "parts": n_parts}, f)
+            files.append((staged_marker, marker))
+        remove = [marker] if end == "complete" and self.resumed else []
+        self.uploads.append(self.upload_pool.submit(self._upload, files, remove))
+        self.tarwriter, self.tar_fd, self.indexer = None, None, None
+
+    def _upload(self, files, remove=()):
+        for staged, dest in files:
+            if self.local_output:
+                os.replace(staged, dest)  # same directory so rename is atomic
+            else:
+                self.fs.put_file(staged, dest)
+                os.remove(staged)
+        for path in remove:
+            if self.fs.exists(path):
+                self.fs.rm(path)
+
+    def _rollover(self):
+        if self.aligned:
+            self._open_shard(None, True, self.part + 1)
+        else:
+            self._open_shard(self.shard_id + 1, False)
+
+    def _write_sample(self, arr, key, metadata):
+        """serializes sample into current shard, rolling over when it's full."""
+        if self.tarwriter is None:
+            self._open_shard(None, False)
+        elif self.count >= self.maxcount or (self.maxsize is not None and self.size >= self.maxsize):
+            self._rollover()
 
         sample = {"__key__": key}
         if arr is not None:
             sample[self.encode_format] = arr
 
         for ext in metadata:
-            sample[ext] = write_fmt[ext](metadata[ext]) if ext in write_fmt else metadata[ext]
+            sample[ext] = format_metadata(ext, metadata[ext])
 
-        self.tarwriter.write(sample)
+        start = self.tarwriter.tarstream.offset
+        self.size += self.tarwriter.write(sample)
+        if self.indexer is not None:
+            self.indexer.update(start)
+        if self.manifest is not None:
+            offset, size = self.indexer.index.get(key, {}).get(self.encode_format, (-1, -1))
+            self.manifest_rows.append(
+                manifest_row(key, self.shard_name + ".tar", arr, self.manifest, self.shard_id, offset, size)
+            )
         self.count += 1
+        self.keys.append(key)
 
-    def close(self):
-        if self.tarwriter is not None:
-            self.tarwriter.close()
-            self.tar_fd.close()
+    def create_shard(self, shard_id=None, partial=None):
+        """
+        create new shard, in sequential order unless shard_id is specified.
+
+        partial: marker of shard_id (see load_partials), writing continues in a new part of the shard
+        """
+        self._check_error()
+        if partial is None:
+            self.queue.put(("shard", (shard_id, shard_id is not None)))
+        else:
+            self.queue.put(("shard", (shard_id, True, partial["parts"], partial["keys"])))
+
+    def write(self, arr, key, metadata=None):
+        """write sample to current shard."""
+        self._check_error()
+        key, metadata = str(key), {} if metadata is None else metadata
+        self.queue.put(("sample", (arr, key, metadata)))
+
+    def flush(self):
+        """wait until all queued samples are serialized (f.e. before pass-through files are deleted)."""
+        self.queue.join()
+        self._check_error()
+
+    def close(self, partial=False):
+        """
+        flush remaining samples and wait for all shards to reach output_folder.
+        raises the error of the background thread if it failed (the shard it failed in isn't saved).
+
+        partial: the current shard isn't complete (f.e. the run was stopped), mark it so it can be continued
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(("close", partial))
+        self.thread.join()
+        for upload in self.uploads:
+            upload.result()
+        self.upload_pool.shutdown()
+        if not self.local_output:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+        self._check_error()
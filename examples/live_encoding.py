@@ -16,7 +16,9 @@ def _convert_image_to_rgb(image):
 
 DATA_DIR = "nps"  # load up DATA_DIR with numpy video frame arrays (https://github.com/iejMac/video2numpy)
 # you can do this live while LiveNumpyEncoder is functioning as long as you pass it
-# the entire set of fnames you expect encoded.
+# the number of arrays you expect encoded. Producers should write each array to a temporary
+# name (f.e. vid.npy.tmp) and os.rename it to vid.npy once it's complete.
+# Producers on the same host can skip the disk with clip_video_encode.live_numpy_encoder.share_frames.
 
 EMB_DIR = "embs"  # save embeddings here
 
@@ -38,7 +40,7 @@ preprocess = Compose(
 )
 fm = FrameMapper(model, device)
 
-np_enc = LiveNumpyEncoder(DATA_DIR, EMB_DIR, VIDS, fm, preprocess)
+np_enc = LiveNumpyEncoder(DATA_DIR, EMB_DIR, len(VIDS), fm, preprocess)
 np_enc.start()
 
 print("DONE ENCODING")
@@ -27,11 +27,12 @@ def clip_encode(selected_config):
     clipencode_abs_path = os.path.join(base_path, 'clip-video-encode')
     with change_dir(clipencode_abs_path):
         from clip_video_encode import clip_video_encode
+    # decode only the keyframes of the original videos, embeddings get their timestamps in *.timestamps.npy
     clip_video_encode(
-        f'{selected_config["base_directory"]}/keyframe_video_requirements.parquet',
+        f'{selected_config["base_directory"]}/original_video_requirements.parquet',
         selected_config["embeddings"],
         frame_workers=25,
-        take_every_nth=1,
+        sampling_strategy="keyframes",
         metadata_columns=['videoLoc', 'videoID', 'duration']
     )
 
@@ -91,6 +91,7 @@ def fix_codecs_in_directory(directory):
             print(f"An unexpected error occurred: {e}")
 
 def segment_key_frames_in_directory(directory, output_directory):
+    # only needed for cutting clips later (fold_seams), clip_encode decodes keyframes of the originals directly
     video_files = glob.glob(f"{directory}/**/*.mp4", recursive=True)
     for video_file in video_files:
         video_id = os.path.basename(video_file).split('.')[0]
@@ -17,6 +17,9 @@ def get_video_duration(video_path):
     return duration
 
 def get_average_embedding(emb_path):
+    mean_path = emb_path[:-len(".npy")] + ".mean.npy"
+    if os.path.exists(mean_path):  # pooled by clip_video_encode, no need to load all frames
+        return np.load(mean_path)
     embeddings = np.load(emb_path)
     average_embedding = np.mean(embeddings, axis=0)
     return average_embedding
@@ -28,7 +31,8 @@ def clip_encode(parquet_path, emb_folder):
             emb_folder,
             frame_workers=25,
             take_every_nth=1,
-            metadata_columns=['videoLoc', 'videoID', 'duration']
+            metadata_columns=['videoLoc', 'videoID', 'duration'],
+            pooling_strategies="mean",
         )
     else:
         print(f"Parquet file {parquet_path} does not exist. Skipping clip_video_encode.")
@@ -87,6 +91,8 @@ def process_videos_and_metadata(dataset_folder, emb_folder):
             
             # Remove the original embedding file to clean up
             os.remove(emb_file_path)
+            if os.path.exists(emb_file_path[:-len(".npy")] + ".mean.npy"):
+                os.remove(emb_file_path[:-len(".npy")] + ".mean.npy")
 
 def main():
     directories = read_config(section="directory")
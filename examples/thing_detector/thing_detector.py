@@ -17,6 +17,7 @@ def conv_filter(probs, width=10):
 
 
 EMBEDDINGS = "pCUtPE4cAsk.npy"
+TIMESTAMPS = "pCUtPE4cAsk.timestamps.npy"
 device = "cuda" if torch.cuda.is_available() else "cpu"
 video_embs = torch.Tensor(np.load(EMBEDDINGS)).to(device)
 
@@ -38,9 +39,8 @@ with torch.no_grad():
     probs = logits_per_frame.softmax(dim=-1).cpu().numpy()
 
 
-T = 12.95  # length of video in minutes
 ps = probs[:, 0]
-xs = [(i * T) / len(ps) for i in range(len(ps))]
+xs = np.load(TIMESTAMPS) / 60  # frame timestamps in minutes
 
 # Unfiltered probs
 plt.plot(xs, ps)
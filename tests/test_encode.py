@@ -24,7 +24,7 @@ def test_encode():
             metadata_columns=["caption", "meta"],
             use_dst_name=True,
         )
-        assert len(os.listdir(tmpdir)) == len(FRAME_COUNTS) * 3
+        assert len(os.listdir(tmpdir)) == len(FRAME_COUNTS) * 4
         for vid in FRAME_COUNTS.keys():
             if vid.endswith(".mp4"):
                 ld = vid[:-4] + ".npy"
@@ -34,3 +34,7 @@ def test_encode():
             embeddings = np.load(os.path.join(tmpdir, ld))
             assert embeddings.shape[0] == FRAME_COUNTS[vid] // 2  # frame count
             assert embeddings.shape[1] == 512  # embed dim
+
+            timestamps = np.load(os.path.join(tmpdir, ld[:-4] + ".timestamps.npy"))
+            assert timestamps.shape == (embeddings.shape[0],)
+            assert np.all(np.diff(timestamps) > 0)
@@ -1,20 +1,46 @@
+import functools
+import http.server
+import io
+import itertools
+import json
 import os
 import glob
 import pytest
+import shutil
 import tempfile
 
+import cv2
+import fsspec
 import open_clip
 import multiprocessing
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import tarfile
+import threading
 import torch
 
+from torch.utils.data._utils.pin_memory import pin_memory
 from torchvision.transforms import Compose, Normalize, ToPILImage, ToTensor
 
+from clip_video_encode import encode_iter
+from clip_video_encode.clip_video_encode import find_done_keys
 from clip_video_encode.utils import block2dl
-from clip_video_encode.simplemapper import FrameMapper
-from clip_video_encode.writer import FileWriter, WebDatasetWriter
-from clip_video_encode.reader import Reader
+from clip_video_encode.coalescer import BatchCoalescer
+from clip_video_encode.handle_chunk import encode_chunk
+from clip_video_encode.dataset.create_shards import create_shards
+from clip_video_encode.dataset import EmbeddingWebDatasetReader, IndexedEmbeddingDataset, ShardList
+from clip_video_encode.dataset.dataset_reader import LazyJson
+from clip_video_encode.frame_reader import FrameReader, SceneSampler, VideoError, get_frames
+from clip_video_encode.manifest import load_manifest, manifest_dataset
+from clip_video_encode.live_numpy_encoder import LiveNumpyEncoder, share_frames
+from clip_video_encode.live_socket_encoder import LiveSocketClient, LiveSocketEncoder
+from clip_video_encode.pooling import pool_chunk
+from clip_video_encode.simplemapper import FrameMapper, token_dtype
+from clip_video_encode.writer import FileWriter, MemoryWriter, WebDatasetWriter, load_partials
+from clip_video_encode.reader import LazyFile, Reader, StreamingReader, is_table_src, read_shard
+from clip_video_encode.tar_index import index_path, index_tar, load_index
+from clip_video_encode.watcher import DirectoryWatcher
 
 
 FRAME_COUNTS = {
@@ -54,6 +80,85 @@ def test_utils():
     assert batch_count == int(N_FRAMES / BATCH_SIZE)
 
 
+def test_frame_reader():
+    vids = [os.path.join("tests/test_videos", vid) for vid in FRAME_COUNTS]
+    fr = FrameReader(vids, take_every_nth=2, resize_size=64, memory_size=0.125)
+    fr.start_reading()
+
+    n_read = 0
+    for frames, info in fr:
+        n_read += 1
+        vid = os.path.basename(vids[info["reference"]])
+        assert frames.shape == (FRAME_COUNTS[vid] // 2, 64, 64, 3)
+        assert info["timestamps"].shape == (frames.shape[0],)
+        assert np.allclose(info["timestamps"], np.arange(0, FRAME_COUNTS[vid], 2) / info["fps"], atol=1e-3)
+    assert n_read == len(vids)
+
+
+def test_frame_reader_stop():
+    stop = threading.Event()
+    vids = [os.path.join("tests/test_videos", vid) for vid in FRAME_COUNTS] * 50
+    fr = FrameReader(vids, take_every_nth=1, resize_size=64, memory_size=0.125, stop=stop)
+    fr.start_reading()
+    threading.Timer(1.5, stop.set).start()
+
+    n_read = sum(1 for _ in fr)  # doesn't wait for the remaining videos once stopped
+    assert n_read < len(vids) and not any(p.is_alive() for p in fr.procs)
+
+
+@pytest.mark.parametrize("take_every_nth", [3, 20])
+def test_seek_decoding(take_every_nth):
+    vids = [os.path.join("tests/test_videos", vid) for vid in FRAME_COUNTS]
+
+    def read(decode_strategy):
+        fr = FrameReader(
+            vids, take_every_nth=take_every_nth, resize_size=64, memory_size=0.125, decode_strategy=decode_strategy
+        )
+        fr.start_reading()
+        return {info["reference"]: (frames, info["timestamps"]) for frames, info in fr}
+
+    sequential, seek = read("sequential"), read("seek")
+    for ref, (frames, times) in sequential.items():
+        assert np.allclose(seek[ref][1], times, atol=1e-3)
+        assert np.abs(seek[ref][0].astype(np.int16) - frames).mean() < 1
+
+
+def test_scene_sampling():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        vid = os.path.join(tmpdir, "scenes.avi")
+        writer = cv2.VideoWriter(vid, cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 64))
+        for color in [(0, 0, 0), (255, 255, 255), (0, 0, 255)]:  # three static 3 second scenes
+            for _ in range(30):
+                writer.write(np.full((64, 64, 3), color, dtype=np.uint8))
+        writer.release()
+
+        def read(sampler):
+            fr = FrameReader([vid], take_every_nth=1, resize_size=32, memory_size=0.0625, sampler=sampler)
+            fr.start_reading()
+            return [info["timestamps"] for _, info in fr][0]
+
+        times = read(SceneSampler(threshold=0.1, min_fps=0.5))
+        assert np.allclose(times, [0.0, 2.0, 3.0, 5.0, 6.0, 8.0], atol=1e-3)  # cuts at 3s and 6s plus every 2s
+        times = read(SceneSampler(threshold=0.1, min_fps=0.5, frame_budget=3))
+        assert np.allclose(times, [0.0, 3.0, 6.0], atol=1e-3)  # budget keeps the largest changes
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_keyframe_reader():
+    def read(**kwargs):
+        fr = FrameReader(["tests/test_videos/vid2.mp4"], resize_size=64, memory_size=0.125, **kwargs)
+        fr.start_reading()
+        return [(frames, info["timestamps"]) for frames, info in fr][0]
+
+    key_frames, key_times = read(keyframes=True)
+    all_frames, all_times = read(take_every_nth=1)
+    assert 0 < len(key_frames) < len(all_frames) // 10 and key_times.shape == (len(key_frames),)
+    for frame, t in zip(key_frames, key_times):  # same frames the full decode returns at those timestamps
+        ind = np.argmin(np.abs(all_times - t))
+        assert abs(all_times[ind] - t) < 1e-3
+        assert np.abs(frame.astype(np.int16) - all_frames[ind]).mean() < 4  # resized by ffmpeg's scaler, not cv2
+
+
 @pytest.mark.parametrize("oc_model_name", ["ViT-B-32", "ViT-L-14"])
 def test_mapper(oc_model_name):
     # Initialize model:
@@ -71,6 +176,27 @@ def test_mapper(oc_model_name):
     assert output.shape == (bs, model_output_dim)
 
 
+def test_pooling():
+    lat_dim = 8
+    lens = [5, 1, 12]
+    embeddings = np.concatenate([np.random.rand(n, lat_dim).astype(np.float16) for n in lens])
+    bounds = [(sum(lens[:i]), sum(lens[: i + 1])) for i in range(len(lens))]
+
+    pooled = pool_chunk(embeddings, bounds, ["mean", "max", "norm_mean", "window_mean"], window=4)
+    timed_pooled = pool_chunk(embeddings, bounds, ["window_mean"], window=1.0, timestamps=np.arange(18) * 0.5)
+
+    assert len(pooled) == len(lens)
+    for (i0, it), vid_pooled in zip(bounds, pooled):
+        emb = embeddings[i0:it].astype(np.float32)
+        assert vid_pooled["mean"].dtype == embeddings.dtype
+        assert np.allclose(vid_pooled["mean"], emb.mean(axis=0), atol=1e-3)
+        assert np.allclose(vid_pooled["max"], emb.max(axis=0), atol=1e-3)
+        assert np.isclose(np.linalg.norm(vid_pooled["norm_mean"].astype(np.float32)), 1.0, atol=1e-2)
+        assert vid_pooled["window_mean"].shape == (-(-(it - i0) // 4), lat_dim)
+        assert np.allclose(vid_pooled["window_mean"][0], emb[:4].mean(axis=0), atol=1e-3)
+    assert [len(p["window_mean"]) for p in timed_pooled] == [3, 1, 6]  # windows of 2 frames aligned to whole seconds
+
+
 @pytest.mark.parametrize("writer_type", ["files", "webdataset"])
 def test_writer(writer_type):
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -107,6 +233,119 @@ def test_writer(writer_type):
             assert len(tarfile.open(tmpdir + "/00000_clip_embeddings.tar").getnames()) == (N_VIDS // 2) * 3
 
 
+def test_writer_maxsize():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        N_VIDS = 10
+        emb = np.ones((100, 8), dtype=np.float32)  # 3200 payload bytes per sample
+        writer = WebDatasetWriter(tmpdir, 5, "npy", maxcount=1000, maxsize=3 * emb.nbytes, shard_suffix="rank0")
+        for i in range(N_VIDS):
+            writer.write(emb, str(i))
+        writer.close()
+
+        l = sorted(glob.glob(tmpdir + "/*.tar"))
+        assert len(l) == 4
+        assert l[0] == tmpdir + "/00000_rank0.tar"
+        assert len(glob.glob(tmpdir + "/*.tmp")) == 0
+        assert sum(len(tarfile.open(t).getnames()) for t in l) == N_VIDS
+
+
+def test_writer_partial():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        emb = np.ones((10, 8), dtype=np.float32)
+        writer = WebDatasetWriter(tmpdir, 5, "npy", maxcount=2, shard_id=3)
+        writer.create_shard(shard_id=3)
+        for i in range(3):
+            writer.write(emb, str(i))
+        writer.close(partial=True)  # stopped mid-shard
+        assert load_partials(tmpdir) == {3: {"keys": ["0", "1", "2"], "parts": 2}}
+
+        writer = WebDatasetWriter(tmpdir, 5, "npy", maxcount=2, shard_id=3)
+        writer.create_shard(shard_id=3, partial=load_partials(tmpdir)[3])
+        for i in range(3, 5):
+            writer.write(emb, str(i))
+        writer.create_shard(shard_id=4)
+        writer.write(emb, "5")
+        writer.close()
+
+        assert load_partials(tmpdir) == {}  # shard 3 was completed
+        names = [f"00003{p}_clip_embeddings.tar" for p in ["", "_1", "_2"]]
+        assert sorted(os.path.basename(t) for t in glob.glob(tmpdir + "/*.tar")) == sorted(
+            names + ["00004_clip_embeddings.tar"]
+        )
+        keys = [tarfile.open(os.path.join(tmpdir, n)).getnames() for n in names]
+        assert [k.split(".")[0] for ks in keys for k in ks] == [str(i) for i in range(5)]
+
+
+def test_writer_rerun():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        run_info = {"model": "ViT-B-32:laion2b_s34b_b79k", "sampling": "{}"}
+        writer = WebDatasetWriter(tmpdir, 5, "npy", manifest=run_info)
+        writer.create_shard(shard_id=0)
+        for i in range(2):
+            writer.write(np.ones((3, 8), dtype=np.float32), str(i))
+        writer.close()
+
+        # re-run after all shards are done: nothing is encoded, finished shards are left alone
+        WebDatasetWriter(tmpdir, 5, "npy", manifest=run_info).close()
+        writer = WebDatasetWriter(tmpdir, 5, "npy", manifest=run_info)
+        writer.create_shard(shard_id=1)
+        writer.close()
+        assert sorted(os.listdir(tmpdir)) == ["00000_clip_embeddings.tar", "manifest"]
+        assert len(tarfile.open(tmpdir + "/00000_clip_embeddings.tar").getnames()) == 2
+        assert load_manifest(tmpdir).num_rows == 2
+
+
+def test_writer_error():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = WebDatasetWriter(tmpdir, 5, "npy")
+        writer.write(np.ones((2, 8), dtype=np.float32), "0", {"foo": {"a": 1}})  # no encoder for .foo
+        errors = []
+
+        def close():
+            try:
+                writer.close()
+            except RuntimeError as e:
+                errors.append(e)
+
+        closer = threading.Thread(target=close, daemon=True)
+        closer.start()
+        closer.join(timeout=10)
+        assert not closer.is_alive()  # close returns after the background thread failed
+        assert len(errors) == 1 and errors[0].__cause__ is not None
+
+
+@pytest.mark.parametrize("writer_type", ["files", "webdataset"])
+def test_writer_manifest(writer_type):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        run_info = {"model": "ViT-B-32:laion2b_s34b_b79k", "sampling": '{"take_every_nth": 2}'}
+        if writer_type == "files":
+            writer = FileWriter(tmpdir, manifest=run_info)
+        else:
+            writer = WebDatasetWriter(tmpdir, 5, "npy", maxcount=3, manifest=run_info)
+        for i in range(5):
+            writer.write(np.full((i + 1, 8), i, dtype=np.float32), str(i), {"txt": str(i)})
+        writer.close()
+
+        manifest = load_manifest(tmpdir).to_pydict()
+        assert sorted(manifest["key"]) == [str(i) for i in range(5)]
+        assert set(manifest["model"]) == {run_info["model"]}
+        for key, location, offset, size, n_frames in zip(
+            manifest["key"], manifest["location"], manifest["offset"], manifest["size"], manifest["n_frames"]
+        ):
+            assert n_frames == int(key) + 1
+            with open(os.path.join(tmpdir, location), "rb") as f:
+                f.seek(max(offset, 0))
+                emb = np.load(io.BytesIO(f.read(size if offset >= 0 else -1)))
+            assert np.all(emb == int(key))
+
+        dataset = manifest_dataset(tmpdir)
+        assert find_done_keys(dataset, run_info, ["1", "3", "7"]) == {"1", "3"}
+        other_model = {**run_info, "model": "ViT-L-14:openai"}
+        assert find_done_keys(dataset, other_model, ["1", "3"]) == set()
+        other_sampling = {**run_info, "sampling": '{"take_every_nth": 4}'}
+        assert find_done_keys(dataset, other_sampling, ["1", "3"]) == set()
+
+
 @pytest.mark.parametrize("input_format", ["txt", "csv", "parquet"])
 def test_reader(input_format):
     src = f"tests/test_videos/test_list.{input_format}"
@@ -121,3 +360,549 @@ def test_reader(input_format):
     assert len(meta) == len(metadata_columns)
     for k in meta:
         assert k in metadata_columns
+
+
+def test_is_table_src():
+    link = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+    assert not is_table_src(link)  # a single video, not a glob
+    vids, _, _ = Reader(link, []).get_data()
+    assert vids == [link]
+    assert is_table_src("tests/test_videos/test_list.parquet") and is_table_src("s3://bucket/part-*")
+    assert is_table_src("tables/part-[0-9]") and not is_table_src("tests/test_videos/vid1.mp4")
+
+
+@pytest.mark.parametrize("input_format", ["txt", "csv", "parquet"])
+@pytest.mark.parametrize("world_size", [1, 2, 3])
+def test_streaming_reader(input_format, world_size):
+    src = f"tests/test_videos/test_list.{input_format}"
+    metadata_columns = ["caption", "meta"] if input_format != "txt" else []
+
+    read_ids = []
+    for rank in range(world_size):
+        reader = StreamingReader(src, list(metadata_columns), rank=rank, world_size=world_size, batch_size=2)
+        for vid, ref in reader:
+            assert isinstance(vid, str)
+            assert set(reader.meta.keys()) == set(metadata_columns)
+            read_ids.append(reader.ids[ref].as_py())
+        reader.release(list(range(len(read_ids))))
+        assert len(reader.ids) == 0
+
+    assert sorted(read_ids) == [0, 1, 2]  # every row read exactly once across ranks
+
+    if input_format == "txt":  # byte offsets of the lines instead of line numbers
+        offset_ids = []
+        for rank in range(world_size):
+            reader = StreamingReader(src, [], rank=rank, world_size=world_size, batch_size=2, line_ids=False)
+            offset_ids += [reader.ids[ref].as_py() for _, ref in reader]
+        with open(src, "rb") as f:
+            assert sorted(offset_ids) == [0] + list(itertools.accumulate(len(line) for line in f.readlines()[:-1]))
+
+
+def test_streaming_reader_row_groups():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, "vids.parquet")
+        n_rows = 100
+        table = pa.table({"videoID": list(range(n_rows)), "videoLoc": [f"{i}.mp4" for i in range(n_rows)]})
+        pq.write_table(table, src, row_group_size=70)  # uneven row groups, fewer than ranks
+
+        read_ids = []
+        for rank in range(4):
+            reader = StreamingReader(src, [], rank=rank, world_size=4, batch_size=16)
+            ids = [reader.ids[ref].as_py() for _, ref in reader]
+            assert len(ids) == n_rows // 4  # split by rows, not by row groups
+            read_ids += ids
+        assert read_ids == list(range(n_rows))
+
+
+def test_read_shard():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = {
+            "a.mp4": b"vid_a",
+            "a.txt": b"caption a",
+            "a.json": b'{"x": 1}',
+            "a.optical-flow.npy": b"flow",
+            "b.webm": b"vid_b",
+            "b.mp4": b"vid_b_mp4",
+            "c.webm": b"vid_c",
+            "d.txt": b"no video",
+        }
+        for fname, data in files.items():
+            with open(os.path.join(tmpdir, fname), "wb") as f:
+                f.write(data)
+
+        vids, keys, meta = read_shard(
+            tmpdir, pass_through_keys=["txt", "json", "optical-flow.npy"], video_extensions=["webm", "mp4"]
+        )
+
+        assert keys == ["a", "b", "c"]
+        assert [os.path.basename(v) for v in vids] == ["a.mp4", "b.webm", "c.webm"]
+        assert meta[0]["txt"] == "caption a"
+        assert meta[0]["json"] == {"x": 1}
+        assert isinstance(meta[0]["optical-flow.npy"], LazyFile)
+        assert meta[0]["optical-flow.npy"].read() == b"flow"
+        assert meta[1] == {} and meta[2] == {}
+
+
+@pytest.mark.parametrize("completion", ["rename", "done"])
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_watcher(completion, use_inotify):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        np.save(os.path.join(tmpdir, "early.npy"), np.zeros((2, 3)))
+        if completion == "done":
+            open(os.path.join(tmpdir, "early.npy.done"), "w").close()
+
+        watcher = DirectoryWatcher(tmpdir, completion=completion, use_inotify=use_inotify)
+        assert watcher.get(timeout=1.0) == ["early.npy"]
+
+        # half-written arrays aren't returned
+        if completion == "rename":
+            with open(os.path.join(tmpdir, "vid.npy.tmp"), "wb") as f:
+                np.save(f, np.ones((4, 3)))
+        else:
+            np.save(os.path.join(tmpdir, "vid.npy"), np.ones((4, 3)))
+        assert watcher.get(timeout=0.2) == []
+
+        if completion == "rename":
+            os.rename(os.path.join(tmpdir, "vid.npy.tmp"), os.path.join(tmpdir, "vid.npy"))
+        else:
+            open(os.path.join(tmpdir, "vid.npy.done"), "w").close()
+        assert watcher.get(timeout=1.0) == ["vid.npy"]
+        assert np.load(os.path.join(tmpdir, "vid.npy")).shape == (4, 3)
+
+        watcher.done("vid.npy")
+        assert not os.path.exists(os.path.join(tmpdir, "vid.npy.done"))
+        assert watcher.get(timeout=0.2) == []  # already returned arrays aren't returned again
+        watcher.close()
+
+
+def _to_chw(frame):
+    return torch.tensor(frame).permute(2, 0, 1).float()
+
+
+class MeanMapper:
+    """maps frames to their per-channel means, stands in for a model"""
+
+    device = "cpu"
+    tokenizer = None
+    preprocess = staticmethod(_to_chw)
+
+    def __call__(self, batch):
+        return batch.mean(dim=(2, 3)).half().numpy()
+
+
+class MeanColorVQ(torch.nn.Module):
+    """quantizes 8x8 patches to the nearest of n_e gray levels, stands in for a VQGAN"""
+
+    def __init__(self, n_e):
+        super().__init__()
+        self.quantize = torch.nn.Module()
+        self.quantize.n_e = n_e
+
+    def encode(self, x):
+        z = torch.nn.functional.avg_pool2d(x.mean(dim=1, keepdim=True), 8)
+        indices = ((z + 1) / 2 * (self.quantize.n_e - 1)).round().long()
+        return z, None, [None, None, indices.flatten()]
+
+
+def test_frame_tokenization():
+    mapper = FrameMapper.__new__(FrameMapper)  # skips loading a model
+    mapper.model, mapper.device, mapper.tokenizer, mapper.preprocess = MeanColorVQ(16384), "cpu", None, np.asarray
+    mapper.token_dtype = token_dtype(16384)
+
+    frames = [np.full((n, 32, 32, 3), 17 * i, dtype=np.uint8) for i, n in enumerate([3, 5])]
+    ind_dict = {0: (0, 3, "a.npy"), 1: (3, 8, "b.npy")}
+    writer = MemoryWriter()
+    encode_chunk(frames, ind_dict, writer, mapper, {}, ["a", "b"], False, "cpu", frame_tokenization_strategy="vqgan")
+
+    samples = writer.drain()
+    assert [(key, tokens.shape, tokens.dtype) for key, tokens, _ in samples] == [
+        ("a", (3, 16), np.uint16),
+        ("b", (5, 16), np.uint16),
+    ]
+    assert np.all(samples[1][1] == round(17 / 255 * 16383))
+    assert token_dtype(256) == np.uint8 and token_dtype(257) == np.uint16 and token_dtype(70000) == np.uint32
+
+
+class MaxHead(MeanMapper):
+    """maps frames to their per-channel maxima and keeps the batches it got"""
+
+    name = "max"
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, batch):
+        self.batches.append(batch)
+        return batch.amax(dim=(2, 3)).numpy()
+
+
+def test_multi_head_encoding():
+    vq = FrameMapper.__new__(FrameMapper)
+    vq.model, vq.device, vq.tokenizer, vq.preprocess = MeanColorVQ(256), "cpu", None, np.asarray
+    vq.token_dtype, vq.frame_tokenizer, vq.name = token_dtype(256), True, "vq"
+    mean_head, max_head, shared_head = MeanMapper(), MaxHead(), MaxHead()
+    shared_head.name = "max2"
+
+    frames = [np.random.randint(0, 255, (n, 32, 32, 3), dtype=np.uint8) for n in [3, 5]]
+    ind_dict = {0: (0, 3, "a.npy"), 1: (3, 8, "b.npy")}
+    writer = MemoryWriter()
+    heads = [mean_head, max_head, vq, shared_head]
+    encode_chunk(frames, ind_dict, writer, heads, {}, ["a", "b"], False, "cpu", pooling_strategies=["mean"])
+
+    samples = writer.drain()
+    assert [key for key, _, _ in samples] == ["a", "b"]
+    for (_, emb, meta), vid_frames in zip(samples, frames):
+        assert np.allclose(emb, vid_frames.mean(axis=(1, 2)), atol=0.5)  # first head is the main output
+        assert np.array_equal(meta["max.npy"], vid_frames.max(axis=(1, 2)))
+        assert np.array_equal(meta["max2.npy"], meta["max.npy"])
+        assert meta["vq.npy"].shape == (len(vid_frames), 16) and meta["vq.npy"].dtype == np.uint8
+        assert np.allclose(meta["max.mean.npy"], meta["max.npy"].mean(axis=0))
+        assert "mean.npy" in meta and "vq.mean.npy" not in meta  # tokens aren't pooled
+    # heads with the same preprocessing got the same preprocessed batches
+    assert all(a is b for a, b in zip(max_head.batches, shared_head.batches))
+
+
+@pytest.mark.parametrize("handoff", ["npy", "shm"])
+def test_live_numpy_encoder(handoff):
+    with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as dest_dir:
+        lengths = {"a.npy": 5, "b.npy": 17, "c.npy": 3}
+        vids = {}
+        for name, n in lengths.items():
+            vids[name] = np.random.randint(0, 255, (n, 8, 8, 3), dtype=np.uint8)
+            if handoff == "npy":
+                np.save(os.path.join(data_dir, name), vids[name])
+            else:
+                share_frames(data_dir, name[:-4], vids[name])
+
+        frame_mem = 6 * 8 * 8 * 3 / 1024**3  # 6 frames, arrays have to be split across flushes
+        enc = LiveNumpyEncoder(data_dir, dest_dir, len(lengths), MeanMapper(), _to_chw, frame_mem, use_inotify=False)
+        enc.start()
+
+        assert enc.buffer.capacity == 6
+        assert enc.pieces == {} and enc.shms == {} and enc.closing == []
+        for name, frames in vids.items():
+            emb = np.load(os.path.join(dest_dir, name))
+            assert emb.dtype == np.float16 and emb.shape == (lengths[name], 3)
+            np.testing.assert_allclose(emb, frames.mean(axis=(1, 2)), rtol=1e-2)
+
+
+def test_live_socket_encoder():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        socket_path = os.path.join(tmpdir, "encode.sock")
+        enc = LiveSocketEncoder(socket_path, MeanMapper(), _to_chw, batch_size=4, max_wait=0.01)
+        server = threading.Thread(target=enc.start)
+        server.start()
+
+        results = {}
+
+        def produce(producer_id):
+            client = LiveSocketClient(socket_path)
+            vids = [np.random.randint(0, 255, (n, 8, 8, 3), dtype=np.uint8) for n in [1, 6, 3]]
+            for i, frames in enumerate(vids):  # pipeline requests, responses come back in order
+                client.send(f"{producer_id}_{i}", frames)
+            for i, frames in enumerate(vids):
+                key, emb = client.recv()
+                results[key] = (emb, frames.mean(axis=(1, 2)))
+            client.close()
+
+        producers = [threading.Thread(target=produce, args=(i,)) for i in range(3)]
+        for p in producers:
+            p.start()
+        for p in producers:
+            p.join()
+        enc.close()
+        server.join()
+
+        assert sorted(results) == [f"{p}_{i}" for p in range(3) for i in range(3)]
+        for emb, expected in results.values():
+            assert emb.dtype == np.float16
+            np.testing.assert_allclose(emb, expected, rtol=1e-2)
+        assert not os.path.exists(socket_path)
+
+
+def test_coalescer():
+    mapper = MeanMapper()
+    coalescer = BatchCoalescer(mapper, max_batch_size=16, max_wait=0.05)
+    batches = [torch.rand(n, 3, 4, 4) for n in [1, 2, 3, 20, 1, 5, 2, 2]]
+    results = [None] * len(batches)
+
+    def call(i):
+        results[i] = coalescer(batches[i])
+
+    callers = [threading.Thread(target=call, args=(i,)) for i in range(len(batches))]
+    for c in callers:
+        c.start()
+    for c in callers:
+        c.join()
+    coalescer.close()
+
+    for batch, emb in zip(batches, results):
+        np.testing.assert_allclose(emb, mapper(batch), rtol=1e-3)
+
+    stats = coalescer.stats()
+    assert stats["requests"] == len(batches) and stats["frames"] == 36 and stats["queue_depth"] == 0
+    assert 3 <= stats["batches"] < len(batches)  # calls were coalesced, 20 frame call was split
+
+
+def test_encode_iter():
+    vids = [os.path.join("tests/test_videos", vid) for vid in FRAME_COUNTS]
+    results = encode_iter(
+        vids, take_every_nth=2, frame_memory_size=0.125, img_size=32, mapper=MeanMapper(), pooling_strategies="mean"
+    )
+
+    n_results = 0
+    for key, emb, meta in results:
+        n_frames = FRAME_COUNTS[os.path.basename(vids[int(key)])] // 2
+        assert emb.shape == (n_frames, 3)
+        assert meta["timestamps.npy"].shape == (n_frames,)
+        np.testing.assert_allclose(meta["mean.npy"], emb.astype(np.float32).mean(axis=0), rtol=1e-2)
+        n_results += 1
+    assert n_results == len(vids)
+
+
+def test_video_limits():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corrupt = os.path.join(tmpdir, "corrupt.mp4")
+        with open(corrupt, "wb") as f:
+            f.write(b"not a video" * 100)
+        vids = [os.path.join("tests/test_videos", vid) for vid in FRAME_COUNTS] + [corrupt]
+
+        fr = FrameReader(vids, take_every_nth=2, resize_size=32, memory_size=0.0625, max_frames=40)
+        fr.start_reading()
+        assert [vids[info["reference"]] for _, info in fr] == [vids[0]]
+        assert sorted((f["video"], f["kind"]) for f in fr.failures) == [
+            (corrupt, "unreadable"),
+            (vids[1], "max_frames"),
+        ]
+
+        failures = []
+        results = encode_iter(
+            vids,
+            take_every_nth=2,
+            frame_memory_size=0.0625,
+            img_size=32,
+            mapper=MeanMapper(),
+            max_bytes=300000,
+            failures=failures,
+        )
+        assert [int(key) for key, _, _ in results] == [0]  # the shard keeps going past skipped videos
+        assert sorted((f["video"], f["reason"]) for f in failures) == [(corrupt, "unreadable"), (vids[1], "max_bytes")]
+
+
+def test_video_download_limit():
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory="tests/test_videos")
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/vid2.mp4"
+    try:
+        with pytest.raises(VideoError) as e:
+            get_frames(url, 0, 10, -1, 32, -1, max_bytes=300000)
+        assert e.value.kind == "max_bytes"
+        frames, info = get_frames(url, 0, 10, -1, 32, -1, max_bytes=10**6)
+        assert len(frames) == len(info["timestamps"]) > 0 and info["dst_name"] == "vid2.npy"
+    finally:
+        server.shutdown()
+
+
+def test_embedding_dataset_bucketing():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = WebDatasetWriter(tmpdir, 5, "npy", maxcount=1000)
+        lengths = [3, 17, 5, 16, 4, 18, 2, 15, 9]
+        for i, n in enumerate(lengths):
+            meta = {"txt": f"caption {i % 3}", "json": {"n": n}}
+            writer.write(np.full((n, 8), i + 1, dtype=np.float32), str(i), meta)
+        writer.close()
+
+        reader = EmbeddingWebDatasetReader(
+            tmpdir + "/00000_clip_embeddings.tar",
+            standard_seq_len=-1,
+            batch_size=2,
+            num_prepro_workers=1,
+            enable_meta=True,
+            bucket_window=4,
+        )
+
+        n_samples = 0
+        for batch in reader:
+            emb, mask = batch["embeddings"], batch["zero_mask"]
+            batch_lengths = mask.sum(dim=1).long()
+            assert emb.shape[1] == batch_lengths.max()  # padded only to the longest sample in the batch
+            assert batch["text_tokens"].shape[0] == len(batch["text"]) == emb.shape[0]
+            assert [m["n"] for m in batch["meta"]] == batch_lengths.tolist()
+            for e, n in zip(emb, batch_lengths):
+                assert torch.all(e[:n] > 0) and torch.all(e[n:] == 0)
+            n_samples += emb.shape[0]
+        assert n_samples == len(lengths)
+
+
+def test_embedding_dataset_collate():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = WebDatasetWriter(tmpdir, 5, "npy", maxcount=1000)
+        for i in range(6):
+            meta = {"txt": f"caption {i % 2}", "json": {"i": i}}
+            writer.write(np.full((4, 8), i, dtype=np.float16), str(i), meta)
+        writer.close()
+
+        reader = EmbeddingWebDatasetReader(
+            tmpdir + "/00000_clip_embeddings.tar", 4, batch_size=3, num_prepro_workers=1, enable_meta=True
+        )
+        batches = list(reader)
+        assert len(batches) == 2
+        for batch in batches:
+            assert batch["embeddings"].shape == (3, 4, 8) and batch["embeddings"].dtype == torch.float16
+            assert batch["zero_mask"].shape == (3, 4)
+            assert batch["text_tokens"].shape == (3, 77)
+            assert torch.equal(batch["text_tokens"], open_clip.tokenize(batch["text"]))
+            for emb, meta in zip(batch["embeddings"], batch["meta"]):
+                assert torch.all(emb == meta["i"])
+
+
+def test_lazy_json():
+    metas = [LazyJson(json.dumps({"i": i}).encode()) for i in range(3)]
+    pinned = pin_memory({"meta": metas})  # what the DataLoader does with every batch
+    assert all(m._decoded is None for m in pinned["meta"])  # pylint: disable=protected-access
+    assert [m["i"] for m in pinned["meta"]] == [0, 1, 2] and dict(metas[0].items()) == {"i": 0}
+
+
+def test_embedding_dataset_sharding():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = WebDatasetWriter(tmpdir, 5, "npy", maxcount=3)
+        for i in range(15):
+            writer.write(np.full((2, 4), i, dtype=np.float32), str(i), {"txt": "", "json": {"i": i}})
+        writer.close()
+        urls = tmpdir + "/{00000..00004}_clip_embeddings.tar"
+
+        reader = EmbeddingWebDatasetReader(
+            urls, 2, batch_size=2, num_prepro_workers=2, enable_meta=True, shuffle_shards=True, shuffle_buffer=4
+        )
+        epochs = [[m["i"] for batch in reader for m in batch["meta"]] for _ in range(2)]
+        for seen in epochs:
+            assert sorted(seen) == list(range(15))  # every sample exactly once across workers
+        assert epochs[0] != epochs[1]
+
+        ranks = [ShardList(urls, shuffle=True, rank=r, world_size=2).split() for r in range(2)]
+        assert sorted(ranks[0] + ranks[1]) == sorted(ShardList(urls).urls)
+
+        reader = EmbeddingWebDatasetReader(
+            urls, 2, batch_size=3, num_prepro_workers=2, enable_meta=True, resampled=True, epoch_length=4
+        )
+        seen = [m["i"] for batch in reader for m in batch["meta"]]
+        assert len(seen) == 12 and len(set(seen)) == 12  # 2 workers x 2 batches, no sample twice within a pass
+
+
+def test_create_shards():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_dir, dest = os.path.join(tmpdir, "data"), os.path.join(tmpdir, "shards")
+        for split, n in [("train", 7), ("val", 3)]:
+            writer = FileWriter(os.path.join(data_dir, split))
+            os.makedirs(os.path.join(data_dir, split))
+            for i in range(n):
+                meta = {"txt": f"{split} {i}", "json": {"i": i}, "timestamps.npy": np.arange(i + 1)}
+                writer.write(np.full((i + 1, 4), i, dtype=np.float32), f"{split}_{i}", meta)
+
+        rows = create_shards(data_dir, dest, maxcount=3, workers=2, oom_shard_count=3)
+        assert [(split, n) for _, split, n in rows] == [("train", 3), ("train", 3), ("train", 1), ("val", 3)]
+        with open(os.path.join(dest, "splits.csv"), encoding="utf-8") as f:
+            assert f.read().splitlines()[1:] == [f"{tar},{split},{n}" for tar, split, n in rows]
+
+        keys = []
+        for tar, _, n in rows:
+            samples = {}
+            with tarfile.open(os.path.join(dest, tar)) as t:
+                for member in t:
+                    key, ext = member.name.split(".", 1)
+                    samples.setdefault(key, {})[ext] = t.extractfile(member).read()
+            assert len(samples) == n
+            for key, members in samples.items():
+                i = int(key.split("_")[1])
+                assert set(members) == {"npy", "txt", "json", "timestamps.npy"}
+                assert members["txt"].decode() == key.replace("_", " ")
+                assert np.load(io.BytesIO(members["npy"])).shape == (i + 1, 4)
+                keys.append(key)
+        assert sorted(keys) == sorted([f"train_{i}" for i in range(7)] + [f"val_{i}" for i in range(3)])
+
+
+def test_create_shards_extractor():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_dir, dest = os.path.join(tmpdir, "kinetics700"), os.path.join(tmpdir, "shards")
+        clips = [
+            ("train", "abseiling", "AbC_eFgHiJk", 0),
+            ("train", "zumba", "-0123456789", 30),
+            ("val", "zumba", "x" * 11, 5),
+        ]
+        for split, label, video_id, start in clips:
+            os.makedirs(os.path.join(data_dir, split, label), exist_ok=True)
+            np.save(
+                os.path.join(data_dir, split, label, f"{video_id}_{start:06}_{start + 10:06}.npy"), np.zeros((3, 4))
+            )
+
+        rows = create_shards(data_dir, dest, extractor="kinetics700")
+        assert [(split, n) for _, split, n in rows] == [("train", 2), ("val", 1)]
+        assert not os.path.exists(os.path.join(data_dir, "processed"))
+
+        reader = EmbeddingWebDatasetReader(
+            dest + "/{00000..00001}_clip_embeddings.tar", 3, batch_size=1, num_prepro_workers=1, enable_meta=True
+        )
+        seen = {(batch["text"][0], batch["meta"][0]["videoID"], batch["meta"][0]["start_time"]) for batch in reader}
+        assert seen == {(label, video_id, f"{start:06}") for _, label, video_id, start in clips}
+
+
+def test_tar_index():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = WebDatasetWriter(tmpdir, 5, "npy", maxcount=4, write_index=True)
+        for i in range(6):
+            meta = {"txt": f"caption {i}" * (i * 50), "json": {"i": i}, "timestamps.npy": np.arange(i + 1) / 2}
+            writer.write(np.full((i + 1, 8), i, dtype=np.float32), f"vid_{i}", meta)
+        writer.close()
+
+        shards = sorted(glob.glob(tmpdir + "/*.tar"))
+        assert len(shards) == 2
+        for shard in shards:
+            written = load_index(shard, build=False)
+            with open(shard, "rb") as f:
+                assert written == index_tar(f)  # index emitted while writing matches a scan
+
+        ds = IndexedEmbeddingDataset(shards)
+        assert len(ds) == 6
+        for i in [5, 0, 3]:
+            sample = ds.get(f"vid_{i}")
+            assert sample["embeddings"].shape == (i + 1, 8) and torch.all(sample["embeddings"] == i)
+            assert sample["text"] == f"caption {i}" * (i * 50)
+            assert sample["meta"]["i"] == i
+
+        os.remove(index_path(shards[0]))
+        assert IndexedEmbeddingDataset(shards[0]).get("vid_1")["meta"]["i"] == 1  # index is rebuilt if missing
+        assert os.path.exists(index_path(shards[0]))
+
+
+class CountingFile:
+    """file wrapper that counts the bytes read from it"""
+
+    def __init__(self, f):
+        self.f, self.n_read = f, 0
+
+    def seek(self, pos):
+        return self.f.seek(pos)
+
+    def read(self, n):
+        data = self.f.read(n)
+        self.n_read += len(data)
+        return data
+
+
+def test_indexed_dataset_range_reads():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = WebDatasetWriter(tmpdir, 5, "npy", write_index=True)
+        video = os.urandom(2**20)  # pass-through member stored between json and npy
+        for i in range(2):
+            meta = {"txt": f"caption {i}", "json": {"i": i}, "mp4": video, "mean.npy": np.zeros(8)}
+            writer.write(np.full((3, 8), i, dtype=np.float32), f"vid_{i}", meta)
+        writer.close()
+
+        shard = tmpdir + "/00000_clip_embeddings.tar"
+        ds = IndexedEmbeddingDataset("file://" + shard)
+        with fsspec.open(shard, "rb") as f:  # read like a remote shard instead of memory mapping it
+            ds.files[0] = counter = CountingFile(f)
+            sample = ds.get("vid_1")
+            assert torch.all(sample["embeddings"] == 1) and sample["text"] == "caption 1" and sample["meta"]["i"] == 1
+            assert counter.n_read < 4 * 4096  # the video isn't read